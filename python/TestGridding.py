@@ -8,6 +8,8 @@ from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
 import scipy.interpolate as sip
 
+from ocalfw.functions import Circle, Gaussian2D
+
 ## Global constants
 
 image_shape = (10,35)
@@ -18,45 +20,6 @@ image_shape = (10,35)
 ##
 ## =============================================================================
 
-##______________________________________________________________________________
-##                                                                        Circle
-
-def Circle (x,
-            y,
-            x0=0.0,
-            y0=0.0,
-            a0=1.0,
-            a1=1.0,
-            a2=1.0):
-    """ General definition of circle, or rather an ellipse.
-        :param x:  x-axis coordinate value.
-        :param y:  y-axis coordinate value.
-        :param x0: x-axis coordinate of the circle's center position.
-        :param y0: y-axis coordinate of the circle's center position.
-    """
-    r = a0 * np.sqrt(a1*(x-x0)**2 + a2*(y-y0)**2)
-    return r
-
-##______________________________________________________________________________
-##                                                                        Circle
-
-def Gaussian2D(x,
-               y,
-               x0=0.0,
-               x1=1.0,
-               y0=0.0,
-               y1=1.0,
-               a0=2.0,
-               a1=1.0):
-    """ 2D Gaussian function.
-
-        :param x: x-axis positions of the points where the function is computed.
-        :param y: y-axis positions of the points where the function is computed.
-        :param x0: Offset along the x-axis.
-        :param y0: Offset along the y-axis.
-    """
-    return a0*np.exp(-(x-x0)**2/(2*x1)**2-(y-y0)**2/(2*y1)**2)+a1
-
 ##______________________________________________________________________________
 ##                                                            transformation_map
 
@@ -64,11 +27,8 @@ def transformation_map(shape):
     """ Generate map for transformation from detector (row,col) to (row,wavelength)
         grid.
     """
-    m = np.ndarray(shape=shape)
-    for nrow in range(shape[0]):
-        rowValue = 0.5*shape[0]-nrow
-        for ncol in range(shape[1]):
-            m[nrow,ncol] = Circle(rowValue, 1.5*ncol, y0=0.5*ncol, a0=10)
+    nrow, ncol = np.indices(shape, dtype=float)
+    m = Circle(0.5*shape[0]-nrow, 1.5*ncol, y0=0.5*ncol, a0=10)
     return m
 
 ## =============================================================================
@@ -140,8 +100,9 @@ def example2 (pdf_pages):
     yr  = y + np.random.randn(nofPoints,nofPoints)
     xr  = x + np.random.randn(nofPoints,nofPoints)
     # Re-gridding of data onto regular grid
-    #zn  = griddata(xr.ravel(), yr.ravel(), z.ravel(), x, y)
-    #zl  = griddata(xr.ravel(),yr.ravel(),z.ravel(),x,y,interp='linear')
+    print ("--> Re-gridding onto regular grid ...")
+    zn  = sip.griddata((xr.ravel(), yr.ravel()), z.ravel(), (x, y), method='nearest')
+    zl  = sip.griddata((xr.ravel(), yr.ravel()), z.ravel(), (x, y), method='linear')
 
     # Plot the grid points
     print ("--> Creating scatter plot of mesh points ...")
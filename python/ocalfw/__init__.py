@@ -0,0 +1 @@
+""" Calibration framework for the PRNU CKD of imaging spectrometers. """
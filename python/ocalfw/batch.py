@@ -0,0 +1,244 @@
+""" Batch processing of the PRNU algorithm over a stack of detector frames.
+
+    All reductions and normalizations of the individual steps operate on the
+    full (nofFrames, nofRows, nofColumns) stack at once, while the products
+    which only depend on the instrument geometry -- spectral calibration map,
+    pixel quality mask and filter window -- are computed once and shared by
+    all frames.
+"""
+
+import numpy as np
+
+import filters
+import normalization
+from scm import get_scm
+
+## =============================================================================
+##
+##  Class definition
+##
+## =============================================================================
+
+class BatchPRNU (object):
+
+    def __init__(self,
+                 frames,
+                 pixel_quality=None,
+                 selection=None,
+                 filter_shape=(15, 15),
+                 dtype=None,
+                 cache_dir=None,
+                 image_area=None):
+        """ Initialize object's internal data.
+
+            :param frames: Stack of detector frames, shape (nofFrames, rows,
+                           columns).
+            :param pixel_quality: Pixel quality mask, non-zero for bad pixels;
+                                  either a single mask of shape (rows, columns)
+                                  shared by all frames or one mask per frame.
+                                  By default pixels with a signal < 0.1 are
+                                  flagged, as in `PRNU`.
+            :param selection: Slices (rows, columns) of the selected image area;
+                              defaults to the full image area.
+            :param filter_shape: Shape of the low-pass filter window (step 4).
+            :param dtype: Floating point type of the computation, see
+                          `normalization.normalize`.
+            :param cache_dir: Directory for persisted spectral calibration maps
+                              and re-gridding operators.
+            :param image_area: Shape of the full CCD, which determines the
+                               instrument geometry; defaults to the shape of
+                               the frames. Frames may be cropped to the rows up
+                               to the end of the selection, e.g. when reading
+                               only that hyperslab from a file.
+        """
+        frames = np.asarray(frames)
+        if frames.ndim != 3:
+            raise ValueError("BatchPRNU needs a (nofFrames, rows, columns) stack!")
+        """ Stack of detector frames. """
+        self._frames = frames
+        """ Image area for full CCD. """
+        if image_area is None:
+            image_area = frames.shape[1:]
+        self.image_area = tuple(image_area)
+        """ Pixel quality mask, shared by all frames or per frame. """
+        if pixel_quality is None:
+            pixel_quality = frames < 0.1
+        self._pixel_quality = np.asarray(pixel_quality, dtype=bool)
+        """ Image area selection slices. """
+        if selection is None:
+            selection = [slice(0, self.image_area[0]), slice(0, self.image_area[1])]
+        self._selection = list(selection)
+        """ Row number index for selection. """
+        self.index_row = np.arange(*self._selection[0].indices(self.image_area[0]))
+        """ Shape of the low-pass filter window used in step 4. """
+        self._filter_shape = filter_shape
+        """ Floating point type of the computation. """
+        self._dtype = dtype
+        """ Directory for persisted geometry products. """
+        self.cache_dir = cache_dir
+        """ Column normalization factors, shape (nofFrames, nofColumns). """
+        self.f_norm_col = None
+        """ Row normalization factors, shape (nofFrames, nofRows). """
+        self.f_norm_row = None
+        """ Row normalized detector signal. """
+        self._signal_row_norm = None
+        """ Wavelength of the selected rows' pixels, shared by all frames. """
+        self._wavelength = None
+        """ Smoothed signal. """
+        self._signal_smooth = None
+        """ Stack of PRNU maps. """
+        self._prnu = None
+        """ Per-frame statistics. """
+        self.statistics = {}
+
+    ##__________________________________________________________________________
+    ## Step 1: Remove swath dependent signal variations
+
+    def calc_prnu_step1(self):
+        print ("\n[Step 1] Remove swath dependent signal variations\n")
+        self.f_norm_col, self.f_norm_row, self._signal_row_norm = \
+            normalization.normalize(self._frames,
+                                    self._pixel_quality,
+                                    self._selection,
+                                    dtype=self._dtype)
+
+    ##__________________________________________________________________________
+
+    def calc_prnu_step2(self):
+        print ("\n[Step 2] Removal of smile effect\n")
+        # The mesh coordinates are the same for all frames; the mesh values are
+        # the row normalized signal itself (struct-of-arrays layout)
+        scm = get_scm(self.image_area, cache_dir=self.cache_dir)
+        self._wavelength = scm[self.index_row]
+
+    ##__________________________________________________________________________
+
+    def calc_prnu_step3(self):
+        print ("\n[Step 3] Correct for variations in spectral intensity\n")
+
+    ##__________________________________________________________________________
+
+    def calc_prnu_step4(self, window=None, method='auto'):
+        print ("\n[Step 4] Removal of high-frequency features\n")
+        if window is None:
+            window = filters.hanning_window_2d(self._filter_shape)
+        nofRows = len(self.index_row)
+        self._signal_smooth = filters.apply_filter(self._signal_row_norm,
+                                                   window,
+                                                   mask=self._pixel_quality[..., :nofRows, :],
+                                                   method=method)
+
+    ##__________________________________________________________________________
+
+    def calc_prnu_step5(self):
+        print ("\n[Step 5] Re-introduction of high-frequency variations\n")
+
+    ##__________________________________________________________________________
+
+    def calc_prnu_step6(self):
+        # No-op, as `PRNU.calc_prnu_step6`: the signal is on the detector grid
+        print ("\n[Step 6] Re-gridding to Detector grid\n")
+
+    ##__________________________________________________________________________
+
+    def calc_prnu_step7(self):
+        print ("\n[Step 7] Inverse normalization of row intensities\n")
+        self._signal_smooth *= self.f_norm_row[..., np.newaxis]
+
+    ##__________________________________________________________________________
+
+    def calc_prnu_step8(self):
+        print ("\n[Step 8] Calculate PRNU CKD\n")
+        nofRows = len(self.index_row)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._prnu = self._frames[:, :nofRows]/self._signal_smooth
+        self._prnu[np.broadcast_to(self._pixel_quality[..., :nofRows, :],
+                                   self._prnu.shape)] = np.nan
+        self.calc_statistics()
+
+    ##__________________________________________________________________________
+
+    def calc_statistics(self):
+        """ Per-frame statistics of the input signal and the PRNU maps.
+        """
+        selection = (slice(None),) + tuple(self._selection)
+        mask      = np.broadcast_to(self._pixel_quality, self._frames.shape)
+        with np.errstate(invalid='ignore'):
+            self.statistics = {
+                'signal_mean' : self._frames[selection].mean(axis=(1, 2)),
+                'bad_pixels'  : mask[selection].sum(axis=(1, 2)),
+                'prnu_mean'   : np.nanmean(self._prnu, axis=(1, 2)),
+                'prnu_std'    : np.nanstd(self._prnu, axis=(1, 2)),
+                'prnu_min'    : np.nanmin(self._prnu, axis=(1, 2)),
+                'prnu_max'    : np.nanmax(self._prnu, axis=(1, 2))}
+        return self.statistics
+
+    ##__________________________________________________________________________
+
+    def calc_prnu(self):
+        """ Calculate the PRNU CKD for all frames.
+
+            :return: Tuple with the stack of PRNU maps and a dictionary with
+                     per-frame statistics.
+        """
+        self.calc_prnu_step1()
+        self.calc_prnu_step2()
+        self.calc_prnu_step3()
+        self.calc_prnu_step4()
+        self.calc_prnu_step5()
+        self.calc_prnu_step6()
+        self.calc_prnu_step7()
+        self.calc_prnu_step8()
+        return self._prnu, self.statistics
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import copy
+    import time
+    from prnu import PRNU
+
+    nofFrames = 8
+
+    ## Reference: single frame PRNU, repeated for each frame
+    prnu = PRNU()
+    data = prnu._data
+    frames = np.array([data._signal*(1.0+0.05*n) for n in range(nofFrames)])
+    start = time.time()
+    reference = []
+    for n in range(nofFrames):
+        single = PRNU()
+        single._data = copy.deepcopy(data)
+        single._data._signal = frames[n]
+        single.calc_prnu()
+        reference.append(single._data._prnu)
+    time_single = time.time()-start
+
+    ## Batch processing of all frames
+    start = time.time()
+    batch = BatchPRNU(frames,
+                      pixel_quality=data._pixel_quality,
+                      selection=data._selection)
+    result, statistics = batch.calc_prnu()
+    time_batch = time.time()-start
+
+    print ("\n[Batch PRNU for %d frames of %d x %d pixels]\n" % frames.shape)
+    print ("-- Time frame-by-frame .... = %.4f s" % time_single)
+    print ("-- Time batch ............. = %.4f s" % time_batch)
+    print ("-- Max. difference ........ = %g"
+           % np.nanmax(np.abs(result-np.array(reference))))
+    for key in sorted(statistics):
+        print ("-- %-12s = %s" % (key, statistics[key]))
+
+    ## The PRNU is the ratio of the signal and its smoothed version, so it
+    ## scatters around 1 in every column; only the columns where the swath
+    ## signal is small compared to the pixel noise (uniform in [0,1)) deviate
+    column_mean = np.nanmean(result, axis=(0, 1))
+    signal_mean = frames[:, :result.shape[1]].mean(axis=(0, 1))
+    print ("-- PRNU mean .............. = %.4f" % np.nanmean(result))
+    print ("-- Column means ........... = %.4f .. %.4f"
+           % (column_mean.min(), column_mean.max()))
+    np.testing.assert_allclose(result, np.array(reference), rtol=1e-12)
+    assert abs(np.nanmean(result)-1.0) < 0.01
+    assert np.all(np.abs(column_mean[signal_mean > 2.0]-1.0) < 0.02)
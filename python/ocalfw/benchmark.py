@@ -0,0 +1,367 @@
+""" Benchmark suite for the calibration pipeline.
+
+    Sweeps the size of the image area, the size of the selection, the floating
+    point type and the number of frames across the steps of the PRNU algorithm,
+    both for single frames (`PRNU`, as used by `run.py`) and for stacks of
+    frames (`BatchPRNU`),
+    the construction of filter windows, the generation of the spectral
+    calibration map and the reporting. The timings are stored in a JSON file,
+    which can serve as baseline for a later run; a run compared against a
+    baseline fails if any benchmark became slower by more than a threshold.
+
+    Usage:
+
+        python benchmark.py [--sizes 256 512 1024] [--output results.json]
+                            [--baseline baseline.json] [--threshold 0.2]
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import filters
+import scm
+from batch import BatchPRNU
+from prnu import PRNU
+from profiling import StepProfiler
+from report_prnu import ReportPRNU
+from stepcache import StepCache
+from workspace import Workspace
+
+## Default parameters of the sweep
+IMAGE_SIZES = (256, 512, 1024, 2048)
+SELECTIONS  = (0.25, 0.5)
+DTYPES      = ('float64', 'float32')
+FRAMES      = (1, 4)
+REPORT_SIZE = 512
+
+## Timings below this value (in seconds) are not checked for regressions,
+## since they are dominated by noise
+MIN_TIME = 0.01
+
+## Attributes of `BatchPRNU` produced by the individual steps
+BATCH_OUTPUTS = dict(PRNU.STEP_OUTPUTS)
+BATCH_OUTPUTS[2] = ('_wavelength',)
+
+## =============================================================================
+##
+##  Helper functions
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                      _best_of
+
+def _best_of(function,
+             repeat):
+    """ Best wall clock time of repeated calls of a function. """
+    best = np.inf
+    for n in range(repeat):
+        start = time.time()
+        function()
+        best = min(best, time.time()-start)
+    return best
+
+##______________________________________________________________________________
+##                                                                    _selection
+
+def _selection(size,
+               fraction):
+    """ Centered selection covering a fraction of the rows and columns. """
+    length = max(int(size*fraction), 16)
+    first  = (size-length)//2
+    return [slice(first, first+length), slice(first, first+length)]
+
+##______________________________________________________________________________
+##                                                                      _quietly
+
+def _quietly(function, *args, **kwargs):
+    """ Call a function with the progress output suppressed. """
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+##______________________________________________________________________________
+##                                                                      metadata
+
+def metadata():
+    """ Description of the environment in which the benchmarks were run. """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=open(os.devnull, 'w')).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit'   : commit,
+            'python'   : platform.python_version(),
+            'numpy'    : np.__version__,
+            'platform' : platform.platform(),
+            'time'     : time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+## =============================================================================
+##
+##  Benchmarks
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                bench_pipeline
+
+def bench_pipeline(size,
+                   fraction,
+                   dtype,
+                   nofFrames,
+                   repeat=3):
+    """ Time the steps of the PRNU algorithm for a stack of frames.
+
+        :return: Dictionary benchmark name -> time [s].
+    """
+    selection = _selection(size, fraction)
+    frames    = 1.0 + np.random.rand(nofFrames, size, size)
+    prefix    = 'prnu/%dx%d/sel%g/%s/frames%d' % (size, size, fraction, dtype, nofFrames)
+    results   = {}
+    for n in range(repeat):
+        profiler = StepProfiler(trace_allocations=False)
+        batch = BatchPRNU(frames, selection=selection, dtype=np.dtype(dtype))
+        for step in range(1, 9):
+            method = getattr(batch, 'calc_prnu_step%d' % step)
+            with profiler.step('step%d' % step, batch, BATCH_OUTPUTS[step]):
+                _quietly(method)
+        for record in profiler.records:
+            name = prefix + '/' + record['step']
+            results[name] = min(results.get(name, np.inf), record['wall_time'])
+    results[prefix + '/total'] = sum(results[prefix + '/step%d' % step]
+                                     for step in range(1, 9))
+    return results
+
+##______________________________________________________________________________
+##                                                                  bench_single
+
+def bench_single(size,
+                 fraction,
+                 dtype,
+                 repeat=3):
+    """ Time the steps of the PRNU algorithm for single frames, processed as
+        consecutive frames sharing a workspace, and the re-run of a frame with
+        all steps taken from the step cache.
+
+        :return: Dictionary benchmark name -> time [s].
+    """
+    selection = _selection(size, fraction)
+    signal    = 1.0 + np.random.rand(size, size)
+    workspace = Workspace()
+    prefix    = 'single/%dx%d/sel%g/%s' % (size, size, fraction, dtype)
+    results   = {}
+    for n in range(repeat):
+        profiler = StepProfiler(trace_allocations=False)
+        prnu = PRNU(signal=signal, selection=selection, workspace=workspace)
+        prnu.step_options[1] = {'dtype' : np.dtype(dtype)}
+        _quietly(prnu.calc_prnu, profiler=profiler)
+        prnu._data.release()
+        for record in profiler.records:
+            name = prefix + '/' + record['step']
+            results[name] = min(results.get(name, np.inf), record['wall_time'])
+    results[prefix + '/total'] = sum(results[prefix + '/step%d' % step]
+                                     for step in range(1, 9))
+
+    cache = StepCache()
+    prnu  = PRNU(signal=signal, selection=selection)
+    prnu.step_options[1] = {'dtype' : np.dtype(dtype)}
+    _quietly(prnu.calc_prnu, cache=cache)
+    results[prefix + '/cached'] = _best_of(lambda: _quietly(prnu.calc_prnu, cache=cache),
+                                           repeat)
+    return results
+
+##______________________________________________________________________________
+##                                                                 bench_filters
+
+def bench_filters(repeat=5):
+    """ Time the construction (with the window cache cleared) and application
+        of filter windows.
+    """
+    results = {}
+    data    = np.random.rand(512, 512)
+    for size in (15, 63, 255):
+        for name, window in [('hanning', filters.hanning_window_2d),
+                             ('moving_average', filters.moving_average_2d)]:
+            def construct():
+                filters.clear_window_cache()
+                window((size, size))
+            results['filters/%s/%d/construct' % (name, size)] = _best_of(construct, repeat)
+        weights = filters.hanning_window_2d((size, size))
+        results['filters/hanning/%d/apply512' % size] = \
+            _best_of(lambda: filters.apply_filter(data, weights), repeat)
+    return results
+
+##______________________________________________________________________________
+##                                                                     bench_scm
+
+def bench_scm(sizes,
+              dtypes,
+              repeat=3):
+    """ Time the generation of the spectral calibration map. """
+    results = {}
+    for size in sizes:
+        for dtype in dtypes:
+            results['scm/%dx%d/%s' % (size, size, dtype)] = \
+                _best_of(lambda: scm.spectral_calibration_map((size, size),
+                                                              dtype=dtype), repeat)
+    return results
+
+##______________________________________________________________________________
+##                                                                  bench_report
+
+def bench_report(size):
+    """ Time the generation of the diagnostic plots of each step. """
+    results   = {}
+    directory = tempfile.mkdtemp()
+    try:
+        prnu = PRNU(signal=1.0+np.random.rand(size, size),
+                    selection=_selection(size, 0.5))
+        _quietly(prnu.calc_prnu)
+        report = ReportPRNU()
+        for step in range(1, 9):
+            outfile = os.path.join(directory, 'step%d.pdf' % step)
+            method  = getattr(report, 'step%d' % step)
+            start   = time.time()
+            _quietly(method, prnu._data, outfile=outfile)
+            results['report/%dx%d/step%d' % (size, size, step)] = time.time()-start
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+##______________________________________________________________________________
+##                                                                     run_suite
+
+def run_suite(sizes=IMAGE_SIZES,
+              selections=SELECTIONS,
+              dtypes=DTYPES,
+              frames=FRAMES,
+              report_size=REPORT_SIZE,
+              repeat=3,
+              log=sys.stdout):
+    """ Run all benchmarks.
+
+        :param report_size: Image size for the reporting benchmark; `None`
+                            skips reporting.
+        :return: Dictionary benchmark name -> time [s].
+    """
+    results = {}
+    for size in sizes:
+        for fraction in selections:
+            for dtype in dtypes:
+                np.random.seed(0)
+                timing = bench_single(size, fraction, dtype, repeat)
+                results.update(timing)
+                prefix = 'single/%dx%d/sel%g/%s' % (size, size, fraction, dtype)
+                for name in [prefix + '/total', prefix + '/cached']:
+                    log.write("-- %-44s %10.4f s\n" % (name, timing[name]))
+                for nofFrames in frames:
+                    np.random.seed(0)
+                    timing = bench_pipeline(size, fraction, dtype, nofFrames, repeat)
+                    results.update(timing)
+                    for name in timing:
+                        if name.endswith('/total'):
+                            log.write("-- %-44s %10.4f s\n" % (name, timing[name]))
+    results.update(bench_filters(repeat))
+    results.update(bench_scm(sizes, dtypes, repeat))
+    if report_size is not None:
+        results.update(bench_report(report_size))
+    return results
+
+## =============================================================================
+##
+##  Regression check
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                       compare
+
+def compare(results,
+            baseline,
+            threshold=0.2,
+            min_time=MIN_TIME):
+    """ Compare timings against a baseline.
+
+        :param results: Dictionary benchmark name -> time [s].
+        :param baseline: Dictionary benchmark name -> time [s] of the baseline.
+        :param threshold: Maximum tolerated relative slow-down.
+        :param min_time: Benchmarks faster than this in both runs are not
+                         checked.
+        :return: List of tuples (name, baseline, time, ratio) of the
+                 benchmarks which regressed.
+    """
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        if max(results[name], baseline[name]) < min_time:
+            continue
+        ratio = results[name]/baseline[name]
+        if ratio > 1.0+threshold:
+            regressions.append((name, baseline[name], results[name], ratio))
+    return regressions
+
+##______________________________________________________________________________
+##                                                                          main
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=IMAGE_SIZES,
+                        help="Edge lengths of the square image areas")
+    parser.add_argument('--selections', type=float, nargs='+', default=SELECTIONS,
+                        help="Fractions of rows/columns covered by the selection")
+    parser.add_argument('--dtypes', nargs='+', default=DTYPES,
+                        help="Floating point types of the computation")
+    parser.add_argument('--frames', type=int, nargs='+', default=FRAMES,
+                        help="Numbers of frames processed as a stack")
+    parser.add_argument('--report-size', type=int, default=REPORT_SIZE,
+                        help="Image size for the reporting benchmark (0 to skip)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Number of repetitions; the best time is kept")
+    parser.add_argument('--output', default='benchmark.json',
+                        help="JSON file to which the results are written")
+    parser.add_argument('--baseline',
+                        help="JSON file with results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Maximum tolerated relative slow-down")
+    parser.add_argument('--min-time', type=float, default=MIN_TIME,
+                        help="Benchmarks faster than this [s] are not checked")
+    args = parser.parse_args(argv)
+
+    print ("\n[Benchmarking ocalfw]\n")
+    results = run_suite(sizes=args.sizes,
+                        selections=args.selections,
+                        dtypes=args.dtypes,
+                        frames=args.frames,
+                        report_size=args.report_size or None,
+                        repeat=args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump({'metadata' : metadata(), 'results' : results},
+                  f, indent=2, sort_keys=True)
+    print ("\n-- %d results written to %s" % (len(results), args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold, args.min_time)
+        print ("-- Compared against %s: %d regressions beyond %.0f%%"
+               % (args.baseline, len(regressions), 100*args.threshold))
+        for name, before, after, ratio in regressions:
+            print ("   %-52s %10.4f s -> %10.4f s (x%.2f)" % (name, before, after, ratio))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
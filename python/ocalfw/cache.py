@@ -0,0 +1,148 @@
+""" Small caching utilities shared by the calibration modules: a bounded
+    least-recently-used (LRU) cache and helpers to derive cache keys.
+"""
+
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+## =============================================================================
+##
+##  Class definition
+##
+## =============================================================================
+
+class LRUCache (object):
+    """ Bounded mapping which evicts the least recently used entry once the
+        maximum number of entries has been reached.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self, maxsize=16):
+        """ Initialize object's internal data.
+
+            :param maxsize: Maximum number of entries held by the cache.
+        """
+        """ Maximum number of entries held by the cache. """
+        self.maxsize = maxsize
+        """ Cached entries, ordered from least to most recently used. """
+        self._entries = OrderedDict()
+        """ Number of cache hits. """
+        self.hits = 0
+        """ Number of cache misses. """
+        self.misses = 0
+
+    ##__________________________________________________________________________
+    ##                                                                       get
+
+    def get(self, key, default=None):
+        """ Retrieve entry for `key`, marking it as most recently used.
+        """
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    ##__________________________________________________________________________
+    ##                                                                       put
+
+    def put(self, key, value):
+        """ Store entry for `key`, evicting the least recently used entries if
+            the cache is full.
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    ##__________________________________________________________________________
+    ##                                                                     clear
+
+    def clear(self):
+        """ Remove all entries and reset the statistics.
+        """
+        self._entries.clear()
+        self.hits   = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+## =============================================================================
+##
+##  Helper functions
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                     key_digest
+
+def key_digest(key):
+    """ Hex digest of a cache key, suitable for use in file names.
+
+        :param key: Cache key; tuples/lists, scalars and strings are supported.
+    """
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+##______________________________________________________________________________
+##                                                                  array_digest
+
+def array_digest(*arrays):
+    """ Hex digest of the contents (shape, type and values) of arrays, used to
+        key cached products derived from them. MD5 is used for its speed on
+        large arrays; the digest only identifies contents, it is not a
+        security measure.
+    """
+    digest = hashlib.md5()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(repr((array.shape, array.dtype.str)).encode('utf-8'))
+        digest.update(array.data)
+    return digest.hexdigest()
+
+##______________________________________________________________________________
+##                                                                  atomic_write
+
+def atomic_write(filename,
+                 write):
+    """ Write a file under a temporary name first and rename it once complete,
+        so that concurrent runs never pick up a partially written file.
+
+        :param filename: Name of the file to be written.
+        :param write: Function writing the data, called with the temporary
+                      file name.
+    """
+    directory = os.path.dirname(filename) or '.'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    handle, tmpname = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(handle)
+    try:
+        write(tmpname)
+        os.rename(tmpname, filename)
+    except Exception:
+        os.remove(tmpname)
+        raise
+
+##______________________________________________________________________________
+##                                                                 readonly_array
+
+def readonly_array(array):
+    """ Mark an array as read-only, so that cached instances can safely be
+        shared between callers.
+    """
+    array = np.asarray(array)
+    array.setflags(write=False)
+    return array
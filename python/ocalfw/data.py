@@ -1,33 +1,9 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from pylab import *
-
-## =============================================================================
-##
-##  Helper functions
-##
-## =============================================================================
-
-def Sin (x,
-         a0=0.0,
-         a1=1.0,
-         a2=1.0,
-         a3=0.0):
-    """ Generalized sin function, including offsets and scale factors.
-    """
-    return a0+a1*np.sin(a2*x+a3)
-
-def Circle (x,
-            y,
-            x0=0.0,
-            y0=0.0,
-            a0=1.0,
-            a1=1.0,
-            a2=1.0):
-    """ General definition of circle, or rather an ellipse.
-    """
-    r = a0 * np.sqrt(a1*(x-x0)**2 + a2*(y-y0)**2)
-    return r
+import scm
+from swath import default_swath
+from workspace import Workspace
 
 ## =============================================================================
 ##
@@ -47,76 +23,192 @@ class Data(object):
         """
 
         """Image area for full CCD. """
-        self.image_area = (1024,600)
+        self.image_area = tuple(kwargs.get('image_area', (1024,600)))
         """ Image area selection slices. """
-        self._selection = [ slice(100,500), slice(200,500) ]
-        """ Swath angle dependent signal variation. """
-        self._swath = np.random.rand(self.image_area[0], self.image_area[1])
+        self._selection = list(kwargs.get('selection', [ slice(100,500), slice(200,500) ]))
+        """ Column profile of the swath dependent signal variation, see
+            `swath.SwathProfile`. """
+        self.swath_profile = kwargs.get('swath_profile')
+        if self.swath_profile is None:
+            self.swath_profile = default_swath(self.image_area[1])
+        """ Pool of work buffers, which may be shared by the objects processing
+            consecutive frames of the same geometry. """
+        self._workspace = kwargs.get('workspace')
+        if self._workspace is None:
+            self._workspace = Workspace()
         """ Spectral calibration map (SCM). """
         self._scm = []
+        """ Directory for persisted spectral calibration maps and re-gridding
+            operators; if `None` these are only cached in memory. """
+        self.scm_cache_dir = None
         """ (row,wavelength) mesh points derived from spectral calibration map. """
         self._signal_row_wavelength = []
-        """ Detector signal for full CCD. """
-        self._signal = np.random.rand(self.image_area[0],self.image_area[1])
         """ Pixel quality mask for full CCD. """
         self._pixel_quality = []
         """ Masked array for the signal array. """
         self.signal_masked = []
         """ Masked array for the selection from the signal array. """
         self.signal_selection_masked = []
-        """ Row normalization factor. Must be floating point to yield non-zero
-            values later on. """
-        self.f_norm_row = np.zeros(self._selection[0].stop-self._selection[0].start, 'float32')
-        """ Column normalization factor. Must be floating point to yield non-zero
-            values later on. """
-        self.f_norm_col = np.zeros(self._selection[1].stop-self._selection[1].start, 'float32')
-        """ Row number index for selection. """
-        self.index_row = np.arange(self._selection[0].start, self._selection[0].stop, 1)
-        """ Column number index for selection. """
-        self.index_col = np.arange(self._selection[1].start, self._selection[1].stop, 1)
-        """ Row normalized detector signal. """
-        self._signal_row_norm = np.ndarray(shape=(len(self.index_row),self.image_area[1]), dtype=float)
-        """ Smoothed signal after removal of high-frequency features. """
-        self._signal_smooth = np.ndarray(shape=self._signal_row_norm.shape, dtype=float)
-        """ Normalization factor for spectral intensity. """
-        self._f_norm_wavelength = np.ones([self.image_area[1]])
-        """ PRNU map. """
-        self._prnu = np.random.rand(self._signal_row_norm.shape[0],self._signal_row_norm.shape[1])
+        """ Optional `framestore.FrameStore` backing the large arrays. """
+        self._store = None
+        """ Prefix of the names of the arrays in the frame store. """
+        self._store_prefix = 'data'
+
+    ## Attributes created on first access, see `__getattr__`
+    _LAZY = ('_swath', '_signal', 'f_norm_row', 'f_norm_col', 'index_row',
+             'index_col', '_signal_row_norm', '_signal_smooth',
+             '_f_norm_wavelength', '_prnu')
+
+    ## Attributes depending on the image area selection
+    _SELECTION_DEPENDENT = ('f_norm_row', 'f_norm_col', 'index_row', 'index_col',
+                            '_signal_row_norm', '_signal_smooth', '_prnu')
+
+    ##__________________________________________________________________________
+    ##                                                               __getattr__
+
+    def __getattr__ (self, name):
+        """ Create the attributes listed in `_LAZY` on first access, with shapes
+            derived from the image area and the current selection:
+
+            _swath             Swath angle dependent signal variation; a
+                               read-only broadcast view of the column profile.
+            _signal            Detector signal for full CCD.
+            f_norm_row         Row normalization factor. Must be floating point
+                               to yield non-zero values later on.
+            f_norm_col         Column normalization factor. Must be floating
+                               point to yield non-zero values later on.
+            index_row          Row number index for selection.
+            index_col          Column number index for selection.
+            _signal_row_norm   Row normalized detector signal.
+            _signal_smooth     Smoothed signal after removal of high-frequency
+                               features.
+            _f_norm_wavelength Normalization factor for spectral intensity.
+            _prnu              PRNU map.
+
+            The buffers of the row normalized and smoothed signal and of the
+            PRNU map are taken from the workspace pool or, if a frame store is
+            attached, created in the store directly.
+        """
+        if name not in Data._LAZY:
+            raise AttributeError(name)
+        if name == '_swath':
+            value = self.swath_profile.map(self.image_area)
+        elif name == '_signal':
+            value = np.random.rand(self.image_area[0], self.image_area[1])
+        elif name == 'index_row':
+            value = np.arange(*self._selection[0].indices(self.image_area[0]))
+        elif name == 'index_col':
+            value = np.arange(*self._selection[1].indices(self.image_area[1]))
+        elif name == 'f_norm_row':
+            value = np.zeros(len(self.index_row), 'float32')
+        elif name == 'f_norm_col':
+            value = np.zeros(len(self.index_col), 'float32')
+        elif name == '_f_norm_wavelength':
+            value = np.ones([self.image_area[1]])
+        elif self._store is not None:
+            value = self._store.create(self._store_prefix + name,
+                                       (len(self.index_row), self.image_area[1]))
+        else:
+            value = self._workspace.acquire((len(self.index_row), self.image_area[1]))
+        setattr(self, name, value)
+        return value
+
+    ##__________________________________________________________________________
+    ##                                                                   release
+
+    def release (self, names=None):
+        """ Drop intermediate arrays, returning their buffers to the workspace
+            pool; they are created again on next access. The released arrays
+            must not be used any longer by the caller.
+
+            :param names: Attributes to release; defaults to all attributes
+                          depending on the selection.
+        """
+        if names is None:
+            names = Data._SELECTION_DEPENDENT
+        for name in names:
+            self._workspace.release(self.__dict__.pop(name, None))
 
     ##__________________________________________________________________________
     ##                                                              setSelection
 
     def setSelection (self, selection):
-        """ Set image area selection.
+        """ Set image area selection; the arrays depending on the selection are
+            released and created again with matching shapes on next access.
         """
         if len(selection)==2:
-            self._selection = selection
-            self.f_norm_row = np.zeros(self._selection[0].stop-self._selection[0].start, 'float32')
-            self.f_norm_col = np.zeros(self._selection[1].stop-self._selection[1].start, 'float32')
-            self.index_row  = np.arange(self._selection[0].start, self._selection[0].stop, 1)
-            self.index_col  = np.arange(self._selection[1].start, self._selection[1].stop, 1)
+            self._selection = list(selection)
+            self.release()
+            if len(self.signal_masked):
+                self.signal_selection_masked = self.signal_masked[self._selection]
+
+    ##__________________________________________________________________________
+    ##                                                               attachStore
+
+    def attachStore (self, store, prefix='data'):
+        """ Move the raw frame and the large intermediate arrays into memory-
+            mapped files of a frame store; slices of these arrays (such as the
+            image area selection and the masked views) are zero-copy views of
+            the on-disk data.
+
+            :param store: `framestore.FrameStore` to hold the arrays.
+            :param prefix: Prefix of the array names within the store, to
+                           allow several objects to share one store.
+        """
+        self._store        = store
+        self._store_prefix = prefix
+        for name in ['_signal', '_signal_row_norm', '_signal_smooth', '_prnu']:
+            if name in self.__dict__:
+                self.keep(name)
+        if len(self._pixel_quality):
+            self.maskSignal()
+
+    ##__________________________________________________________________________
+    ##                                                                      keep
+
+    def keep (self, name):
+        """ Move the array held by attribute `name` into the frame store (if
+            one is attached) and return it; arrays created in the store are
+            kept as they are.
+        """
+        array = getattr(self, name)
+        if self._store is not None and not isinstance(array, np.memmap):
+            array = self._store.store(self._store_prefix + name, np.atleast_1d(array))
+            setattr(self, name, array)
+        return array
+
+    ##__________________________________________________________________________
+    ##                                                                maskSignal
+
+    def maskSignal (self):
+        """ Create the masked views of the signal array and its selection. The
+            data of the masked arrays are not copied.
+        """
+        self.signal_masked = np.ma.masked_array(self._signal,
+                                                mask=self._pixel_quality,
+                                                copy=False)
+        self.signal_selection_masked = self.signal_masked[self._selection]
 
     ##__________________________________________________________________________
     ##                                                                  swathMap
 
-    def swathMap (self):
-        """ Generate map of swath dependent signal variation. """
-        for col in np.arange(self.image_area[1]):
-            self._swath[:,col] = Sin(col, a1=20, a2=2.0/self.image_area[1])
-        return self._swath
+    def swathMap (self, materialize=False):
+        """ Map of swath dependent signal variation, by default a read-only
+            broadcast view of the column profile.
+
+            :param materialize: Return a writable copy of the full map.
+        """
+        return self._swath.copy() if materialize else self._swath
 
     ##__________________________________________________________________________
     ##                                                    spectralCalibrationMap
 
     def spectralCalibrationMap (self):
         """ Generate some type of spectral calibration map to provide a mapping
-            from (row,col) to (row,wavelength).
+            from (row,col) to (row,wavelength). The map is shared between all
+            objects with the same image area and is read-only.
         """
-        self._scm = np.ndarray(shape=(self.image_area[0], self.image_area[1]))
-        for row in range(self.image_area[0]):
-            rowValue = 0.5*self.image_area[0]-row
-            for col in range(self.image_area[1]):
-                self._scm[row,col] = Circle(rowValue,2*col, y0=0.5*col, a0=10)
+        self._scm = scm.get_scm(self.image_area, cache_dir=self.scm_cache_dir)
         return self._scm
 
     ##__________________________________________________________________________
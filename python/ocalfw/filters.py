@@ -1,8 +1,63 @@
 import numpy as np
+import scipy.ndimage as ndimage
+import scipy.signal as signal
+from scipy.signal import windows
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
+from cache import LRUCache, readonly_array
 
-""" Collection of filter windows. """
+""" Collection of filter windows, and routines to apply them to 2D data. """
+
+## Kernel size (number of weights) above which non-separable kernels are
+## applied by means of FFT convolution
+FFT_THRESHOLD_2D = 11*11
+## Kernel size (along the longer axis) above which separable kernels are
+## applied by means of FFT convolution
+FFT_THRESHOLD_SEPARABLE = 95
+
+## =============================================================================
+##
+##  Window cache
+##
+## =============================================================================
+
+## Cache of generated filter windows; entries are read-only and shared
+_window_cache = LRUCache(maxsize=32)
+
+##______________________________________________________________________________
+##                                                                _cached_window
+
+def _cached_window(key,
+                   build):
+    """ Return the window stored for `key`, calling `build` to generate it if
+        it is not available from the cache yet.
+    """
+    weights = _window_cache.get(key)
+    if weights is None:
+        weights = readonly_array(build())
+        _window_cache.put(key, weights)
+    return weights
+
+##______________________________________________________________________________
+##                                                                 _outer_window
+
+def _outer_window(window_row,
+                  window_col,
+                  normalize,
+                  dtype):
+    """ 2D window as outer product of the 1D windows along rows and columns.
+    """
+    weights = np.outer(window_row, window_col)
+    if (normalize):
+        weights /= np.sum(weights)
+    return weights.astype(dtype, copy=False)
+
+##______________________________________________________________________________
+##                                                            clear_window_cache
+
+def clear_window_cache():
+    """ Drop all filter windows from the cache. """
+    _window_cache.clear()
 
 ## =============================================================================
 ##
@@ -10,16 +65,24 @@ import matplotlib.pyplot as plt
 ##
 ## =============================================================================
 
-def moving_average_2d(shape):
+def moving_average_2d(shape,
+                      dtype=float):
+    """ Calculate weights for 2D moving average filter window.
+
+        :param shape: Shape of the 2D window.
+        :type shape: Integer array, size=2
+        :param dtype: Data type of the weights.
+    """
     ## Check input parameter
     if (len(shape)<2):
         print ("ERROR - moving_average_2d needs shape consiting of 2 axes!")
         return []
 
-    # Initialize arrays
-    w = np.ones(shape=shape)/np.prod(shape)
-    return w
-
+    key = ('moving_average', tuple(shape), np.dtype(dtype).str)
+    return _cached_window(key, lambda: _outer_window(np.ones(shape[0]),
+                                                     np.ones(shape[1]),
+                                                     True,
+                                                     dtype))
 
 ## =============================================================================
 ##
@@ -28,7 +91,8 @@ def moving_average_2d(shape):
 ## =============================================================================
 
 def hanning_window_2d(shape,
-                      normalize=True):
+                      normalize=True,
+                      dtype=float):
     """ Calculate weights for (normalized) 2D Hanning filter window.
 
         :param shape: Shape of the 2D Hanning window.
@@ -38,28 +102,259 @@ def hanning_window_2d(shape,
                           values, which does not hold the condition that the
                           sum of all entries equals 1.
         :type normalize: Bool
+        :param dtype: Data type of the weights.
     """
     # Check input parameter
     if (len(shape)<2):
         print ("ERROR - hanning_window_2d needs shape consiting of 2 axes!")
         return []
 
-    # Initialize arrays
-    hanning_row = np.hanning(shape[0])
-    hanning_col = np.hanning(shape[1])
-    hanning2d   = np.ndarray(shape=shape)
+    key = ('hanning', tuple(shape), bool(normalize), np.dtype(dtype).str)
+    return _cached_window(key, lambda: _outer_window(np.hanning(shape[0]),
+                                                     np.hanning(shape[1]),
+                                                     normalize,
+                                                     dtype))
+
+## =============================================================================
+##
+##  2D Gaussian filter
+##
+## =============================================================================
+
+def gaussian_window_2d(shape,
+                       std,
+                       normalize=True,
+                       dtype=float):
+    """ Calculate weights for (normalized) 2D Gaussian filter window.
 
-    for nrow in range(shape[0]):
-        hanning2d[nrow, :] = hanning_col
+        :param shape: Shape of the 2D Gaussian window.
+        :type shape: Integer array, size=2
+        :param std: Standard deviation of the Gaussian, either a single value
+                    or one value per axis (in pixels).
+        :param normalize: Normalize the weights, such that their sum is 1?
+        :type normalize: Bool
+        :param dtype: Data type of the weights.
+    """
+    # Check input parameter
+    if (len(shape)<2):
+        print ("ERROR - gaussian_window_2d needs shape consiting of 2 axes!")
+        return []
 
-    for ncol in range(shape[1]):
-        hanning2d[:, ncol] = hanning2d[:, ncol]*hanning_row
+    std = tuple(np.broadcast_to(np.asarray(std, dtype=float), (2,)))
+    key = ('gaussian', tuple(shape), std, bool(normalize), np.dtype(dtype).str)
+    return _cached_window(key, lambda: _outer_window(windows.gaussian(shape[0], std[0]),
+                                                     windows.gaussian(shape[1], std[1]),
+                                                     normalize,
+                                                     dtype))
 
-    if (normalize):
-        hanning2d_norm = hanning2d/np.sum(hanning2d)
-        return hanning2d_norm
-    else:
-        return hanning2d
+## =============================================================================
+##
+##  2D Tukey filter
+##
+## =============================================================================
+
+def tukey_window_2d(shape,
+                    alpha=0.5,
+                    normalize=True,
+                    dtype=float):
+    """ Calculate weights for (normalized) 2D Tukey (tapered cosine) window.
+
+        :param shape: Shape of the 2D Tukey window.
+        :type shape: Integer array, size=2
+        :param alpha: Fraction of the window inside the cosine tapered region;
+                      0 yields a rectangular, 1 a Hann window.
+        :param normalize: Normalize the weights, such that their sum is 1?
+        :type normalize: Bool
+        :param dtype: Data type of the weights.
+    """
+    # Check input parameter
+    if (len(shape)<2):
+        print ("ERROR - tukey_window_2d needs shape consiting of 2 axes!")
+        return []
+
+    key = ('tukey', tuple(shape), float(alpha), bool(normalize), np.dtype(dtype).str)
+    return _cached_window(key, lambda: _outer_window(windows.tukey(shape[0], alpha),
+                                                     windows.tukey(shape[1], alpha),
+                                                     normalize,
+                                                     dtype))
+
+## =============================================================================
+##
+##  Filter application
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                separate_kernel
+
+def separate_kernel(weights,
+                    rtol=1e-10):
+    """ Decompose 2D filter weights into the outer product of two 1D kernels.
+
+        :param weights: 2D array with the filter weights.
+        :param rtol: Relative tolerance for the reconstruction of the weights.
+        :return: Tuple (kernel_row, kernel_col) such that weights is equal to
+                 np.outer(kernel_row, kernel_col), or `None` if the weights are
+                 not separable.
+    """
+    weights = np.asarray(weights, dtype=float)
+    pivot   = np.unravel_index(np.argmax(np.abs(weights)), weights.shape)
+    if weights[pivot] == 0:
+        return None
+    kernel_row = weights[:, pivot[1]]
+    kernel_col = weights[pivot[0], :]/weights[pivot]
+    if np.allclose(np.outer(kernel_row, kernel_col), weights,
+                   rtol=rtol, atol=rtol*abs(weights[pivot])):
+        return kernel_row, kernel_col
+    return None
+
+##______________________________________________________________________________
+##                                                                 _origin
+
+def _origin(size):
+    """ Origin to pass to scipy.ndimage for a kernel of the given size, such
+        that the result is centered in the same way as for FFT convolution.
+    """
+    return -1 if size % 2 == 0 else 0
+
+##______________________________________________________________________________
+##                                                                     _convolve
+
+def _convolve(data,
+              weights,
+              method,
+              kernels=None):
+    """ Convolve data along its last two axes, with zero padding at the
+        borders; result has the same shape as the input data.
+
+        :param method: 'direct', 'separable' or 'fft'.
+        :param kernels: 1D kernels of separable weights.
+    """
+    if method == 'separable':
+        result = ndimage.convolve1d(data, kernels[0], axis=-2, mode='constant',
+                                    origin=_origin(len(kernels[0])))
+        return ndimage.convolve1d(result, kernels[1], axis=-1, mode='constant',
+                                  origin=_origin(len(kernels[1])))
+    # Leading axes (e.g. frames) are not mixed by a kernel of length 1
+    leading = data.ndim - 2
+    weights = weights.reshape((1,)*leading + weights.shape)
+    if method == 'fft':
+        return signal.fftconvolve(data, weights, mode='same')
+    return ndimage.convolve(data, weights, mode='constant',
+                            origin=[0]*leading + [_origin(n) for n in weights.shape[leading:]])
+
+##______________________________________________________________________________
+##                                                                 select_method
+
+def select_method(weights,
+                  kernels=None):
+    """ Select the fastest method to apply a filter with the given weights.
+
+        :param weights: 2D array with the filter weights.
+        :param kernels: Result of `separate_kernel` for the weights.
+    """
+    if kernels is not None:
+        if max(weights.shape) > FFT_THRESHOLD_SEPARABLE:
+            return 'fft'
+        return 'separable'
+    if weights.size > FFT_THRESHOLD_2D:
+        return 'fft'
+    return 'direct'
+
+##______________________________________________________________________________
+##                                                                  apply_filter
+
+def apply_filter(data,
+                 weights,
+                 mask=None,
+                 method='auto',
+                 out=None):
+    """ Apply 2D filter weights to data by means of normalized convolution.
+
+        Masked pixels and pixels with non-finite values do not contribute to
+        the result; the filter response is renormalized by the sum of the
+        weights covering valid pixels, which also corrects for the missing
+        data beyond the borders of the array. Pixels without any valid data
+        within the filter window are set to NaN.
+
+        :param data: 2D array with the data to be filtered, or a stack of 2D
+                     arrays with the frame index along the first axis.
+        :param weights: 2D array with the filter weights.
+        :param mask: Optional pixel quality mask, non-zero for bad pixels;
+                     broadcast against the data.
+        :param method: 'direct' (2D convolution), 'separable' (two 1D passes),
+                       'fft' (FFT convolution) or 'auto' to select the method
+                       from the kernel size and separability.
+        :param out: Optional output array of the shape of the data, e.g. a
+                    memory-mapped array of a frame store.
+    """
+    data    = np.asarray(data, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    if weights.ndim != 2 or data.ndim < 2:
+        raise ValueError("apply_filter needs 2D (stacks of) data and 2D weights!")
+
+    kernels = None
+    if method in ('auto', 'separable'):
+        kernels = separate_kernel(weights)
+        if kernels is None and method == 'separable':
+            raise ValueError("Filter weights are not separable!")
+    if method == 'auto':
+        method = select_method(weights, kernels)
+    elif method not in ('direct', 'separable', 'fft'):
+        raise ValueError("Unknown filter method '%s'" % method)
+
+    valid = np.isfinite(data)
+    if mask is not None:
+        valid &= ~np.asarray(mask, dtype=bool)
+    values = np.where(valid, data, 0.0)
+
+    numerator   = _convolve(values, weights, method, kernels)
+    denominator = _convolve(valid.astype(float), weights, method, kernels)
+    # FFT round-off leaves tiny non-zero values where no valid pixels contribute
+    empty = np.abs(denominator) <= 1e-12*np.abs(weights).sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.divide(numerator, denominator, out=out)
+    result[empty] = np.nan
+    return result
+
+##______________________________________________________________________________
+##                                                           benchmark_filtering
+
+def benchmark_filtering(shape=(400, 600),
+                        sizes=(3, 7, 15, 31, 63, 127, 255),
+                        nofRuns=3):
+    """ Time the application of Hanning windows of increasing size, with each of
+        the available methods.
+
+        :param shape: Shape of the filtered data.
+        :param sizes: Kernel sizes along each axis.
+        :param nofRuns: Number of runs per measurement; the best is reported.
+        :return: List of (size, method, time) tuples.
+    """
+    import time
+    data    = np.random.rand(shape[0], shape[1])
+    mask    = data < 0.05
+    results = []
+    print ("%8s %12s %12s %12s %12s" % ("size", "direct", "separable", "fft", "auto"))
+    for size in sizes:
+        weights = hanning_window_2d((size, size))
+        times   = {}
+        for method in ('direct', 'separable', 'fft', 'auto'):
+            ## Direct 2D convolution is prohibitively slow for large kernels
+            if method == 'direct' and size > 31:
+                continue
+            best = None
+            for n in range(nofRuns):
+                start = time.time()
+                apply_filter(data, weights, mask=mask, method=method)
+                elapsed = time.time()-start
+                best = elapsed if best is None else min(best, elapsed)
+            times[method] = best
+            results.append((size, method, best))
+        print ("%8d %12s %12s %12s %12s" % tuple(
+            [size] + ["%.4f" % times[m] if m in times else "-"
+                      for m in ('direct', 'separable', 'fft', 'auto')]))
+    return results
 
 ##  Testing
 
@@ -68,6 +363,8 @@ if __name__ == '__main__':
     shape = (256, 256)
     hanning2d      = hanning_window_2d(shape)
     moving_average = moving_average_2d(shape)
+    gaussian2d     = gaussian_window_2d(shape, std=32)
+    tukey2d        = tukey_window_2d(shape)
 
     ## Create new PDF document
     pdf_pages = PdfPages('plots_filters.pdf')
@@ -84,6 +381,22 @@ if __name__ == '__main__':
     pdf_pages.savefig(fig)
     plt.close()
 
+    fig = plt.figure ()
+    plt.imshow(gaussian2d)
+    plt.title("2D Gaussian window")
+    pdf_pages.savefig(fig)
+    plt.close()
+
+    fig = plt.figure ()
+    plt.imshow(tukey2d)
+    plt.title("2D Tukey window")
+    pdf_pages.savefig(fig)
+    plt.close()
+
     # Write the PDF document to the disk
     pdf_pages.close()
 
+    ## Benchmark application of the filter windows
+    print ("\n[Benchmark filter application]\n")
+    benchmark_filtering()
+
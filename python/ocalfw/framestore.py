@@ -0,0 +1,273 @@
+""" Memory-mapped store for detector frames and large intermediate products.
+
+    Arrays are kept in NumPy `.npy` files within a directory and accessed via
+    `np.memmap`, so that slices (e.g. the image area selection or a block of
+    frames) are zero-copy views of the on-disk data and only the pages which
+    are actually touched are held in memory. This allows calibration stacks
+    larger than the available RAM to be processed block by block.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from batch import BatchPRNU
+
+## =============================================================================
+##
+##  Class definition
+##
+## =============================================================================
+
+class FrameStore (object):
+    """ Directory of memory-mapped arrays.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self, directory):
+        """ Initialize object's internal data.
+
+            :param directory: Directory holding the array files; it is created
+                              if it does not exist yet.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        """ Directory holding the array files. """
+        self.directory = directory
+
+    ##__________________________________________________________________________
+    ##                                                                 _filename
+
+    def _filename(self, name):
+        return os.path.join(self.directory, name + '.npy')
+
+    def __contains__(self, name):
+        return os.path.isfile(self._filename(name))
+
+    ##__________________________________________________________________________
+    ##                                                                     names
+
+    def names(self):
+        """ Names of the arrays in the store. """
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(self.directory)
+                      if f.endswith('.npy'))
+
+    ##__________________________________________________________________________
+    ##                                                                    create
+
+    def create(self,
+               name,
+               shape,
+               dtype=float):
+        """ Create a new (uninitialized) memory-mapped array. An existing
+            array of the same name is replaced by a new file, rather than
+            truncated, so that mappings of it which are still held (e.g. the
+            array being stored anew) keep their data.
+
+            :param name: Name of the array within the store.
+            :param shape: Shape of the array.
+            :param dtype: Data type of the array.
+        """
+        handle, filename = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(handle)
+        try:
+            mapped = open_memmap(filename, mode='w+', shape=tuple(shape), dtype=dtype)
+            os.rename(filename, self._filename(name))
+        except Exception:
+            os.remove(filename)
+            raise
+        return mapped
+
+    ##__________________________________________________________________________
+    ##                                                                      open
+
+    def open(self,
+             name,
+             mode='r'):
+        """ Map an existing array.
+
+            :param name: Name of the array within the store.
+            :param mode: 'r' (read-only), 'r+' (read/write) or 'c' (copy on
+                         write, changes are not written back).
+        """
+        return np.load(self._filename(name), mmap_mode=mode)
+
+    ##__________________________________________________________________________
+    ##                                                                     store
+
+    def store(self,
+              name,
+              array,
+              nofFrames=16):
+        """ Copy an array into the store, one block along the first axis at a
+            time, and return the memory-mapped copy.
+        """
+        mapped = self.create(name, array.shape, array.dtype)
+        for first in range(0, array.shape[0], nofFrames):
+            mapped[first:first+nofFrames] = array[first:first+nofFrames]
+        mapped.flush()
+        return mapped
+
+    ##__________________________________________________________________________
+    ##                                                               import_hdf5
+
+    def import_hdf5(self,
+                    reader,
+                    name='signal',
+                    quality='pixel_quality',
+                    nofFrames=16):
+        """ Copy the frames (and pixel quality mask) delivered by an
+            `h5io.FrameReader` into the store, one block of frames at a time.
+
+            :return: Tuple with the memory-mapped frames and pixel quality
+                     mask (`None` if the file provides no mask).
+        """
+        frames = self.create(name, (len(reader),) + tuple(reader.image_area),
+                             reader._signal.dtype)
+        pixel_quality = None
+        first = 0
+        for signal, mask in reader.blocks(nofFrames):
+            frames[first:first+len(signal)] = signal
+            if mask is not None and mask.ndim == 3:
+                if pixel_quality is None:
+                    pixel_quality = self.create(quality, frames.shape, bool)
+                pixel_quality[first:first+len(signal)] = mask
+            first += len(signal)
+        if pixel_quality is None and reader._pixel_quality is not None:
+            pixel_quality = self.create(quality, reader.image_area, bool)
+            pixel_quality[...] = reader.read_quality()
+        frames.flush()
+        return frames, pixel_quality
+
+## =============================================================================
+##
+##  Processing of stored frames
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                 process_store
+
+def process_store(store,
+                  selection,
+                  name='signal',
+                  quality='pixel_quality',
+                  output='prnu',
+                  nofFrames=16,
+                  **options):
+    """ Run the PRNU algorithm over all frames held by a store, one block of
+        frames at a time, writing the PRNU maps to a memory-mapped output array.
+
+        :param store: `FrameStore` holding the frames.
+        :param selection: Slices (rows, columns) of the selected image area.
+        :param name: Name of the array with the frames.
+        :param quality: Name of the array with the pixel quality mask; if it is
+                        not in the store, the default mask of `BatchPRNU` is
+                        used.
+        :param output: Name of the output array for the PRNU maps.
+        :param nofFrames: Number of frames per block.
+        :param options: Further keyword arguments passed on to `BatchPRNU`.
+        :return: Tuple with the memory-mapped PRNU maps and a dictionary with
+                 the per-frame statistics of all frames.
+    """
+    frames = store.open(name)
+    nofTotal, image_area = frames.shape[0], frames.shape[1:]
+    del frames
+    nofRows = len(range(*selection[0].indices(image_area[0])))
+    rows    = slice(0, selection[0].indices(image_area[0])[1])
+
+    store.create(output, (nofTotal, nofRows, image_area[1]))
+    statistics = {}
+    for first in range(0, nofTotal, nofFrames):
+        block = slice(first, first+nofFrames)
+        # The arrays are mapped per block, such that the pages of processed
+        # blocks are released and the resident memory stays bounded
+        frames = store.open(name)
+        prnu   = store.open(output, mode='r+')
+        mask   = None
+        if quality in store:
+            pixel_quality = store.open(quality)
+            if pixel_quality.ndim == 3:
+                mask = pixel_quality[block, rows]
+            else:
+                mask = pixel_quality[rows]
+        # Zero-copy views of the rows used by the PRNU steps
+        batch = BatchPRNU(frames[block, rows],
+                          pixel_quality=mask,
+                          selection=selection,
+                          image_area=image_area,
+                          **options)
+        prnu[block], block_statistics = batch.calc_prnu()
+        prnu.flush()
+        for key, value in block_statistics.items():
+            statistics.setdefault(key, []).append(value)
+        del frames, prnu, mask, batch
+    return store.open(output), dict((key, np.concatenate(value))
+                                    for key, value in statistics.items())
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import resource
+    import shutil
+    import sys
+    import tempfile
+    import time
+
+    directory = tempfile.mkdtemp()
+    store     = FrameStore(directory)
+    selection = [slice(100, 500), slice(200, 500)]
+    devnull   = open(os.devnull, 'w')
+
+    ## Single frame PRNU with memory-mapped signal and intermediates
+    from prnu import PRNU
+    signal = 1.0 + np.random.rand(1024, 600)
+    stdout, sys.stdout = sys.stdout, devnull
+    reference = PRNU(signal=signal)
+    reference.calc_prnu()
+    mapped = PRNU(signal=signal, store=FrameStore(os.path.join(directory, 'data')))
+    mapped.calc_prnu()
+    sys.stdout = stdout
+    data = mapped._data
+    print ("\n[PRNU with memory-mapped Data arrays]\n")
+    for name in ['_signal', '_signal_row_norm', '_signal_smooth', '_prnu']:
+        print ("-- %-16s memory-mapped = %s" % (name, isinstance(getattr(data, name), np.memmap)))
+        assert isinstance(getattr(data, name), np.memmap)
+    ## Intermediates are created in the store, rather than copied into it
+    assert not data._workspace.allocated
+    print ("-- Zero-copy selection ...... = %s"
+           % np.may_share_memory(data.signal_selection_masked.data, data._signal))
+    np.testing.assert_array_equal(data._prnu, reference._data._prnu)
+    del reference, mapped, data
+
+    ## Storing an array anew leaves mappings of the previous file intact
+    first  = store.store('array', signal)
+    second = store.store('array', first*2.0)
+    np.testing.assert_array_equal(first, signal)
+    np.testing.assert_array_equal(store.store('array', second), 2.0*signal)
+    assert store.names() == ['array']
+    del first, second
+
+    print ("\n[PRNU over memory-mapped frame store]\n")
+    print ("%8s %12s %10s %14s" % ("frames", "stack [MB]", "time [s]", "max. RSS [MB]"))
+    for nofFrames in [16, 64, 128]:
+        store.create('signal', (nofFrames, 1024, 600))
+        for n in range(nofFrames):
+            frames = store.open('signal', mode='r+')
+            frames[n] = 1.0 + np.random.rand(1024, 600)
+            del frames
+        stdout, sys.stdout = sys.stdout, devnull
+        start = time.time()
+        prnu, statistics = process_store(store, selection, nofFrames=8)
+        elapsed = time.time()-start
+        sys.stdout = stdout
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+        print ("%8d %12.1f %10.3f %14.1f"
+               % (nofFrames, nofFrames*1024*600*8/1048576.0, elapsed, maxrss))
+        del prnu
+    shutil.rmtree(directory)
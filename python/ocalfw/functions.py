@@ -1,12 +1,254 @@
+""" Analytic model functions used to generate synthetic detector data.
+
+    The functions are evaluated in place into a single output array, which is
+    either passed by the caller (`out`) or allocated once, instead of creating
+    a full-size temporary for every subexpression. The coordinates may be any
+    arrays broadcasting against each other, e.g. from `np.ogrid`, in which case
+    the output is the only full-size array. The output has the floating point
+    type of the inputs (float32 inputs yield float32 results) unless `dtype` or
+    `out` specify otherwise. If `numexpr` is available, large arrays are
+    evaluated by it in a single multi-threaded pass.
+"""
+
 import numpy as np
 
-## Generalized sin() function
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+## Use numexpr (if available) for arrays of at least `NUMEXPR_MIN_SIZE` entries
+use_numexpr = numexpr is not None
+NUMEXPR_MIN_SIZE = 16384
+
+## =============================================================================
+##
+##  Helper functions
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                       _output
+
+def _output(out,
+            dtype,
+            *arrays):
+    """ Output array for the broadcast shape of the inputs; a given output
+        array may be larger, as long as the inputs broadcast against it.
+    """
+    if out is None:
+        if dtype is None:
+            dtype = np.result_type(*(arrays + (1.0,)))
+        return np.empty(np.broadcast(*arrays).shape, dtype=dtype)
+    if np.broadcast(out, *arrays).shape != out.shape:
+        raise ValueError("Inputs do not broadcast to output shape %s!" % (out.shape,))
+    return out
+
+##______________________________________________________________________________
+##                                                                     _numexpr
+
+def _numexpr(expression,
+             out,
+             arrays,
+             parameters):
+    """ Evaluate an expression with numexpr if it is enabled and worthwhile.
+
+        :return: `True` if the expression has been evaluated into `out`.
+    """
+    if not use_numexpr or out.size < NUMEXPR_MIN_SIZE or \
+       np.broadcast(*arrays.values()).shape != out.shape:
+        return False
+    # Parameters of the output type, so that float32 is not promoted
+    names = dict((name, out.dtype.type(value)) for name, value in parameters.items())
+    names.update(arrays)
+    numexpr.evaluate(expression, local_dict=names, out=out, casting='same_kind')
+    return True
+
+##______________________________________________________________________________
+##                                                                       _result
+
+def _result(out, given):
+    """ Return scalars for scalar input, unless an output array was given. """
+    return out[()] if out.ndim == 0 and given is None else out
+
+## =============================================================================
+##
+##  Model functions
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                           Sin
 
 def Sin (x,
          a0=0.0,
          a1=1.0,
          a2=1.0,
-         a3=0.0):
-    """ Generalized sin function, including offsets and scale factors.
+         a3=0.0,
+         out=None,
+         dtype=None):
+    """ Generalized sin function, including offsets and scale factors:
+        a0 + a1*sin(a2*x + a3).
+
+        :param out: Optional output array of a shape `x` broadcasts to.
+        :param dtype: Floating point type of the result, if `out` is not given.
     """
-    return a0+a1*np.sin(a2*x+a3)
+    result = _output(out, dtype, x)
+    if not _numexpr('a0+a1*sin(a2*x+a3)', result, {'x' : x},
+                    {'a0' : a0, 'a1' : a1, 'a2' : a2, 'a3' : a3}):
+        np.multiply(a2, x, out=result)
+        result += a3
+        np.sin(result, out=result)
+        result *= a1
+        result += a0
+    return _result(result, out)
+
+##______________________________________________________________________________
+##                                                                        Circle
+
+def Circle (x,
+            y,
+            x0=0.0,
+            y0=0.0,
+            a0=1.0,
+            a1=1.0,
+            a2=1.0,
+            out=None,
+            dtype=None):
+    """ General definition of circle, or rather an ellipse:
+        a0*sqrt(a1*(x-x0)**2 + a2*(y-y0)**2).
+
+        :param x:  x-axis coordinate value.
+        :param y:  y-axis coordinate value.
+        :param x0: x-axis coordinate of the circle's center position.
+        :param y0: y-axis coordinate of the circle's center position.
+        :param out: Optional output array of a shape the inputs broadcast to.
+        :param dtype: Floating point type of the result, if `out` is not given.
+    """
+    result = _output(out, dtype, x, y, x0, y0)
+    if not _numexpr('a0*sqrt(a1*(x-x0)**2+a2*(y-y0)**2)', result,
+                    {'x' : x, 'y' : y, 'x0' : x0, 'y0' : y0},
+                    {'a0' : a0, 'a1' : a1, 'a2' : a2}):
+        np.subtract(x, x0, out=result)
+        np.square(result, out=result)
+        result *= a1
+        # Temporary of the broadcast shape of (y, y0) only
+        term = np.subtract(y, y0, dtype=result.dtype)
+        np.square(term, out=term)
+        term *= a2
+        result += term
+        np.sqrt(result, out=result)
+        result *= a0
+    return _result(result, out)
+
+##______________________________________________________________________________
+##                                                                    Gaussian2D
+
+def Gaussian2D(x,
+               y,
+               x0=0.0,
+               x1=1.0,
+               y0=0.0,
+               y1=1.0,
+               a0=2.0,
+               a1=1.0,
+               out=None,
+               dtype=None):
+    """ 2D Gaussian function:
+        a0*exp(-(x-x0)**2/(2*x1)**2 - (y-y0)**2/(2*y1)**2) + a1.
+
+        :param x: x-axis positions of the points where the function is computed.
+        :param y: y-axis positions of the points where the function is computed.
+        :param x0: Offset along the x-axis.
+        :param y0: Offset along the y-axis.
+        :param out: Optional output array of a shape the inputs broadcast to.
+        :param dtype: Floating point type of the result, if `out` is not given.
+    """
+    result = _output(out, dtype, x, y, x0, y0)
+    if not _numexpr('a0*exp(-(x-x0)**2/(2*x1)**2-(y-y0)**2/(2*y1)**2)+a1', result,
+                    {'x' : x, 'y' : y, 'x0' : x0, 'y0' : y0},
+                    {'x1' : x1, 'y1' : y1, 'a0' : a0, 'a1' : a1}):
+        np.subtract(x, x0, out=result)
+        np.square(result, out=result)
+        np.negative(result, out=result)
+        result /= (2*x1)**2
+        # Temporary of the broadcast shape of (y, y0) only
+        term = np.subtract(y, y0, dtype=result.dtype)
+        np.square(term, out=term)
+        term /= (2*y1)**2
+        result -= term
+        np.exp(result, out=result)
+        result *= a0
+        result += a1
+    return _result(result, out)
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import multiprocessing
+    import resource
+    import sys
+    import time
+
+    shape = (4096, 2048)
+
+    ## Previous implementations, with a temporary per subexpression
+    reference = {
+        'Sin'        : lambda x, y: 0.0+20.0*np.sin(0.01*x+0.5),
+        'Circle'     : lambda x, y: 10.0*np.sqrt(1.0*(x-2048.0)**2 + 2.25*(y-512.0)**2),
+        'Gaussian2D' : lambda x, y: 2.0*np.exp(-(x-2048.0)**2/(2*300.0)**2
+                                               -(y-1024.0)**2/(2*200.0)**2)+1.0}
+    library = {
+        'Sin'        : lambda x, y, out: Sin(x, a1=20.0, a2=0.01, a3=0.5, out=out),
+        'Circle'     : lambda x, y, out: Circle(x, y, x0=2048.0, y0=512.0, a0=10.0,
+                                                a2=2.25, out=out),
+        'Gaussian2D' : lambda x, y, out: Gaussian2D(x, y, x0=2048.0, x1=300.0, y0=1024.0,
+                                                    y1=200.0, out=out)}
+
+    def run(name, implementation, dtype, queue):
+        """ Evaluate a function on the grid, reporting time and memory. """
+        x, y = np.indices(shape, dtype=dtype)
+        out  = np.empty(shape, dtype=dtype)
+        out.fill(0)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start  = time.time()
+        if implementation == 'reference':
+            result = reference[name](x, y)
+        elif implementation == 'grid':
+            result = library[name](x, y, out)
+        else:
+            result = library[name](x[:, :1], y[:1, :], out)
+        elapsed = time.time()-start
+        queue.put((elapsed,
+                   (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-maxrss)/1024.0,
+                   result.dtype.name))
+
+    ## Same results as the previous implementations
+    x, y = np.indices((256, 128), dtype=float)
+    for name in reference:
+        np.testing.assert_allclose(library[name](x, y, None), reference[name](x, y),
+                                   rtol=1e-12)
+        np.testing.assert_allclose(library[name](x[:, :1], y[:1, :], np.empty(x.shape)),
+                                   reference[name](x, y), rtol=1e-12)
+        result = library[name](x.astype(np.float32), y.astype(np.float32), None)
+        assert result.dtype == np.float32
+        np.testing.assert_allclose(result, reference[name](x, y), rtol=1e-5, atol=1e-5)
+
+    print ("\n[Evaluation on a %d x %d grid, numexpr %s]\n"
+           % (shape + ("enabled" if use_numexpr else "not available",)))
+    print ("%-12s %-8s %-22s %10s %16s" % ("function", "dtype", "implementation",
+                                           "time [s]", "extra RSS [MB]"))
+    for name in ['Sin', 'Circle', 'Gaussian2D']:
+        for dtype in ['float64', 'float32']:
+            for implementation, label in [('reference', 'temporaries'),
+                                          ('grid', 'in place, full grid'),
+                                          ('ogrid', 'in place, open grid')]:
+                queue   = multiprocessing.Queue()
+                process = multiprocessing.Process(target=run,
+                                                  args=(name, implementation, dtype, queue))
+                process.start()
+                elapsed, rss, result_dtype = queue.get()
+                process.join()
+                print ("%-12s %-8s %-22s %10.4f %16.1f" % (name, result_dtype, label,
+                                                           elapsed, rss))
@@ -0,0 +1,580 @@
+""" HDF5 input/output layer for the calibration pipeline.
+
+    Detector frames are read from a (nofFrames, rows, columns) dataset, the
+    pixel quality mask either from a (rows, columns) dataset shared by all
+    frames or from a per-frame (nofFrames, rows, columns) dataset. Frames are
+    delivered lazily, one frame or one block of frames at a time, and only the
+    requested hyperslab is read from the file, so that memory use does not
+    depend on the number of frames held by the file.
+
+    The PRNU CKD and intermediate products are written per group (e.g. one
+    group per detector band) into extendible, chunked and optionally compressed
+    datasets, appending one frame or block of frames at a time.
+"""
+
+import numpy as np
+import h5py
+
+from batch import BatchPRNU
+
+## Default dataset names
+SIGNAL_DATASET  = 'signal'
+QUALITY_DATASET = 'pixel_quality'
+
+## Per-frame products written by `CKDWriter.write_batch`
+CKD_PRODUCTS = ('prnu', 'signal_smooth', 'signal_row_norm', 'f_norm_row', 'f_norm_col')
+## Target size of a dataset chunk in bytes
+CHUNK_BYTES = 256*1024
+
+## =============================================================================
+##
+##  Class definition
+##
+## =============================================================================
+
+class FrameReader (object):
+    """ Lazy reader for detector frames and pixel quality masks.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self,
+                 filename,
+                 signal=SIGNAL_DATASET,
+                 pixel_quality=QUALITY_DATASET):
+        """ Initialize object's internal data.
+
+            :param filename: Name of the HDF5 file.
+            :param signal: Name of the dataset with the detector frames.
+            :param pixel_quality: Name of the dataset with the pixel quality
+                                  mask; if the dataset does not exist, no mask
+                                  is provided.
+        """
+        """ HDF5 file handle. """
+        self._file = h5py.File(filename, 'r')
+        """ Dataset with the detector frames. """
+        self._signal = self._file[signal]
+        if self._signal.ndim != 3:
+            raise ValueError("Dataset '%s' must have shape (nofFrames, rows, columns)"
+                             % signal)
+        """ Dataset with the pixel quality mask, or `None`. """
+        self._pixel_quality = None
+        if pixel_quality in self._file:
+            self._pixel_quality = self._file[pixel_quality]
+        """ Number of frames in the file. """
+        self.nofFrames = self._signal.shape[0]
+        """ Image area for full CCD. """
+        self.image_area = self._signal.shape[1:]
+
+    ##__________________________________________________________________________
+    ##                                                                     close
+
+    def close(self):
+        """ Close the underlying file. """
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.nofFrames
+
+    def __iter__(self):
+        return self.frames()
+
+    ##__________________________________________________________________________
+    ##                                                                 _hyperslab
+
+    def _hyperslab(self,
+                   frames,
+                   selection):
+        """ Index tuple for a block of frames and an image area selection. """
+        if selection is None:
+            selection = (slice(None), slice(None))
+        return (frames,) + tuple(selection)
+
+    ##__________________________________________________________________________
+    ##                                                              read_quality
+
+    def read_quality(self,
+                     frames=slice(None),
+                     selection=None):
+        """ Read the pixel quality mask.
+
+            :param frames: Frame index or slice; ignored for a shared mask.
+            :param selection: Slices (rows, columns) of the image area to read.
+            :return: Boolean mask, or `None` if the file provides no mask.
+        """
+        if self._pixel_quality is None:
+            return None
+        if selection is None:
+            selection = (slice(None), slice(None))
+        if self._pixel_quality.ndim == 2:
+            index = tuple(selection)
+        else:
+            index = self._hyperslab(frames, selection)
+        return np.asarray(self._pixel_quality[index], dtype=bool)
+
+    ##__________________________________________________________________________
+    ##                                                                    frames
+
+    def frames(self,
+               selection=None,
+               start=0,
+               stop=None):
+        """ Iterate over single frames.
+
+            :param selection: Slices (rows, columns) of the image area to read;
+                              defaults to the full image area.
+            :param start: Index of the first frame.
+            :param stop: Index after the last frame; defaults to all frames.
+            :return: Generator yielding tuples (signal, pixel_quality).
+        """
+        if stop is None:
+            stop = self.nofFrames
+        for n in range(start, stop):
+            yield (self._signal[self._hyperslab(n, selection)],
+                   self.read_quality(n, selection))
+
+    ##__________________________________________________________________________
+    ##                                                                    blocks
+
+    def blocks(self,
+               nofFrames,
+               selection=None,
+               start=0,
+               stop=None):
+        """ Iterate over blocks of consecutive frames.
+
+            :param nofFrames: Maximum number of frames per block.
+            :param selection: Slices (rows, columns) of the image area to read;
+                              defaults to the full image area.
+            :param start: Index of the first frame.
+            :param stop: Index after the last frame; defaults to all frames.
+            :return: Generator yielding tuples (signal, pixel_quality), with a
+                     signal of shape (nofFrames, rows, columns).
+        """
+        if stop is None:
+            stop = self.nofFrames
+        for first in range(start, stop, nofFrames):
+            frames = slice(first, min(first+nofFrames, stop))
+            yield (self._signal[self._hyperslab(frames, selection)],
+                   self.read_quality(frames, selection))
+
+## =============================================================================
+##
+##  CKD output
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                   chunk_shape
+
+def chunk_shape(frame_shape,
+                itemsize,
+                nbytes=CHUNK_BYTES):
+    """ Chunk shape for a per-frame dataset: chunks hold whole rows of a single
+        frame, as many as fit into the target chunk size. Reading a single row
+        then only touches one small chunk, while reading whole frames still
+        involves few chunks.
+
+        :param frame_shape: Shape of a single frame's data.
+        :param itemsize: Size of a data element in bytes.
+        :param nbytes: Target size of a chunk in bytes.
+    """
+    frame_shape = tuple(frame_shape)
+    if len(frame_shape) < 2:
+        return (max(1, nbytes//(itemsize*max(1, int(np.prod(frame_shape))))),) + frame_shape
+    row_bytes = itemsize*int(np.prod(frame_shape[1:]))
+    nofRows   = int(min(frame_shape[0], max(1, nbytes//row_bytes)))
+    return (1, nofRows) + frame_shape[1:]
+
+##______________________________________________________________________________
+##                                                                     CKDWriter
+
+class CKDWriter (object):
+    """ Incremental writer for the PRNU CKD and intermediate products.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self,
+                 filename,
+                 compression='gzip',
+                 compression_opts=None,
+                 dtype=None,
+                 mode='w'):
+        """ Initialize object's internal data.
+
+            :param filename: Name of the HDF5 file.
+            :param compression: Compression filter, 'gzip', 'lzf' or `None`.
+            :param compression_opts: Options of the compression filter, e.g.
+                                     the gzip level (default 4).
+            :param dtype: Type to which floating point data is converted before
+                          writing; the default (`None`) keeps the type of the
+                          data, `np.float32` halves the size of double
+                          precision products at the cost of accuracy.
+            :param mode: File mode, 'w' (create) or 'a' (append).
+        """
+        if compression not in ('gzip', 'lzf', None):
+            raise ValueError("Unknown compression filter '%s'" % compression)
+        if compression == 'gzip' and compression_opts is None:
+            compression_opts = 4
+        """ HDF5 file handle. """
+        self._file = h5py.File(filename, mode)
+        """ Compression filter and its options. """
+        self._compression = compression
+        self._compression_opts = compression_opts
+        """ Type of floating point data in the file. """
+        self._dtype = dtype
+
+    ##__________________________________________________________________________
+    ##                                                                     close
+
+    def close(self):
+        """ Close the underlying file. """
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ##__________________________________________________________________________
+    ##                                                                   _prepare
+
+    def _prepare(self, array):
+        """ Convert an array to the type stored in the file. """
+        array = np.asarray(array)
+        if self._dtype is not None and array.dtype.kind == 'f':
+            array = array.astype(self._dtype, copy=False)
+        return array
+
+    ##__________________________________________________________________________
+    ##                                                           _create_options
+
+    def _create_options(self):
+        """ Keyword arguments for the creation of a dataset. """
+        if self._compression is None:
+            return {}
+        return {'compression'      : self._compression,
+                'compression_opts' : self._compression_opts,
+                'shuffle'          : True}
+
+    ##__________________________________________________________________________
+    ##                                                                    append
+
+    def append(self,
+               group,
+               name,
+               block):
+        """ Append a block of frames to a per-frame dataset, creating the
+            dataset on first use.
+
+            :param group: Name of the group, e.g. the detector band.
+            :param name: Name of the dataset within the group.
+            :param block: Data with the frame index along the first axis.
+        """
+        block = self._prepare(block)
+        path  = group + '/' + name
+        if path not in self._file:
+            frame_shape = block.shape[1:]
+            self._file.create_dataset(path,
+                                      shape=(0,) + frame_shape,
+                                      maxshape=(None,) + frame_shape,
+                                      dtype=block.dtype,
+                                      chunks=chunk_shape(frame_shape, block.dtype.itemsize),
+                                      **self._create_options())
+        dataset = self._file[path]
+        first = dataset.shape[0]
+        dataset.resize(first+block.shape[0], axis=0)
+        dataset[first:] = block
+
+    ##__________________________________________________________________________
+    ##                                                                write_static
+
+    def write_static(self,
+                     group,
+                     name,
+                     array):
+        """ Write data shared by all frames of a group (e.g. the wavelength of
+            the mesh points) unless it has been written before.
+        """
+        path = group + '/' + name
+        if path not in self._file:
+            self._file.create_dataset(path, data=self._prepare(array),
+                                      **self._create_options())
+
+    ##__________________________________________________________________________
+    ##                                                               write_batch
+
+    def write_batch(self,
+                    group,
+                    batch):
+        """ Append the products of a `BatchPRNU` computation to a group. The
+            (row,wavelength) mesh is stored as the wavelength of its points,
+            written once per group, and the per-frame row normalized signal.
+        """
+        products = {'prnu'            : batch._prnu,
+                    'signal_smooth'   : batch._signal_smooth,
+                    'signal_row_norm' : batch._signal_row_norm,
+                    'f_norm_row'      : batch.f_norm_row,
+                    'f_norm_col'      : batch.f_norm_col}
+        for name in CKD_PRODUCTS:
+            self.append(group, name, products[name])
+        self.write_static(group, 'wavelength', batch._wavelength)
+        self.write_static(group, 'index_row', batch.index_row)
+
+    ##__________________________________________________________________________
+    ##                                                                write_data
+
+    def write_data(self,
+                   group,
+                   data):
+        """ Append the products of a single frame `PRNU` computation, held by
+            a `Data` object, to a group.
+        """
+        products = {'prnu'            : data._prnu,
+                    'signal_smooth'   : data._signal_smooth,
+                    'signal_row_norm' : data._signal_row_norm,
+                    'f_norm_row'      : data.f_norm_row,
+                    'f_norm_col'      : data.f_norm_col}
+        for name in CKD_PRODUCTS:
+            self.append(group, name, np.asarray(products[name])[np.newaxis])
+        self.write_static(group, 'wavelength', data._scm[data.index_row])
+        self.write_static(group, 'index_row', data.index_row)
+
+##______________________________________________________________________________
+##                                                                     CKDReader
+
+class CKDReader (object):
+    """ Read-back of the products written by `CKDWriter`.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self, filename):
+        """ Initialize object's internal data.
+
+            :param filename: Name of the HDF5 file.
+        """
+        """ HDF5 file handle. """
+        self._file = h5py.File(filename, 'r')
+
+    ##__________________________________________________________________________
+    ##                                                                     close
+
+    def close(self):
+        """ Close the underlying file. """
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ##__________________________________________________________________________
+    ##                                                                    groups
+
+    def groups(self):
+        """ Names of the groups in the file. """
+        return list(self._file.keys())
+
+    ##__________________________________________________________________________
+    ##                                                                      read
+
+    def read(self,
+             group,
+             name,
+             frames=slice(None),
+             selection=None):
+        """ Read (a hyperslab of) a dataset.
+
+            :param group: Name of the group.
+            :param name: Name of the dataset.
+            :param frames: Frame index or slice; ignored for static datasets.
+            :param selection: Index for the remaining axes, e.g. slices (rows,
+                              columns).
+        """
+        dataset = self._file[group + '/' + name]
+        index = () if selection is None else tuple(selection)
+        if name in CKD_PRODUCTS:
+            index = (frames,) + index
+        if not index:
+            return dataset[...]
+        return dataset[index]
+
+    ##__________________________________________________________________________
+    ##                                                                  read_row
+
+    def read_row(self,
+                 group,
+                 name,
+                 frame,
+                 row):
+        """ Read a single row of a frame of a per-frame 2D product. """
+        return self._file[group + '/' + name][frame, row]
+
+##______________________________________________________________________________
+##                                                               benchmark_ckd
+
+def benchmark_ckd(filename,
+                  nofFrames=16,
+                  shape=(400, 600),
+                  nofReads=500):
+    """ Write PRNU maps with different storage options and measure the file
+        size, the write time and the time for random access to single rows.
+    """
+    import os
+    import time
+    blocks = [1.0 + 0.01*np.random.randn(4, shape[0], shape[1])
+              for n in range(nofFrames//4)]
+    frames = np.random.randint(0, nofFrames, nofReads)
+    rows   = np.random.randint(0, shape[0], nofReads)
+    print ("%-14s %10s %10s %12s %14s"
+           % ("compression", "dtype", "size [MB]", "write [s]", "row read [ms]"))
+    for compression in (None, 'lzf', 'gzip'):
+        for dtype in (None, np.float32):
+            start = time.time()
+            with CKDWriter(filename, compression=compression, dtype=dtype) as writer:
+                for block in blocks:
+                    writer.append('band_1', 'prnu', block)
+            time_write = time.time()-start
+            start = time.time()
+            with CKDReader(filename) as reader:
+                for frame, row in zip(frames, rows):
+                    reader.read_row('band_1', 'prnu', frame, row)
+            time_read = (time.time()-start)/nofReads
+            print ("%-14s %10s %10.2f %12.3f %14.3f"
+                   % (compression, np.dtype(dtype or float).name,
+                      os.path.getsize(filename)/1048576.0, time_write, 1e3*time_read))
+            os.remove(filename)
+
+## =============================================================================
+##
+##  Processing of frames from file
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                  process_file
+
+def process_file(filename,
+                 selection,
+                 nofFrames=16,
+                 writer=None,
+                 group='prnu',
+                 **options):
+    """ Run the PRNU algorithm over all frames of a file, one block at a time.
+
+        The frames are read as rows 0 up to the end of the row selection, over
+        all columns, rather than as the selected area alone: the normalization
+        factors of step 1 are derived from the selected area, but steps 1, 4
+        and 8 process the first `len(rows)` rows of the full CCD width (as the
+        single-frame implementation does, see `normalization.normalize`). The
+        rows read cover both; peak memory is determined by the block size, not
+        by the number of frames in the file.
+
+        :param filename: Name of the HDF5 file.
+        :param selection: Slices (rows, columns) of the selected image area.
+        :param nofFrames: Number of frames per block.
+        :param writer: Optional `CKDWriter` to which the products of each block
+                       are appended.
+        :param group: Name of the output group used with `writer`.
+        :param options: Further keyword arguments passed on to `BatchPRNU`.
+        :return: Generator yielding (prnu, statistics) per block of frames.
+    """
+    with FrameReader(filename) as reader:
+        # Selected area plus the leading rows of the full CCD width
+        rows = (slice(0, selection[0].indices(reader.image_area[0])[1]),
+                slice(None))
+        for signal, pixel_quality in reader.blocks(nofFrames, selection=rows):
+            batch = BatchPRNU(signal,
+                              pixel_quality=pixel_quality,
+                              selection=selection,
+                              image_area=reader.image_area,
+                              **options)
+            result = batch.calc_prnu()
+            if writer is not None:
+                writer.write_batch(group, batch)
+            yield result
+
+##______________________________________________________________________________
+##                                                               write_test_file
+
+def write_test_file(filename,
+                    nofFrames,
+                    image_area=(1024, 600),
+                    per_frame_quality=False):
+    """ Write a file with random detector frames and pixel quality masks, in
+        the layout expected by `FrameReader`; frames are written one at a time
+        and stored in chunks of one frame.
+    """
+    with h5py.File(filename, 'w') as f:
+        signal = f.create_dataset(SIGNAL_DATASET,
+                                  shape=(nofFrames,) + tuple(image_area),
+                                  dtype='f8',
+                                  chunks=(1,) + tuple(image_area))
+        if per_frame_quality:
+            quality = f.create_dataset(QUALITY_DATASET,
+                                       shape=signal.shape,
+                                       dtype='u1',
+                                       chunks=signal.chunks)
+        for n in range(nofFrames):
+            frame = 1.0 + np.random.rand(image_area[0], image_area[1])
+            signal[n] = frame
+            if per_frame_quality:
+                quality[n] = frame < 1.05
+        if not per_frame_quality:
+            f.create_dataset(QUALITY_DATASET,
+                             data=np.zeros(image_area, dtype='u1'))
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import os
+    import resource
+    import sys
+    import tempfile
+    import time
+
+    filename  = os.path.join(tempfile.mkdtemp(), 'frames.h5')
+    selection = [slice(100, 500), slice(200, 500)]
+    devnull   = open(os.devnull, 'w')
+
+    print ("\n[Streaming PRNU over HDF5 frames]\n")
+    print ("%8s %10s %14s" % ("frames", "time [s]", "max. RSS [MB]"))
+    for nofFrames in [8, 32, 128]:
+        write_test_file(filename, nofFrames)
+        stdout, sys.stdout = sys.stdout, devnull
+        start = time.time()
+        nofBlocks = 0
+        for prnu, statistics in process_file(filename, selection, nofFrames=8):
+            nofBlocks += 1
+        elapsed = time.time()-start
+        sys.stdout = stdout
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+        print ("%8d %10.3f %14.1f" % (nofFrames, elapsed, maxrss))
+        os.remove(filename)
+
+    ## Products are stored in their own type unless a type is requested
+    ckdfile = os.path.join(tempfile.mkdtemp(), 'ckd.h5')
+    block   = 1.0 + 0.01*np.random.randn(2, 40, 60)
+    for dtype in [None, np.float32]:
+        with CKDWriter(ckdfile, dtype=dtype) as writer:
+            writer.append('band_1', 'prnu', block)
+        with CKDReader(ckdfile) as reader:
+            assert reader.read('band_1', 'prnu').dtype == np.dtype(dtype or block.dtype)
+    os.remove(ckdfile)
+
+    print ("\n[Storage of PRNU CKD]\n")
+    benchmark_ckd(os.path.join(tempfile.mkdtemp(), 'ckd.h5'))
@@ -0,0 +1,249 @@
+""" Layout of a detector frame composed of several bands.
+
+    The bands of a frame are placed side by side along the columns, e.g. two
+    bands of 800 columns each make up frame columns 0..799 (band 1) and
+    800..1599 (band 2). A `FrameLayout` holds an interval index over the
+    column ranges of the bands, through which a selection of the frame is
+    resolved into one (rows, columns) selection per band it touches, in
+    coordinates local to the band. Resolved selections are cached, so that
+    applying the same selection to every frame of a batch costs a dictionary
+    lookup, and the per-band views are plain slices of the band arrays, i.e.
+    they do not copy any data.
+"""
+
+from bisect import bisect_right
+
+## =============================================================================
+##
+##  Helper functions
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                 region_slices
+
+def region_slices(corners):
+    """ Convert region corners, grouped by axis as [(start,stop), ...], to a
+        list of slices, one per axis.
+    """
+    return [slice(start, stop) for start, stop in corners]
+
+##______________________________________________________________________________
+##                                                                 _selection_key
+
+def _selection_key(selection):
+    """ Hashable representation of a selection (rows, columns), as a flat
+        tuple of the slice attributes (slices are not hashable).
+    """
+    rows, columns = selection
+    return (rows.start, rows.stop, rows.step, columns.start, columns.stop, columns.step)
+
+## =============================================================================
+##
+##  Class definition
+##
+## =============================================================================
+
+class FrameLayout (object):
+    """ Column layout of the bands of a frame.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self,
+                 bands,
+                 cachesize=64):
+        """ Initialize object's internal data.
+
+            :param bands: Sequence of tuples (name, shape), where shape is
+                          (rows, columns) of the band, in the order in which
+                          the bands are placed along the frame columns.
+            :param cachesize: Maximum number of resolved selections kept; the
+                              cache is emptied once it is full.
+        """
+        if not len(bands):
+            raise ValueError("A frame layout requires at least one band!")
+        """ Names of the bands. """
+        self.names = [name for name, shape in bands]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError("Band names must be unique!")
+        """ Shapes (rows, columns) of the bands. """
+        self.shapes = [tuple(shape) for name, shape in bands]
+        """ First frame column of each band (sorted, used for bisection). """
+        self._starts = []
+        column = 0
+        for rows, columns in self.shapes:
+            self._starts.append(column)
+            column += columns
+        """ Shape (rows, columns) of the frame. """
+        self.shape = (max(rows for rows, columns in self.shapes), column)
+        """ Maximum number of resolved selections kept. """
+        self.cachesize = cachesize
+        """ Resolved selections: selection key -> result of `resolve`. """
+        self._cache = {}
+
+    ##__________________________________________________________________________
+    ##                                                            from_detectors
+
+    @classmethod
+    def from_detectors(cls,
+                       detector_bands,
+                       shape):
+        """ Layout of the bands of a set of detectors, ordered by band number.
+
+            :param detector_bands: Dictionary detector -> tuple of band numbers,
+                                   e.g. {'1': (1, 2), '2': (3, 4)}.
+            :param shape: Shape (rows, columns) of all bands, or dictionary
+                          band number -> shape.
+        """
+        bands = sorted(band for numbers in detector_bands.values() for band in numbers)
+        if isinstance(shape, dict):
+            return cls([(band, shape[band]) for band in bands])
+        return cls([(band, shape) for band in bands])
+
+    ##__________________________________________________________________________
+    ##                                                                    locate
+
+    def locate(self, column):
+        """ Band holding a frame column.
+
+            :return: Tuple (band name, column within the band).
+        """
+        if not 0 <= column < self.shape[1]:
+            raise ValueError("Column %d outside of frame with %d columns!"
+                             % (column, self.shape[1]))
+        n = bisect_right(self._starts, column)-1
+        return self.names[n], column-self._starts[n]
+
+    ##__________________________________________________________________________
+    ##                                                                band_slice
+
+    def band_slice(self, name):
+        """ Frame columns covered by a band. """
+        n = self.names.index(name)
+        return slice(self._starts[n], self._starts[n]+self.shapes[n][1])
+
+    ##__________________________________________________________________________
+    ##                                                                   resolve
+
+    def resolve(self, selection):
+        """ Split a frame selection into selections of the bands it touches.
+
+            :param selection: Slices (rows, columns) in frame coordinates; the
+                              column slice may span several bands.
+            :return: Tuple of tuples (band name, (rows, columns)) with slices
+                     local to the band, in the order of the frame columns;
+                     it is shared between callers.
+        """
+        key = _selection_key(selection)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        if len(self._cache) >= self.cachesize:
+            self._cache.clear()
+        result = self._cache[key] = self._resolve(selection)
+        return result
+
+    def _resolve(self, selection):
+        rows, columns = selection
+        start, stop, step = columns.indices(self.shape[1])
+        if step < 0:
+            raise ValueError("Column selections must have a positive step!")
+        result = []
+        if start >= stop:
+            return ()
+        first = bisect_right(self._starts, start)-1
+        last  = bisect_right(self._starts, stop-1)-1
+        for n in range(first, last+1):
+            begin = self._starts[n]
+            end   = begin+self.shapes[n][1]
+            # First selected column within the band
+            column = start + max(0, -(-(begin-start)//step))*step
+            if column >= min(stop, end):
+                continue
+            result.append((self.names[n],
+                           (slice(*rows.indices(self.shapes[n][0])),
+                            slice(column-begin, min(stop, end)-begin, step))))
+        return tuple(result)
+
+    ##__________________________________________________________________________
+    ##                                                                     views
+
+    def views(self,
+              arrays,
+              selection):
+        """ Views of a selection into the arrays of the bands.
+
+            :param arrays: Dictionary band name -> array, the last two axes
+                           being (rows, columns); e.g. a single frame or a
+                           stack of frames per band.
+            :param selection: Slices (rows, columns) in frame coordinates.
+            :return: List of tuples (band name, view), see `resolve`.
+        """
+        return [(name, arrays[name][(Ellipsis,)+index])
+                for name, index in self.resolve(selection)]
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import time
+    import numpy as np
+
+    ## Frame of two bands, as in test_regions.py
+    layout = FrameLayout([(1, (1025, 800)), (2, (1025, 800))])
+    print ("\n[Frame layout] %d bands, frame shape %s\n" % (len(layout.names), layout.shape))
+    for selection in [[slice(500, 1000), slice(100, 600)],
+                      [slice(500, 1000), slice(900, 1400)],
+                      [slice(500, 1000), slice(600, 1000)],
+                      [slice(500, 1000), slice(799, 1600, 4)]]:
+        print ("-- %s" % selection)
+        for name, index in layout.resolve(selection):
+            print ("   band %s: %s" % (name, list(index)))
+
+    ## Views against a copy of the full frame
+    bands = dict((name, np.random.rand(*shape))
+                 for name, shape in zip(layout.names, layout.shapes))
+    frame = np.hstack([bands[name] for name in layout.names])
+    for selection in [[slice(500, 1000), slice(600, 1000)],
+                      [slice(None, None, 3), slice(1, 1600, 7)],
+                      [slice(0, 10), slice(800, 800)]]:
+        views = layout.views(bands, selection)
+        assert all(np.may_share_memory(view, bands[name]) for name, view in views)
+        joined = np.hstack([view for name, view in views]) if views else \
+                 np.empty((len(range(*selection[0].indices(layout.shape[0]))), 0))
+        np.testing.assert_array_equal(joined, frame[tuple(selection)])
+
+    ## Detector bands and region selections, as in test_dictionaries.py
+    detectors = {'1': (1, 2), '3': (5, 6), '2': (3, 4), '4': (7, 8)}
+    layout8 = FrameLayout.from_detectors(detectors, (1024, 500))
+    print ("\n[Detector layout] bands %s, frame shape %s" % (layout8.names, layout8.shape))
+    print ("-- Column 2100 in band %s at column %d" % layout8.locate(2100))
+    print ("-- Region [(10,90),(200,310)] = %s" % region_slices([(10, 90), (200, 310)]))
+
+    ## Per-frame selection overhead in a batch loop
+    nofFrames = 100000
+    selection = [slice(500, 1000), slice(600, 1000)]
+    def if_chain(selection):
+        """ Band selection of test_regions.py """
+        stop = layout.shapes[0][1]
+        if selection[1].stop <= stop:
+            return [selection, False]
+        if selection[1].start > stop:
+            return [False, [selection[0], slice(selection[1].start-stop,
+                                                selection[1].stop-stop, 1)]]
+        return [[selection[0], slice(selection[1].start, stop, 1)],
+                [selection[0], slice(0, selection[1].stop-stop, 1)]]
+    print ("\n[Selection of %d frames]\n" % nofFrames)
+    for name, function in [("if chain (2 bands only)", lambda: if_chain(selection)),
+                           ("uncached resolve", lambda: layout._resolve(selection)),
+                           ("cached resolve", lambda: layout.resolve(selection))]:
+        start = time.time()
+        for n in range(nofFrames):
+            function()
+        print ("-- %-26s = %8.2f us/frame" % (name, 1e6*(time.time()-start)/nofFrames))
+
+    ## Cache keys of equal selections match
+    assert layout.resolve([slice(500, 1000), slice(600, 1000)]) is layout.resolve(selection)
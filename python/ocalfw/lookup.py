@@ -0,0 +1,246 @@
+""" Lookup and interpolation in sorted tables, e.g. calibration tables giving
+    wavelength or row as function of another coordinate.
+
+    A `LookupTable` prepares everything that depends on the table alone when
+    it is created: the slopes (linear mode), the interval midpoints (nearest
+    mode) or the spline coefficients (cubic mode). Queries are located by
+    index arithmetic if the abscissae are equidistant and by `searchsorted`
+    otherwise, and are evaluated in chunks, so that the temporary arrays stay
+    small for any number of queries. Tables may have several columns, which
+    are interpolated with a single lookup.
+"""
+
+import numpy as np
+from scipy.interpolate import CubicSpline
+
+## Interpolation modes
+MODES = ('linear', 'nearest', 'cubic')
+
+## Number of queries evaluated at a time
+CHUNK_SIZE = 65536
+
+## =============================================================================
+##
+##  Class definition
+##
+## =============================================================================
+
+class LookupTable (object):
+    """ Interpolating lookup in a table y(x).
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self,
+                 x,
+                 y,
+                 mode='linear',
+                 fill=None,
+                 rtol=1e-9):
+        """ Initialize object's internal data.
+
+            :param x: Abscissae of the table, 1D array with at least two
+                      distinct values; they are sorted if necessary.
+            :param y: Table values, array of shape (len(x),) or, for a table
+                      with several columns, (len(x), columns).
+            :param mode: Interpolation mode, 'linear', 'nearest' or 'cubic'
+                         (natural cubic spline).
+            :param fill: Value for queries outside of the table; `None` uses
+                         the first or last table value, as `np.interp`.
+            :param rtol: Relative tolerance on the spacing of the abscissae
+                         for the table to be treated as uniform.
+        """
+        if mode not in MODES:
+            raise ValueError("Unknown interpolation mode '%s'!" % mode)
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y)
+        if x.ndim != 1 or len(x) < 2 or y.shape[:1] != x.shape or y.ndim > 2:
+            raise ValueError("Table requires 1D abscissae and values of shape"
+                             " (len(x),) or (len(x), columns)!")
+        if not y.dtype.kind == 'f':
+            y = y.astype(float)
+        if np.any(np.diff(x) < 0):
+            order = np.argsort(x, kind='mergesort')
+            x, y = x[order], y[order]
+        if np.any(np.diff(x) == 0):
+            raise ValueError("Table abscissae must be distinct!")
+        """ Interpolation mode. """
+        self.mode = mode
+        """ Value for queries outside of the table, `None` to clamp. """
+        self.fill = fill
+        """ Table abscissae and values. """
+        self.x = x
+        self.y = y
+        """ Spacing of uniform tables, `None` for non-uniform tables. """
+        self.step = None
+        step = (x[-1]-x[0])/(len(x)-1)
+        if np.allclose(np.diff(x), step, rtol=rtol, atol=0):
+            self.step = step
+        if mode == 'linear':
+            """ Slopes of the table intervals. """
+            self._slope = np.diff(y, axis=0)/np.diff(x).reshape((-1,) + (1,)*(y.ndim-1))
+        elif mode == 'nearest':
+            """ Midpoints between the abscissae. """
+            self._midpoints = 0.5*(x[1:]+x[:-1])
+        else:
+            """ Polynomial coefficients per interval, highest power first. """
+            self._coefficients = CubicSpline(x, y, axis=0, bc_type='natural').c
+
+    ##__________________________________________________________________________
+    ##                                                                    _index
+
+    def _index(self, xq):
+        """ Index of the table interval holding each (clamped) query. """
+        if self.step is not None:
+            index = ((xq-self.x[0])*(1.0/self.step)).astype(np.intp)
+            np.clip(index, 0, len(self.x)-2, out=index)
+            return index
+        index = np.searchsorted(self.x, xq, side='right')-1
+        np.clip(index, 0, len(self.x)-2, out=index)
+        return index
+
+    ##__________________________________________________________________________
+    ##                                                                 _evaluate
+
+    def _evaluate(self, xq):
+        """ Interpolate a 1D chunk of queries lying within the table. """
+        if self.mode == 'nearest':
+            # Queries half-way between two abscissae go to the upper one, on
+            # both paths: the interval is refined by its midpoint
+            if self.step is not None:
+                index = self._index(xq)
+                index += xq >= self._midpoints[index]
+            else:
+                index = np.searchsorted(self._midpoints, xq, side='right')
+            return self.y[index]
+        index = self._index(xq)
+        dx = xq-self.x[index]
+        if self.y.ndim == 2:
+            dx = dx[:, np.newaxis]
+        if self.mode == 'linear':
+            return self.y[index] + self._slope[index]*dx
+        c = self._coefficients
+        return ((c[0][index]*dx + c[1][index])*dx + c[2][index])*dx + c[3][index]
+
+    ##__________________________________________________________________________
+    ##                                                                  __call__
+
+    def __call__(self,
+                 xq,
+                 out=None,
+                 chunksize=CHUNK_SIZE):
+        """ Interpolate the table at the query points.
+
+            :param xq: Query points, array of any shape.
+            :param out: Optional output array of shape xq.shape (+ (columns,)
+                        for tables with several columns).
+            :param chunksize: Number of queries evaluated at a time.
+        """
+        xq = np.asarray(xq, dtype=float)
+        shape = xq.shape + self.y.shape[1:]
+        if out is None:
+            out = np.empty(shape, dtype=self.y.dtype)
+        elif out.shape != shape:
+            raise ValueError("Output array must have shape %s!" % (shape,))
+        queries = xq.reshape(-1)
+        result  = out.reshape((-1,) + self.y.shape[1:])
+        for start in range(0, len(queries), chunksize):
+            chunk = queries[start:start+chunksize]
+            clamped = np.clip(chunk, self.x[0], self.x[-1])
+            result[start:start+chunksize] = self._evaluate(clamped)
+            if self.fill is not None:
+                outside = (chunk < self.x[0]) | (chunk > self.x[-1])
+                result[start:start+chunksize][outside] = self.fill
+        if not np.may_share_memory(result, out):
+            out[...] = result.reshape(shape)
+        return out
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import sys
+    import time
+
+    def best_of(function, repeat=3):
+        best = np.inf
+        for n in range(repeat):
+            start = time.time()
+            function()
+            best = min(best, time.time()-start)
+        return best
+
+    ## Table of test_lookup.py
+    x = np.arange(-10, 10, 0.5)
+    y = np.sin(x)
+    xvals = np.array([0.3, 0.6, 0.9, 1.2, 1.5])
+    table = LookupTable(x, y)
+    print ("\n[Table of %d points, uniform = %s]\n" % (len(x), table.step is not None))
+    for xq, yq in zip(xvals, table(xvals)):
+        print ("%6.2f -> %9.6f" % (xq, yq))
+
+    ## Wavelength table and queries
+    nofEntries = 4096
+    wavelength = np.linspace(270.0, 500.0, nofEntries)
+    irregular  = np.sort(np.random.uniform(270.0, 500.0, nofEntries))
+    values     = np.column_stack([np.sin(wavelength/7.0), np.cos(wavelength/11.0),
+                                  wavelength/500.0])
+    queries    = np.random.uniform(260.0, 510.0, 10**5)
+
+    ## Agreement with np.interp and scipy
+    for grid in [wavelength, irregular]:
+        for column in range(values.shape[1]):
+            reference = np.interp(queries, grid, values[:, column])
+            np.testing.assert_allclose(LookupTable(grid, values[:, column])(queries),
+                                       reference, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(LookupTable(grid, values)(queries)[:, 2],
+                                   np.interp(queries, grid, values[:, 2]), rtol=1e-12)
+        inside = np.clip(queries, grid[0], grid[-1])
+        np.testing.assert_allclose(LookupTable(grid, values, mode='cubic')(queries),
+                                   CubicSpline(grid, values, bc_type='natural')(inside),
+                                   rtol=1e-9, atol=1e-12)
+        nearest = np.concatenate([np.abs(chunk[:, np.newaxis]-grid).argmin(axis=1)
+                                  for chunk in np.array_split(inside, 100)])
+        np.testing.assert_array_equal(LookupTable(grid, values[:, 0], mode='nearest')(inside),
+                                      values[nearest, 0])
+    ## Same tie rule for uniform and non-uniform tables
+    uniform = LookupTable(np.arange(5.0), np.arange(5.0), mode='nearest')
+    general = LookupTable(np.arange(5.0), np.arange(5.0), mode='nearest')
+    general.step = None
+    ties = np.array([0.5, 1.5, 2.5, 3.5])
+    np.testing.assert_array_equal(uniform(ties), [1.0, 2.0, 3.0, 4.0])
+    np.testing.assert_array_equal(general(ties), uniform(ties))
+    filled = LookupTable(wavelength, values[:, 0], fill=np.nan)(queries)
+    assert np.all(np.isnan(filled) == ((queries < 270.0) | (queries > 500.0)))
+
+    def interp_columns(queries):
+        """ One np.interp call per table column. """
+        for n in range(values.shape[1]):
+            np.interp(queries, wavelength, values[:, n])
+
+    ## Timing for increasing numbers of queries; pass the largest power of
+    ## ten as argument (10^8 queries need about 4 GB of memory)
+    maxPower = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    uniform  = LookupTable(wavelength, values[:, 0])
+    sorted_  = LookupTable(irregular, values[:, 0])
+    cubic    = LookupTable(wavelength, values[:, 0], mode='cubic')
+    spline   = CubicSpline(wavelength, values[:, 0], bc_type='natural')
+    columns  = LookupTable(wavelength, values)
+    print ("\n[Lookups in a table of %d entries, time in s]\n" % nofEntries)
+    print ("%10s %10s %10s %10s %10s %10s %12s %12s" % ("queries", "np.interp", "uniform",
+                                                        "sorted", "cubic", "CubicSpl.",
+                                                        "3x interp", "3 columns"))
+    for power in range(3, maxPower+1):
+        queries = np.random.uniform(270.0, 500.0, 10**power)
+        repeat  = 3 if power < 7 else 1
+        print ("%10s %10.5f %10.5f %10.5f %10.5f %10.5f %12.5f %12.5f"
+               % ("10^%d" % power,
+                  best_of(lambda: np.interp(queries, wavelength, values[:, 0]), repeat),
+                  best_of(lambda: uniform(queries), repeat),
+                  best_of(lambda: sorted_(queries), repeat),
+                  best_of(lambda: cubic(queries), repeat),
+                  best_of(lambda: spline(queries), repeat),
+                  best_of(lambda: interp_columns(queries), repeat),
+                  best_of(lambda: columns(queries), repeat)))
+        del queries
@@ -0,0 +1,211 @@
+""" Statistics of masked data, operating on a raw data array and a boolean mask.
+
+    The functions follow the conventions of `numpy.ma` -- `True` in the mask
+    flags an entry to be ignored, and the mean is the sum of the filled values
+    divided by the count -- but avoid the overhead of creating masked arrays
+    and propagating masks through every operation. Statistics other than the
+    sum and count are set to NaN where all input values are masked.
+"""
+
+import numpy as np
+
+## =============================================================================
+##
+##  Helper functions
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                      _prepare
+
+def _prepare(values,
+             mask,
+             axis,
+             fill):
+    """ Fill the masked entries of the data array.
+
+        :return: Tuple (filled, mask, count), with the mask broadcast against
+                 the data and the number of non-masked entries along `axis`;
+                 for `axis=None` the arrays are flattened and the reduction
+                 axis is 0.
+    """
+    values = np.asarray(values)
+    mask   = np.broadcast_to(np.asarray(mask, dtype=bool), values.shape)
+    filled = np.where(mask, fill, values)
+    if axis is None:
+        filled, mask = filled.ravel(), mask.ravel()
+    return filled, mask, count(mask, 0 if axis is None else axis)
+
+## =============================================================================
+##
+##  Reductions
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                         count
+
+def count(mask,
+          axis=None):
+    """ Number of non-masked entries.
+
+        :param mask: Boolean mask, `True` for entries to be ignored.
+        :param axis: Axis along which to count; `None` counts all entries.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if axis is None:
+        return mask.size - np.count_nonzero(mask)
+    return mask.shape[axis] - np.count_nonzero(mask, axis=axis)
+
+##______________________________________________________________________________
+##                                                                    masked_sum
+
+def masked_sum(values,
+               mask,
+               axis=None):
+    """ Sum of the non-masked entries; zero if all entries are masked.
+
+        :param values: Input data array.
+        :param mask: Boolean mask, broadcastable against `values`.
+        :param axis: Axis along which the sum is computed; `None` sums over all
+                     entries.
+    """
+    values = np.asarray(values)
+    mask   = np.broadcast_to(np.asarray(mask, dtype=bool), values.shape)
+    return np.where(mask, 0, values).sum(axis=axis)
+
+##______________________________________________________________________________
+##                                                                          mean
+
+def mean(values,
+         mask,
+         axis=None):
+    """ Mean of the non-masked entries.
+
+        :param values: Input data array.
+        :param mask: Boolean mask, broadcastable against `values`.
+        :param axis: Axis along which the mean is computed; `None` averages
+                     over all entries.
+    """
+    filled, mask, cnt = _prepare(values, mask, axis, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return filled.sum(axis=axis)*1./cnt
+
+##______________________________________________________________________________
+##                                                                           std
+
+def std(values,
+        mask,
+        axis=None,
+        ddof=0):
+    """ Standard deviation of the non-masked entries.
+
+        :param values: Input data array.
+        :param mask: Boolean mask, broadcastable against `values`.
+        :param axis: Axis along which the standard deviation is computed;
+                     `None` uses all entries.
+        :param ddof: Delta degrees of freedom, the divisor is `count - ddof`.
+    """
+    filled, mask, cnt = _prepare(values, mask, axis, 0)
+    filled = filled.astype(np.result_type(filled, 1.0), copy=False)
+    axis   = 0 if axis is None else axis
+    with np.errstate(divide='ignore', invalid='ignore'):
+        average = np.expand_dims(filled.sum(axis=axis)*1./cnt, axis)
+        np.subtract(filled, average, out=filled, casting='unsafe')
+        np.copyto(filled, 0, where=mask)
+        np.square(filled, out=filled)
+        return np.sqrt(filled.sum(axis=axis)*1./(cnt-ddof))
+
+##______________________________________________________________________________
+##                                                                        median
+
+def median(values,
+           mask,
+           axis=None):
+    """ Median of the non-masked entries.
+
+        Masked entries are moved to the end of each lane by filling them with
+        +inf before sorting; the median is then taken from the first `count`
+        entries of the sorted lane.
+
+        :param values: Input data array.
+        :param mask: Boolean mask, broadcastable against `values`.
+        :param axis: Axis along which the median is computed; `None` uses all
+                     entries.
+    """
+    filled, mask, cnt = _prepare(values, mask, axis, np.inf)
+    axis   = 0 if axis is None else axis
+    filled = np.sort(filled, axis=axis)
+    lower  = np.expand_dims(np.maximum((cnt-1)//2, 0), axis)
+    upper  = np.expand_dims(np.maximum(cnt//2, 0), axis)
+    with np.errstate(invalid='ignore'):
+        result = 0.5*(np.take_along_axis(filled, lower, axis=axis) +
+                      np.take_along_axis(filled, upper, axis=axis))
+    return np.where(cnt > 0, np.squeeze(result, axis=axis), np.nan)
+
+##______________________________________________________________________________
+##                                                                    statistics
+
+def statistics(values,
+               mask,
+               axis=None):
+    """ Count, mean, standard deviation, minimum, median and maximum of the
+        non-masked entries.
+
+        :return: Dictionary with the statistics.
+    """
+    filled, lane_mask, cnt = _prepare(values, mask, axis, np.inf)
+    result = {'count'  : cnt,
+              'mean'   : mean(values, mask, axis),
+              'std'    : std(values, mask, axis),
+              'median' : median(values, mask, axis),
+              'min'    : np.min(filled, axis=axis)}
+    np.copyto(filled, -np.inf, where=lane_mask)
+    result['max'] = np.max(filled, axis=axis)
+    for key in ['min', 'max']:
+        result[key] = np.where(cnt > 0, result[key], np.nan)
+    return result
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import time
+
+    def timing(function, repeat=5):
+        """ Best wall clock time of repeated calls of a function. """
+        best = np.inf
+        for n in range(repeat):
+            start = time.time()
+            function()
+            best = min(best, time.time()-start)
+        return best
+
+    shape  = (1024, 1024)
+    values = 1.0 + np.random.rand(*shape)
+    mask   = np.random.rand(*shape) < 0.05
+    mask[:, 7] = True
+    masked = np.ma.masked_array(values, mask=mask)
+
+    print ("\n[Masked statistics on %d x %d frame, %.1f%% masked]\n"
+           % (shape[0], shape[1], 100.0*mask.mean()))
+    print ("%-8s %-6s %12s %12s %10s %12s"
+           % ("method", "axis", "numpy.ma [s]", "kernel [s]", "speed-up", "max. diff."))
+    for name, kernel, reference in [
+            ('sum',    masked_sum, lambda axis: np.ma.sum(masked, axis=axis)),
+            ('mean',   mean,       lambda axis: np.ma.mean(masked, axis=axis)),
+            ('std',    std,        lambda axis: np.ma.std(masked, axis=axis)),
+            ('median', median,     lambda axis: np.ma.median(masked, axis=axis))]:
+        for axis in [None, 0, 1]:
+            expected = np.ma.filled(np.ma.asarray(reference(axis), dtype=float),
+                                    0 if name == 'sum' else np.nan)
+            result   = kernel(values, mask, axis=axis)
+            time_ma     = timing(lambda: reference(axis))
+            time_kernel = timing(lambda: kernel(values, mask, axis=axis))
+            print ("%-8s %-6s %12.5f %12.5f %10.1f %12.3g"
+                   % (name, axis, time_ma, time_kernel, time_ma/time_kernel,
+                      np.nanmax(np.abs(result-expected))))
+            if name in ('sum', 'mean'):
+                np.testing.assert_array_equal(result, expected)
+            else:
+                np.testing.assert_allclose(result, expected, rtol=1e-12)
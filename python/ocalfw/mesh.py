@@ -0,0 +1,137 @@
+""" Construction of the (row,wavelength) mesh points derived from the spectral
+    calibration map, as used in PRNU step 2 (removal of smile effect).
+"""
+
+import numpy as np
+
+## Names of the mesh point components, in the order of the (N,3) array layout
+MESH_FIELDS = ('row', 'wavelength', 'signal')
+
+## =============================================================================
+##
+##  Mesh construction
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                           row_wavelength_mesh
+
+def row_wavelength_mesh(index_row,
+                        scm,
+                        signal,
+                        layout='array',
+                        dtype=float):
+    """ Compute (row,wavelength) mesh points for the selected detector rows.
+
+        Every pixel (row,col) of the selected rows is mapped onto the point
+        (row, scm[row,col]), carrying the signal value of the pixel.
+
+        :param index_row: Row numbers of the selection.
+        :param scm: Spectral calibration map for the full CCD.
+        :param signal: Signal for the selected rows, shape (len(index_row),
+                       scm.shape[1]).
+        :param layout: Memory layout of the result:
+                       'array' -- array of shape (N,3) with columns row,
+                       wavelength and signal;
+                       'structured' -- structured array with fields
+                       `MESH_FIELDS`;
+                       'columns' -- struct of arrays, i.e. dictionary with one
+                       contiguous 1D array per field, which can be handed to
+                       the gridding routines without further copies.
+        :param dtype: Floating point type of the mesh coordinates and values.
+    """
+    index_row = np.asarray(index_row)
+    shape     = (len(index_row), scm.shape[1])
+    signal    = np.asarray(signal)
+    if signal.shape != shape:
+        raise ValueError("Signal shape %s does not match mesh shape %s"
+                         % (signal.shape, shape))
+
+    if layout == 'columns':
+        mesh = {'row'        : np.empty(shape, dtype=dtype),
+                'wavelength' : np.empty(shape, dtype=dtype),
+                'signal'     : np.empty(shape, dtype=dtype)}
+        fields = [mesh[name] for name in MESH_FIELDS]
+    elif layout == 'structured':
+        mesh   = np.empty(shape, dtype=[(name, dtype) for name in MESH_FIELDS])
+        fields = [mesh[name] for name in MESH_FIELDS]
+    elif layout == 'array':
+        mesh   = np.empty(shape + (3,), dtype=dtype)
+        fields = [mesh[..., n] for n in range(3)]
+    else:
+        raise ValueError("Unknown mesh layout '%s'" % layout)
+
+    # Fill the components in place through (rows,cols) views, avoiding the
+    # temporaries of np.repeat/np.column_stack
+    fields[0][...] = index_row[:, np.newaxis]
+    np.take(scm, index_row, axis=0, out=fields[1])
+    fields[2][...] = signal
+
+    if layout == 'columns':
+        for name in MESH_FIELDS:
+            mesh[name] = mesh[name].reshape(-1)
+        return mesh
+    elif layout == 'structured':
+        return mesh.reshape(-1)
+    return mesh.reshape(-1, 3)
+
+##______________________________________________________________________________
+##                                                                  mesh_columns
+
+def mesh_columns(mesh):
+    """ Return views on the (row, wavelength, signal) components of a mesh,
+        independent of the layout in which it was created.
+
+        :param mesh: Mesh points as returned by `row_wavelength_mesh`.
+    """
+    if isinstance(mesh, dict) or mesh.dtype.names is not None:
+        return tuple(mesh[name] for name in MESH_FIELDS)
+    return tuple(mesh[:, n] for n in range(3))
+
+##______________________________________________________________________________
+##                                                      row_wavelength_mesh_loop
+
+def row_wavelength_mesh_loop(index_row,
+                             scm,
+                             signal):
+    """ Reference implementation of the mesh construction, filling the (N,3)
+        array one element at a time; kept for regression testing.
+    """
+    mesh = np.ndarray(shape=[signal.size,3])
+    count = 0
+    for nrow in range(len(index_row)):
+        for ncol in range(scm.shape[1]):
+            mesh[count,0] = index_row[nrow]
+            mesh[count,1] = scm[index_row[nrow],ncol]
+            mesh[count,2] = signal[nrow,ncol]
+            count        += 1
+    return mesh
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import time
+
+    image_area = (1024, 600)
+    index_row  = np.arange(100, 500)
+    scm        = np.random.rand(image_area[0], image_area[1])
+    signal     = np.random.rand(len(index_row), image_area[1])
+
+    print ("\n[Mesh construction for %d x %d pixels]\n" % signal.shape)
+
+    start = time.time()
+    reference = row_wavelength_mesh_loop(index_row, scm, signal)
+    time_loop = time.time()-start
+    print ("-- Time loop implementation ... = %.4f s" % time_loop)
+
+    for layout in ['array', 'structured', 'columns']:
+        nofRuns = 10
+        start = time.time()
+        for n in range(nofRuns):
+            mesh = row_wavelength_mesh(index_row, scm, signal, layout=layout)
+        time_layout = (time.time()-start)/nofRuns
+        print ("-- Time layout %-10s ..... = %.4f s (speed-up %.0fx)"
+               % (layout, time_layout, time_loop/time_layout))
+        for n, values in enumerate(mesh_columns(mesh)):
+            np.testing.assert_array_equal(values, reference[:, n])
@@ -0,0 +1,247 @@
+""" Normalization engine for PRNU step 1: removal of swath dependent signal
+    variations by means of column and row normalization factors.
+
+    The functions in this module replace the per-row/per-column loops over
+    slices of a masked array by whole-array reductions on the raw data array
+    and its pixel quality mask, while reproducing the results of the masked
+    array arithmetic bit by bit.
+"""
+
+import numpy as np
+
+import maskedstats
+
+## Tolerance used by numpy.ma to decide whether a division is valid
+_DIVIDE_TOLERANCE = np.finfo(float).tiny
+
+## =============================================================================
+##
+##  Helper functions
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                   _masked_mean
+
+def _masked_mean(values,
+                 mask,
+                 axis):
+    """ Mean of the non-masked entries along an axis, computed the same way as
+        `numpy.ma.MaskedArray.mean` for a 1D slice (sum of filled values
+        divided by count), see `maskedstats.mean`. Entries for which all input
+        values are masked are set to NaN, which is what assigning a masked
+        result to a regular array yields.
+
+        :param values: Input data array.
+        :param mask: Boolean mask, `True` for pixels to be ignored.
+        :param axis: Axis along which the mean is computed, -2 (columns) or -1
+                     (rows); any leading axes (e.g. frames) are kept.
+                     Reductions are always carried out along the last
+                     (contiguous) axis, in order to use the same summation as
+                     for a 1D slice.
+    """
+    if axis == -2:
+        values = np.ascontiguousarray(np.swapaxes(values, -1, -2))
+        mask   = np.ascontiguousarray(np.swapaxes(mask, -1, -2))
+    return maskedstats.mean(values, mask, axis=-1)
+
+##______________________________________________________________________________
+##                                                                _masked_divide
+
+def _masked_divide(a,
+                   mask,
+                   b):
+    """ Division of masked data, following the conventions of `numpy.ma`:
+        entries which are masked, or for which the division is invalid or not
+        finite, are flagged in the returned mask and keep the value of the numerator.
+
+        :param a: Numerator data array.
+        :param mask: Boolean mask for the numerator.
+        :param b: Denominator, broadcastable against `a`.
+        :return: Tuple with the quotient and its mask.
+    """
+    invalid = np.absolute(a) * _DIVIDE_TOLERANCE >= np.absolute(b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        quotient = np.true_divide(a, b)
+    mask = mask | invalid | ~np.isfinite(quotient)
+    np.copyto(quotient, a, casting='unsafe', where=mask)
+    return quotient, mask
+
+## =============================================================================
+##
+##  Normalization engine
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                    column_normalization_factor
+
+def column_normalization_factor(signal,
+                                mask):
+    """ Column normalization factor (equation 79a): mean of the non-masked
+        pixels within each column of the selection.
+
+        :param signal: Detector signal for the selected image area; a stack of
+                       frames may be passed with the frame index along the
+                       first axis.
+        :param mask: Boolean pixel quality mask for the selected image area.
+    """
+    return _masked_mean(signal, mask, axis=-2)
+
+##______________________________________________________________________________
+##                                                       row_normalization_factor
+
+def row_normalization_factor(signal,
+                             mask,
+                             f_norm_col):
+    """ Row normalization factor (equation 79d): mean of the column normalized
+        non-masked pixels within each row of the selection.
+
+        :param signal: Detector signal for the selected image area.
+        :param mask: Boolean pixel quality mask for the selected image area.
+        :param f_norm_col: Column normalization factor.
+    """
+    quotient, mask = _masked_divide(signal, mask, f_norm_col[..., np.newaxis, :])
+    return _masked_mean(quotient, mask, axis=-1)
+
+##______________________________________________________________________________
+##                                                                normalize_rows
+
+def normalize_rows(signal,
+                   mask,
+                   f_norm_row,
+                   out=None):
+    """ Pixel data row normalization (equation 79e).
+
+        :param signal: Detector signal, one row per entry of `f_norm_row`.
+        :param mask: Boolean pixel quality mask for `signal`.
+        :param f_norm_row: Row normalization factor.
+        :param out: Optional output array; masked pixels keep their input value.
+    """
+    quotient, mask = _masked_divide(signal, mask, f_norm_row[..., np.newaxis])
+    if out is None:
+        return quotient
+    out[...] = quotient
+    return out
+
+##______________________________________________________________________________
+##                                                                     normalize
+
+def normalize(signal,
+              mask,
+              selection,
+              dtype=None,
+              out=None):
+    """ PRNU step 1 for a single frame or a stack of frames (frame index along
+        the first axis).
+
+        :param signal: Detector signal for the full CCD.
+        :param mask: Pixel quality mask, non-zero for bad pixels; broadcast
+                     against the signal, so a single mask can be shared by all
+                     frames of a stack.
+        :param selection: Slices (rows, columns) of the selected image area.
+        :param dtype: Floating point type used for the computation. The default
+                      (`None`) uses the type of the input signal, which yields
+                      results identical to the `numpy.ma` based computation;
+                      pass `np.float32` to trade accuracy for speed and memory.
+        :param out: Optional output array for the row normalized signal.
+        :return: Tuple (f_norm_col, f_norm_row, signal_row_norm); as in `Data`
+                 the normalization factors are stored in single precision.
+    """
+    signal = np.asarray(signal)
+    mask   = np.asarray(mask, dtype=bool)
+    if dtype is not None:
+        signal = signal.astype(dtype, copy=False)
+    nofRows   = len(range(*selection[0].indices(signal.shape[-2])))
+    selection = (Ellipsis,) + tuple(selection)
+
+    # Column normalization factor (equation 79a)
+    f_norm_col = column_normalization_factor(signal[selection],
+                                             mask[selection]).astype(np.float32)
+    # Row normalization factor (equation 79d)
+    f_norm_row = row_normalization_factor(signal[selection],
+                                          mask[selection],
+                                          f_norm_col if dtype is None
+                                          else f_norm_col.astype(dtype))
+    f_norm_row = f_norm_row.astype(np.float32)
+    # Pixel data row normalization (equation 79e); the rows are taken from the
+    # top of the full CCD, matching the original implementation.
+    signal_row_norm = normalize_rows(signal[..., :nofRows, :],
+                                     mask[..., :nofRows, :],
+                                     f_norm_row.astype(signal.dtype),
+                                     out=out)
+    return f_norm_col, f_norm_row, signal_row_norm
+
+##______________________________________________________________________________
+##                                                                    calc_step1
+
+def calc_step1(data,
+               dtype=None):
+    """ Run PRNU step 1 on a `Data` object, filling `f_norm_col`, `f_norm_row`
+        and `_signal_row_norm`.
+
+        :param data: Data object holding signal, pixel quality and selection.
+        :param dtype: Floating point type used for the computation, see
+                      `normalize`.
+    """
+    f_norm_col, f_norm_row, signal_row_norm = normalize(data._signal,
+                                                        data._pixel_quality,
+                                                        data._selection,
+                                                        dtype=dtype,
+                                                        out=data._signal_row_norm)
+    data.f_norm_col[:] = f_norm_col
+    data.f_norm_row[:] = f_norm_row
+
+##______________________________________________________________________________
+##                                                               calc_step1_loop
+
+def calc_step1_loop(data):
+    """ Reference implementation of PRNU step 1, looping over the rows and
+        columns of the masked signal array; kept for regression testing.
+    """
+    for ncol in range(len(data.index_col)):
+        data.f_norm_col[ncol] = data.signal_selection_masked[:, ncol].mean()
+    for nrow in range(len(data.index_row)):
+        data.f_norm_row[nrow] = np.mean(data.signal_selection_masked[nrow, :]/data.f_norm_col)
+    for nrow in range(len(data.index_row)):
+        data._signal_row_norm[nrow,:] = data.signal_masked[nrow, :]/data.f_norm_row[nrow]
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import copy
+    import time
+    from prnu import PRNU
+
+    ## Default fixture, and a variant with a large fraction of flagged pixels
+    ## including a fully masked row and column within the selection
+    for threshold in [None, 5.0]:
+        prnu = PRNU()
+        data = prnu._data
+        if threshold is not None:
+            data._pixel_quality = np.array(data._signal < threshold, dtype=int)
+            data._pixel_quality[150, :] = 1
+            data._pixel_quality[:, 300] = 1
+            data.signal_masked = np.ma.masked_array(data._signal,
+                                                    mask=data._pixel_quality)
+            data.signal_selection_masked = data.signal_masked[tuple(data._selection)]
+        print ("\n[Pixel quality threshold = %s]\n" % threshold)
+
+        reference = copy.deepcopy(data)
+        start = time.time()
+        calc_step1_loop(reference)
+        time_loop = time.time()-start
+
+        start = time.time()
+        calc_step1(data)
+        time_vectorized = time.time()-start
+
+        print ("-- Time loop implementation ....... = %.4f s" % time_loop)
+        print ("-- Time vectorized implementation . = %.4f s" % time_vectorized)
+
+        ## Exact comparison; NaN entries (fully masked rows/columns) match NaN
+        for name in ['f_norm_col', 'f_norm_row', '_signal_row_norm']:
+            np.testing.assert_array_equal(getattr(data, name),
+                                          getattr(reference, name))
+            print ("-- Bit-for-bit identical ......... = %s" % name)
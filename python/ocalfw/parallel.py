@@ -0,0 +1,243 @@
+""" Parallel execution of the PRNU algorithm over detectors and bands.
+
+    A detector frame holds the image areas of its bands side by side along the
+    columns (see `test_regions.py`); the bands per detector are given as in
+    `test_dictionaries.py`, e.g. {'1': (1, 2), '2': (3, 4)}. One PRNU
+    computation per (detector, band) pair is distributed onto a pool of worker
+    processes. Input frames and output PRNU maps live in shared memory
+    (`multiprocessing.RawArray`), which the workers inherit when the pool is
+    started, so only band coordinates and statistics are passed between
+    processes.
+"""
+
+import multiprocessing
+import os
+import sys
+from contextlib import contextmanager
+
+import numpy as np
+
+from batch import BatchPRNU
+from layout import FrameLayout
+
+## Shared buffers of the current process: name -> (RawArray, shape)
+_shared = {}
+
+## Settings of the current process, see `_init_worker`
+_settings = {'quiet' : False}
+
+## =============================================================================
+##
+##  Shared memory helpers
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                 shared_array
+
+def shared_array(shape):
+    """ Allocate a double precision array backed by shared memory.
+
+        :param shape: Shape of the array.
+        :return: Tuple (buffer, array), where `buffer` is the underlying
+                 `multiprocessing.RawArray` to be handed to the worker processes.
+    """
+    raw = multiprocessing.RawArray('d', int(np.prod(shape)))
+    return raw, np.frombuffer(raw, dtype=np.float64).reshape(shape)
+
+##______________________________________________________________________________
+##                                                                   _get_shared
+
+def _get_shared(name):
+    """ NumPy view on a shared buffer registered in this process. """
+    raw, shape = _shared[name]
+    return np.frombuffer(raw, dtype=np.float64).reshape(shape)
+
+##______________________________________________________________________________
+##                                                                  _init_worker
+
+def _init_worker(buffers,
+                 quiet):
+    """ Register the shared buffers in a worker process.
+
+        :param buffers: Dictionary name -> (RawArray, shape).
+        :param quiet: Suppress the progress output of the workers?
+    """
+    _shared.clear()
+    _shared.update(buffers)
+    _settings['quiet'] = quiet
+
+##______________________________________________________________________________
+##                                                                        _quiet
+
+@contextmanager
+def _quiet(quiet):
+    """ Discard the standard output within the context, if `quiet`. """
+    if not quiet:
+        yield
+        return
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+## =============================================================================
+##
+##  Processing of a single (detector, band) pair
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                 _process_band
+
+def _process_band(task):
+    """ Run the PRNU algorithm for one band of a detector.
+
+        :param task: Tuple (detector, band, columns, selection, filter_shape,
+                     cache_dir); `columns` is the slice of the band within the
+                     detector frame.
+        :return: Tuple (detector, band, statistics); the PRNU maps are written
+                 to the shared output buffer of the (detector, band) pair.
+    """
+    detector, band, columns, selection, filter_shape, cache_dir = task
+    frames = _get_shared(('frames', detector))[:, :, columns]
+    with _quiet(_settings['quiet']):
+        prnu = BatchPRNU(frames,
+                         selection=selection,
+                         filter_shape=filter_shape,
+                         cache_dir=cache_dir)
+        result, statistics = prnu.calc_prnu()
+    _get_shared(('prnu', detector, band))[...] = result
+    return detector, band, statistics
+
+## =============================================================================
+##
+##  Parallel driver
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                            calc_prnu_parallel
+
+def calc_prnu_parallel(frames,
+                       bands,
+                       nofWorkers=None,
+                       selection=None,
+                       filter_shape=(15, 15),
+                       cache_dir=None,
+                       quiet=True):
+    """ Calculate the PRNU CKD for all bands of all detectors in parallel.
+
+        :param frames: Dictionary detector -> frame data, either a single frame
+                       (rows, columns) or a stack (nofFrames, rows, columns);
+                       the bands of the detector are side by side along the
+                       columns.
+        :param bands: Dictionary detector -> tuple of band identifiers.
+        :param nofWorkers: Number of worker processes; defaults to the number
+                           of CPUs. With a single worker the computation runs
+                           in the calling process.
+        :param selection: Slices (rows, columns) of the selected area within
+                          each band; defaults to the full band.
+        :param filter_shape: Shape of the low-pass filter window (step 4).
+        :param cache_dir: Directory for persisted geometry products.
+        :param quiet: Suppress the progress output of the computations, in
+                      the worker processes or in the calling process?
+        :return: Dictionary (detector, band) -> (prnu, statistics).
+    """
+    if nofWorkers is None:
+        nofWorkers = multiprocessing.cpu_count()
+
+    buffers = {}
+    tasks   = []
+    for detector in sorted(frames):
+        data = np.asarray(frames[detector], dtype=np.float64)
+        if data.ndim == 2:
+            data = data[np.newaxis]
+        raw, shared = shared_array(data.shape)
+        shared[...] = data
+        buffers[('frames', detector)] = (raw, data.shape)
+
+        detector_bands = bands[detector]
+        width, remainder = divmod(data.shape[2], len(detector_bands))
+        if remainder:
+            raise ValueError("Frame of detector %s with %d columns does not split into"
+                             " %d bands of equal width!"
+                             % (detector, data.shape[2], len(detector_bands)))
+        layout = FrameLayout([(band, (data.shape[1], width)) for band in detector_bands])
+        for band in detector_bands:
+            columns = layout.band_slice(band)
+            if selection is None:
+                rows = data.shape[1]
+            else:
+                rows = len(range(*selection[0].indices(data.shape[1])))
+            raw, shared = shared_array((data.shape[0], rows, width))
+            buffers[('prnu', detector, band)] = (raw, shared.shape)
+            tasks.append((detector, band, columns, selection, filter_shape, cache_dir))
+
+    if nofWorkers == 1:
+        _init_worker(buffers, quiet)
+        try:
+            results = [_process_band(task) for task in tasks]
+        finally:
+            # Do not keep the buffers of this run alive in the calling process
+            _shared.clear()
+            _settings['quiet'] = False
+    else:
+        pool = multiprocessing.Pool(nofWorkers,
+                                    initializer=_init_worker,
+                                    initargs=(buffers, quiet))
+        try:
+            results = pool.map(_process_band, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    output = {}
+    for detector, band, statistics in results:
+        raw, shape = buffers[('prnu', detector, band)]
+        output[(detector, band)] = (np.frombuffer(raw, dtype=np.float64).reshape(shape),
+                                    statistics)
+    return output
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import time
+
+    bands  = {'1': (1, 2), '2': (3, 4), '3': (5, 6), '4': (7, 8)}
+    frames = dict((detector, 10.0+np.random.rand(4, 512, 2*300))
+                  for detector in bands)
+
+    ## Frames which do not split into bands of equal width are rejected
+    try:
+        calc_prnu_parallel({'1': frames['1'][..., :-1]}, bands, nofWorkers=1)
+    except ValueError as error:
+        print ("-- %s" % error)
+    else:
+        raise AssertionError("Frame with remainder columns accepted")
+
+    ## Reference: all bands processed in the calling process
+    start = time.time()
+    reference = calc_prnu_parallel(frames, bands, nofWorkers=1)
+    time_serial = time.time()-start
+    assert not _shared
+
+    print ("\n[Scaling of parallel PRNU, %d detectors x 2 bands]\n" % len(bands))
+    print ("%8s %10s %10s" % ("workers", "time [s]", "speed-up"))
+    print ("%8d %10.3f %10.2f" % (1, time_serial, 1.0))
+    ## Maximum number of workers: command line argument or number of CPUs
+    if len(sys.argv) > 1:
+        maxWorkers = int(sys.argv[1])
+    else:
+        maxWorkers = multiprocessing.cpu_count()
+    for nofWorkers in range(2, maxWorkers+1):
+        start = time.time()
+        result = calc_prnu_parallel(frames, bands, nofWorkers=nofWorkers)
+        elapsed = time.time()-start
+        print ("%8d %10.3f %10.2f" % (nofWorkers, elapsed, time_serial/elapsed))
+        for key in reference:
+            np.testing.assert_array_equal(result[key][0], reference[key][0])
@@ -0,0 +1,249 @@
+""" Dependency-driven execution of processing steps.
+
+    Each step (node) of a pipeline declares the attributes of the shared data
+    object it reads (inputs) and writes (outputs). From these declarations, and
+    the order in which the nodes are listed, the dependencies between the nodes
+    are derived: a node depends on the last preceding writer of any attribute
+    it reads or writes, and on all readers of an attribute it overwrites since
+    that attribute was last written. Nodes whose dependencies are satisfied run
+    concurrently in a pool of threads; since NumPy releases the GIL in its
+    compute kernels, this overlaps independent numerical work.
+"""
+
+import sys
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+## A node of the pipeline: `function` is called without arguments
+Node = namedtuple('Node', ('name', 'function', 'inputs', 'outputs'))
+
+## Timeline entry of an executed node
+Execution = namedtuple('Execution', ('name', 'start', 'end', 'thread'))
+
+## Re-raise an error caught in another thread with its original traceback
+if sys.version_info[0] < 3:
+    exec("def _reraise(exc_info):\n"
+         "    raise exc_info[0], exc_info[1], exc_info[2]\n")
+else:
+    def _reraise(exc_info):
+        raise exc_info[1].with_traceback(exc_info[2])
+
+## =============================================================================
+##
+##  Class definition
+##
+## =============================================================================
+
+class Pipeline (object):
+    """ Set of nodes, executed in an order respecting their dependencies.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self, nodes):
+        """ Initialize object's internal data.
+
+            :param nodes: Sequence of `Node`; where two nodes access the same
+                          attribute, their order in this sequence determines
+                          the order of execution.
+        """
+        names = [node.name for node in nodes]
+        if len(set(names)) != len(names):
+            raise ValueError("Pipeline node names must be unique!")
+        """ Nodes in declaration order. """
+        self.nodes = list(nodes)
+        """ Dependencies: node name -> set of names of the nodes it depends on. """
+        self.dependencies = self._dependencies()
+        """ Timeline of the last run, list of `Execution`. """
+        self.timeline = []
+
+    ##__________________________________________________________________________
+    ##                                                             _dependencies
+
+    def _dependencies(self):
+        """ Derive the dependencies from the declared inputs and outputs. """
+        writer  = {}    # attribute -> last node writing it
+        readers = {}    # attribute -> nodes reading it since the last write
+        dependencies = {}
+        for node in self.nodes:
+            depends = set()
+            for name in node.inputs:
+                if name in writer:
+                    depends.add(writer[name])
+            for name in node.outputs:
+                if name in writer:
+                    depends.add(writer[name])
+                depends.update(readers.get(name, ()))
+            depends.discard(node.name)
+            dependencies[node.name] = depends
+            for name in node.inputs:
+                readers.setdefault(name, set()).add(node.name)
+            for name in node.outputs:
+                writer[name]  = node.name
+                readers[name] = set()
+        return dependencies
+
+    ##__________________________________________________________________________
+    ##                                                                  schedule
+
+    def schedule(self):
+        """ Nodes grouped into stages: the nodes of a stage only depend on
+            nodes of earlier stages and may run concurrently.
+
+            :return: List of lists of node names.
+        """
+        stage  = {}
+        stages = []
+        for node in self.nodes:
+            level = max([stage[name]+1 for name in self.dependencies[node.name]] or [0])
+            stage[node.name] = level
+            if level == len(stages):
+                stages.append([])
+            stages[level].append(node.name)
+        return stages
+
+    ##__________________________________________________________________________
+    ##                                                                  describe
+
+    def describe(self):
+        """ Description of the nodes, their dependencies and the schedule. """
+        lines = []
+        for node in self.nodes:
+            lines.append("%-8s in: %s" % (node.name, ', '.join(node.inputs) or '-'))
+            lines.append("%-8s out: %s" % ('', ', '.join(node.outputs) or '-'))
+            lines.append("%-8s after: %s" % ('', ', '.join(sorted(self.dependencies[node.name])) or '-'))
+        for n, names in enumerate(self.schedule()):
+            lines.append("stage %d: %s" % (n, ', '.join(names)))
+        return '\n'.join(lines)
+
+    ##__________________________________________________________________________
+    ##                                                                       run
+
+    def run(self, nofThreads=None):
+        """ Execute all nodes.
+
+            :param nofThreads: Number of threads; defaults to the number of
+                               CPUs. With a single thread the nodes are
+                               executed in declaration order in the calling
+                               thread.
+            :return: Timeline of the run, list of `Execution` in order of
+                     completion.
+        """
+        self.timeline = []
+        if nofThreads == 1:
+            for node in self.nodes:
+                execution, error = _execute(node)
+                if error is not None:
+                    _reraise(error)
+                self.timeline.append(execution)
+            return self.timeline
+
+        finished = queue.Queue()
+        waiting  = dict((name, set(depends))
+                        for name, depends in self.dependencies.items())
+        nodes    = dict((node.name, node) for node in self.nodes)
+        pool     = ThreadPool(nofThreads)
+        try:
+            def submit(names):
+                for name in names:
+                    del waiting[name]
+                    pool.apply_async(_execute, (nodes[name],), callback=finished.put)
+            submit([node.name for node in self.nodes if not waiting[node.name]])
+            for n in range(len(self.nodes)):
+                execution, error = finished.get()
+                if error is not None:
+                    _reraise(error)
+                self.timeline.append(execution)
+                ready = []
+                for name in [node.name for node in self.nodes if node.name in waiting]:
+                    waiting[name].discard(execution.name)
+                    if not waiting[name]:
+                        ready.append(name)
+                submit(ready)
+        finally:
+            pool.close()
+            pool.join()
+        return self.timeline
+
+##______________________________________________________________________________
+##                                                                      _execute
+
+def _execute(node):
+    """ Execute a node, catching any error to hand it to the scheduler.
+
+        :return: Tuple (execution, error), where `error` is `None` or the
+                 `sys.exc_info()` of the error, including its traceback.
+    """
+    start = time.time()
+    try:
+        node.function()
+        error = None
+    except Exception:
+        error = sys.exc_info()
+    return (Execution(node.name, start, time.time(), threading.current_thread().name),
+            error)
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import multiprocessing
+    import os
+    import sys
+    import numpy as np
+    import scm
+    from prnu import PRNU
+
+    def run(signal, nofThreads):
+        """ Run the PRNU calculation, returning the result, time and timeline. """
+        prnu = PRNU(signal=signal)
+        scm.clear_cache()   # generate the map in every run
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        start = time.time()
+        timeline = prnu.calc_prnu(nofThreads=nofThreads)
+        elapsed = time.time()-start
+        sys.stdout.close()
+        sys.stdout = stdout
+        return prnu._data._prnu, elapsed, timeline
+
+    print ("\n[PRNU pipeline]\n")
+    print (PRNU().pipeline().describe())
+
+    signal = 1.0 + np.random.rand(1024, 600)
+    reference, elapsed, timeline = run(signal, 1)
+    print ("\n[Execution of 1024 x 600 frame, %d CPUs]\n" % multiprocessing.cpu_count())
+    print ("%10s %10s" % ("threads", "time [s]"))
+    print ("%10d %10.4f" % (1, elapsed))
+    assert [execution.name for execution in timeline] == \
+           ['step%d' % step for step, outputs in PRNU.STEP_OUTPUTS]
+    for nofThreads in [2, 4]:
+        result, elapsed, timeline = run(signal, nofThreads)
+        np.testing.assert_array_equal(result, reference)
+        print ("%10d %10.4f" % (nofThreads, elapsed))
+
+    print ("\n[Timeline with 4 threads]\n")
+    origin = min(execution.start for execution in timeline)
+    for execution in sorted(timeline, key=lambda execution: execution.start):
+        print ("%-8s %8.4f -> %8.4f s  %s" % (execution.name, execution.start-origin,
+                                              execution.end-origin, execution.thread))
+
+    ## Errors of a node are re-raised with the traceback of the node
+    import traceback
+    def failing():
+        raise RuntimeError("failing node")
+    for nofThreads in [1, 2]:
+        try:
+            Pipeline([Node('a', lambda: None, (), ('x',)),
+                      Node('b', failing, ('x',), ())]).run(nofThreads)
+        except RuntimeError:
+            assert traceback.extract_tb(sys.exc_info()[2])[-1][2] == 'failing'
+        else:
+            raise AssertionError("Error of node not raised")
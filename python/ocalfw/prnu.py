@@ -1,3 +1,5 @@
+import threading
+import time
 import numpy as np
 from matplotlib.backends.backend_pdf import PdfPages
 from mpl_toolkits.mplot3d import Axes3D
@@ -8,6 +10,10 @@ from pylab import *
 from data import Data
 from report_prnu import ReportPRNU
 import filters
+import normalization
+import mesh
+import stepcache
+from pipeline import Execution, Node, Pipeline
 
 ## =============================================================================
 ##
@@ -19,60 +25,87 @@ class PRNU (object):
 
     def __init__(self, *args, **kwargs):
         """ Initialize object's internal data.
+
+            :param signal: Detector signal for the full CCD (optional keyword
+                           argument); if not given, a random signal including
+                           swath dependent variation is generated.
+            :param pixel_quality: Pixel quality mask for the full CCD (optional
+                                  keyword argument), non-zero for bad pixels.
+            :param selection: Image area selection slices (optional keyword
+                              argument).
+            :param workspace: `workspace.Workspace` pool of work buffers, to
+                              be shared with the objects processing other
+                              frames of the same geometry (optional keyword
+                              argument).
+            :param swath_profile: `swath.SwathProfile` added to the generated
+                                  random signal (optional keyword argument).
+            :param store: `framestore.FrameStore` holding the signal and the
+                          large intermediate arrays in memory-mapped files
+                          (optional keyword argument).
         """
-        # Create data object
-        self._data = Data()
-        # Detector signal including swath dependent variation
-        swath = self._data.swathMap()
-        self._data._signal = self._data._signal + swath
-        # Pixel quality mask for the full image area (flag pixels with value < 0.1)
-        self._data._pixel_quality = np.array(self._data._signal < 0.1, dtype=int)
+        signal        = kwargs.get('signal')
+        pixel_quality = kwargs.get('pixel_quality')
+        options       = {}
+        for key in ['selection', 'workspace', 'swath_profile']:
+            if key in kwargs:
+                options[key] = kwargs[key]
+        if signal is None:
+            # Create data object
+            self._data = Data(**options)
+            # Detector signal including swath dependent variation
+            self._data.swath_profile.add(self._data._signal, out=self._data._signal)
+        else:
+            # Create data object for the provided detector signal
+            signal = np.asarray(signal, dtype=float)
+            self._data = Data(image_area=signal.shape, **options)
+            self._data._signal = signal
+        if pixel_quality is None:
+            # Pixel quality mask for the full image area (flag pixels with value < 0.1)
+            self._data._pixel_quality = np.array(self._data._signal < 0.1, dtype=int)
+        else:
+            self._data._pixel_quality = np.array(pixel_quality, dtype=int)
+        if kwargs.get('store') is not None:
+            # Memory-mapped signal and intermediate arrays
+            self._data.attachStore(kwargs['store'])
         # Masked array for the signal array
-        self._data.signal_masked = np.ma.masked_array(self._data._signal,
-                                                      mask=self._data._pixel_quality)
-        self._data.signal_selection_masked = self._data.signal_masked[self._data._selection]
+        self._data.maskSignal()
+        # Shape of the low-pass filter window used in step 4
+        self._filter_shape = (15, 15)
+        # Keyword arguments passed to the individual steps by `calc_prnu`,
+        # step number -> dictionary, e.g. {4: {'method': 'fft'}}
+        self.step_options = {}
 
     ##__________________________________________________________________________
     ## Step 1: Remove swath dependent signal variations
 
-    def calc_prnu_step1(self):
+    def calc_prnu_step1(self, dtype=None):
         print ("\n[Step 1] Remove swath dependent signal variations\n")
 
-        # Column normalization factor (equation 79a)
-        print("--> Computing column normalization factor ...")
-        for ncol in range(len(self._data.index_col)):
-            self._data.f_norm_col[ncol] = self._data.signal_selection_masked[:, ncol].mean()
-
-        # Row normalization factor (equation 79d)
-        print("--> Computing row normalization factor ...")
-        for nrow in range(len(self._data.index_row)):
-            self._data.f_norm_row[nrow] = np.mean(self._data.signal_selection_masked[nrow, :]/self._data.f_norm_col)
-
-        # Pixel data rown normalization (equation 79e)
-        print("--> Pixel data rown normalization ...")
-        for nrow in range(len(self._data.index_row)):
-            self._data._signal_row_norm[nrow,:] = self._data.signal_masked[nrow, :]/self._data.f_norm_row[nrow]
+        # Column normalization factor (equation 79a), row normalization factor
+        # (equation 79d) and pixel data row normalization (equation 79e)
+        print("--> Computing column/row normalization factors ...")
+        normalization.calc_step1(self._data, dtype=dtype)
+        self._data.keep('_signal_row_norm')
 
     ##__________________________________________________________________________
 
-    def calc_prnu_step2(self):
+    def calc_prnu_step2(self, layout='array'):
         print ("\n[Step 2] Removal of smile effect\n")
+        self.calc_prnu_step2_scm()
+        self.calc_prnu_step2_mesh(layout=layout)
 
+    def calc_prnu_step2_scm(self):
         # Get the spectral map
         print ("--> Get spectral calibration map ...")
-        scm = self._data.spectralCalibrationMap()
+        self._data.spectralCalibrationMap()
 
+    def calc_prnu_step2_mesh(self, layout='array'):
         # Compute (row,wavelength) mesh points based on spectral map
         print ("--> Computing (row,wavelength) mesh points ...")
-        self._data._signal_row_wavelength = np.ndarray(shape=[self._data._signal_row_norm.size,3])
-
-        count = 0
-        for nrow in range(len(self._data.index_row)):
-            for ncol in range(scm.shape[1]):
-                self._data._signal_row_wavelength[count,0] = self._data.index_row[nrow]
-                self._data._signal_row_wavelength[count,1] = scm[self._data.index_row[nrow],ncol]
-                self._data._signal_row_wavelength[count,2] = self._data._signal_row_norm[nrow,ncol]
-                count          += 1
+        self._data._signal_row_wavelength = mesh.row_wavelength_mesh(self._data.index_row,
+                                                                     self._data._scm,
+                                                                     self._data._signal_row_norm,
+                                                                     layout=layout)
 
     ##__________________________________________________________________________
 
@@ -81,9 +114,27 @@ class PRNU (object):
 
     ##__________________________________________________________________________
 
-    def calc_prnu_step4(self):
+    def calc_prnu_step4(self, window=None, method='auto'):
+        """ Removal of high-frequency features by applying a low-pass filter
+            to the row normalized signal; bad pixels are excluded by means of
+            normalized convolution.
+
+            :param window: 2D filter weights; defaults to a Hanning window of
+                           `self._filter_shape`.
+            :param method: Filter application method, see `filters.apply_filter`.
+        """
         print ("\n[Step 4] Removal of high-frequency features\n")
 
+        if window is None:
+            window = filters.hanning_window_2d(self._filter_shape)
+        nofRows = self._data._signal_row_norm.shape[0]
+        filters.apply_filter(self._data._signal_row_norm,
+                             window,
+                             mask=self._data._pixel_quality[:nofRows],
+                             method=method,
+                             out=self._data._signal_smooth)
+        self._data.keep('_signal_smooth')
+
     ##__________________________________________________________________________
 
     def calc_prnu_step5(self):
@@ -92,6 +143,13 @@ class PRNU (object):
     ##__________________________________________________________________________
 
     def calc_prnu_step6(self):
+        """ Re-gridding of the smoothed signal from the (row,wavelength) mesh
+            back onto the detector grid. Steps 2 to 5 keep the signal on the
+            detector pixels, i.e. the mesh points coincide with the detector
+            grid, so there is nothing to re-grid and the step is a no-op. Once
+            the preceding steps resample the mesh, `regrid.regrid_operator`
+            provides the (cached) interpolation onto the detector grid.
+        """
         print ("\n[Step 6] Re-gridding to Detector grid\n")
 
     ##__________________________________________________________________________
@@ -99,51 +157,176 @@ class PRNU (object):
     def calc_prnu_step7(self):
         print ("\n[Step 7] Inverse normalization of row intensities\n")
 
-        # Temporary data
-        signal_norm_row_smooth = np.ones(shape=self._data._signal_row_norm.shape)
-
-        # Apply normalization factor
-        for nrow in range(len(self._data.index_row)):
-            self._data._signal_smooth[nrow,:] = signal_norm_row_smooth[nrow, :]*self._data.f_norm_row[nrow]
+        # Apply normalization factor to the smoothed row normalized signal
+        self._data._signal_smooth *= self._data.f_norm_row[:, np.newaxis]
 
     ##__________________________________________________________________________
 
     def calc_prnu_step8(self):
+        """ PRNU CKD as ratio of the detector signal and its smoothed version;
+            pixels flagged in the pixel quality mask are set to NaN.
+        """
         print ("\n[Step 8] Calculate PRNU CKD\n")
 
+        # Same rows as used for the row normalization in step 1
+        nofRows = self._data._signal_smooth.shape[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(self._data._signal[:nofRows],
+                      self._data._signal_smooth,
+                      out=self._data._prnu)
+        self._data._prnu[self._data._pixel_quality[:nofRows] != 0] = np.nan
+        self._data.keep('_prnu')
+
+    ##__________________________________________________________________________
+
+    ## Attributes of the data object produced by the individual steps
+    STEP_OUTPUTS = ((1, ('f_norm_col', 'f_norm_row', '_signal_row_norm')),
+                    (2, ('_scm', '_signal_row_wavelength')),
+                    (3, ()),
+                    (4, ('_signal_smooth',)),
+                    (5, ()),
+                    (6, ()),
+                    (7, ('_signal_smooth',)),
+                    (8, ('_prnu',)))
+
+    def step_parameters(self, step):
+        """ Parameters that the result of a step depends on, besides the input
+            data and the results of the preceding steps.
+        """
+        parameters = dict(self.step_options.get(step, {}))
+        if step == 4:
+            parameters['filter_shape'] = self._filter_shape
+        return parameters
+
+    ##__________________________________________________________________________
+
+    ## Data attributes read and written by the nodes of the PRNU pipeline:
+    ## (name, method, inputs, outputs, step). The spectral calibration map and
+    ## the mesh of step 2 are separate nodes, since the map does not depend on
+    ## step 1 and the mesh is not used by the later steps.
+    PIPELINE = (('step1', 'calc_prnu_step1',
+                 ('_signal', '_pixel_quality', '_selection'),
+                 ('f_norm_col', 'f_norm_row', '_signal_row_norm'), 1),
+                ('scm', 'calc_prnu_step2_scm',
+                 ('image_area',),
+                 ('_scm',), None),
+                ('mesh', 'calc_prnu_step2_mesh',
+                 ('index_row', '_scm', '_signal_row_norm'),
+                 ('_signal_row_wavelength',), 2),
+                ('step3', 'calc_prnu_step3', (), (), 3),
+                ('step4', 'calc_prnu_step4',
+                 ('_signal_row_norm', '_pixel_quality'),
+                 ('_signal_smooth',), 4),
+                ('step5', 'calc_prnu_step5', (), (), 5),
+                ('step6', 'calc_prnu_step6', (), (), 6),
+                ('step7', 'calc_prnu_step7',
+                 ('_signal_smooth', 'f_norm_row'),
+                 ('_signal_smooth',), 7),
+                ('step8', 'calc_prnu_step8',
+                 ('_signal', '_signal_smooth', '_pixel_quality'),
+                 ('_prnu',), 8))
+
+    def pipeline(self):
+        """ Pipeline of the PRNU algorithm, see `pipeline.Pipeline`; the nodes
+            call the steps with their keyword arguments in `step_options`.
+        """
+        nodes = []
+        for name, method, inputs, outputs, step in PRNU.PIPELINE:
+            function = getattr(self, method)
+            options  = self.step_options.get(step, {})
+            if options:
+                function = (lambda function, options: lambda: function(**options))(function, options)
+            nodes.append(Node(name, function, inputs, outputs))
+        return Pipeline(nodes)
+
     ##__________________________________________________________________________
 
-    def calc_prnu(self):
+    def calc_prnu(self, profiler=None, cache=None, nofThreads=1):
         """ Calculate PRNU CKD.
+
+            :param profiler: Optional `profiling.StepProfiler` recording time,
+                             memory usage and products of each step.
+            :param cache: Optional `stepcache.StepCache`; steps whose input data
+                          and parameters are unchanged since a previous run are
+                          taken from the cache instead of being recomputed.
+            :param nofThreads: Number of threads; with more than one thread
+                               (or `None` for one per CPU) independent steps
+                               are executed concurrently by `pipeline`. This
+                               cannot be combined with profiling or caching,
+                               which operate step by step.
+            :return: Timeline of the executed steps, list of
+                     `pipeline.Execution`; steps taken from the cache are not
+                     included.
         """
-        self.calc_prnu_step1()
-        self.calc_prnu_step2()
-        self.calc_prnu_step3()
-        self.calc_prnu_step4()
-        self.calc_prnu_step5()
-        self.calc_prnu_step6()
-        self.calc_prnu_step7()
-        self.calc_prnu_step8()
+        if nofThreads != 1:
+            if profiler is not None or cache is not None:
+                raise ValueError("Profiling and caching require nofThreads=1!")
+            return self.pipeline().run(nofThreads)
+
+        first = 0
+        if cache is not None:
+            keys = stepcache.step_keys(self._data,
+                                       [(step, self.step_parameters(step))
+                                        for step, outputs in PRNU.STEP_OUTPUTS])
+            # Leading steps available from the cache; the state of the data
+            # object is restored to that after the last of them
+            cached = {}
+            for key in keys:
+                result = cache.get(key)
+                if result is None:
+                    break
+                cached.update(result)
+                first += 1
+            cache.restore(self._data, cached)
+            if first:
+                print ("\n[Steps 1-%d] Taken from cache\n" % first)
+
+        timeline = []
+        for n in range(first, len(PRNU.STEP_OUTPUTS)):
+            step, outputs = PRNU.STEP_OUTPUTS[n]
+            method  = getattr(self, 'calc_prnu_step%d' % step)
+            options = self.step_options.get(step, {})
+            start   = time.time()
+            if profiler is None:
+                method(**options)
+            else:
+                with profiler.step('step%d' % step, self._data, outputs):
+                    method(**options)
+            timeline.append(Execution('step%d' % step, start, time.time(),
+                                      threading.current_thread().name))
+            if cache is not None:
+                cache.put(keys[n], self._data, outputs)
+        return timeline
 
     ##__________________________________________________________________________
 
-    def report_prnu(self):
+    def report_prnu(self, nofWorkers=1, background=False, directory='.'):
         """ Generate plots for reporting.
+
+            :param nofWorkers: Number of worker processes generating the plots
+                               of the individual steps, `None` for the number
+                               of CPUs; see `ReportPRNU.run`.
+            :param background: Generate the plots in the background and return
+                               immediately.
+            :param directory: Directory to which the PDF files are written.
+            :return: `report_prnu.ReportJob` to wait for the plots.
         """
         print ("\n[Reporting]\n")
         report = ReportPRNU()
-        report.step1(self._data)
-        report.step2(self._data)
-        report.step3(self._data)
-        report.step4(self._data)
-        report.step5(self._data)
-        report.step6(self._data)
-        report.step7(self._data)
-        report.step8(self._data)
+        return report.run(self._data,
+                          directory=directory,
+                          nofWorkers=nofWorkers,
+                          background=background,
+                          quiet=False)
 
     ##__________________________________________________________________________
 
-    def run(self):
-        self.calc_prnu()
-        self.report_prnu()
+    def run(self, background=False):
+        """ Calculate the PRNU CKD and generate the plots for reporting.
 
+            :param background: Return as soon as the PRNU CKD is calculated,
+                               while the plots are generated in the background.
+            :return: `report_prnu.ReportJob` to wait for the plots.
+        """
+        self.calc_prnu()
+        return self.report_prnu(background=background)
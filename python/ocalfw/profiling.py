@@ -0,0 +1,231 @@
+""" Timing and memory instrumentation of the steps of the PRNU algorithm.
+
+    A `StepProfiler` records per step the wall clock and CPU time, the peak
+    resident set size of the process and -- where `tracemalloc` is available
+    (Python 3) -- the number of bytes allocated, as well as shape and data type
+    of the arrays produced by the step. The records of a run can be written as
+    JSON or CSV and printed as a summary table. Profiling is switched on by
+    passing a profiler to `PRNU.calc_prnu`; without one, the steps are called
+    directly and no instrumentation overhead is incurred.
+"""
+
+import csv
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+## Columns of the CSV output and the summary table
+RECORD_FIELDS = ('step', 'wall_time', 'cpu_time', 'peak_rss', 'rss_increase',
+                 'allocated', 'allocated_peak', 'outputs')
+
+## =============================================================================
+##
+##  Helper functions
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                     _peak_rss
+
+def _peak_rss():
+    """ Peak resident set size of the process in bytes. """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, in kilobytes elsewhere
+    return maxrss if sys.platform == 'darwin' else 1024*maxrss
+
+##______________________________________________________________________________
+##                                                                     _cpu_time
+
+def _cpu_time():
+    """ User and system CPU time of the process in seconds. """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+##______________________________________________________________________________
+##                                                                     _describe
+
+def _describe(value):
+    """ Shape and data type of an array, or of the arrays in a sequence. """
+    if isinstance(value, np.ndarray):
+        return '%s:%s' % ('x'.join(str(n) for n in value.shape), value.dtype)
+    if isinstance(value, (tuple, list)) and len(value) and \
+       all(isinstance(item, np.ndarray) for item in value):
+        return '(' + ','.join(_describe(item) for item in value) + ')'
+    return type(value).__name__
+
+## =============================================================================
+##
+##  Class definition
+##
+## =============================================================================
+
+class StepProfiler (object):
+    """ Collect timing and memory records of the steps of a run.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self, trace_allocations=True):
+        """ Initialize object's internal data.
+
+            :param trace_allocations: Trace memory allocations via `tracemalloc`
+                                      (if available); this slows down
+                                      allocation heavy code.
+        """
+        """ Trace memory allocations? """
+        self._trace = trace_allocations and tracemalloc is not None
+        """ Records of the profiled steps. """
+        self.records = []
+
+    ##__________________________________________________________________________
+    ##                                                                      step
+
+    @contextmanager
+    def step(self,
+             name,
+             data=None,
+             outputs=()):
+        """ Profile the execution of a block of code.
+
+            :param name: Name of the step.
+            :param data: Object holding the products of the step.
+            :param outputs: Names of the attributes of `data` produced by the
+                            step, whose shapes and data types are recorded.
+        """
+        started_tracing = False
+        if self._trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            allocated_start = tracemalloc.get_traced_memory()[0]
+        peak_rss  = _peak_rss()
+        cpu_start = _cpu_time()
+        start     = time.time()
+        try:
+            yield
+        finally:
+            record = {'step'      : name,
+                      'wall_time' : time.time()-start,
+                      'cpu_time'  : _cpu_time()-cpu_start,
+                      'peak_rss'  : _peak_rss()}
+            record['rss_increase'] = record['peak_rss']-peak_rss
+            if self._trace:
+                current, peak = tracemalloc.get_traced_memory()
+                record['allocated']      = current-allocated_start
+                record['allocated_peak'] = peak-allocated_start
+                if started_tracing:
+                    tracemalloc.stop()
+            else:
+                record['allocated']      = None
+                record['allocated_peak'] = None
+            record['outputs'] = dict((output, _describe(getattr(data, output, None)))
+                                     for output in outputs)
+            self.records.append(record)
+
+    ##__________________________________________________________________________
+    ##                                                                     total
+
+    def total(self):
+        """ Total wall clock and CPU time over all recorded steps. """
+        return (sum(record['wall_time'] for record in self.records),
+                sum(record['cpu_time'] for record in self.records))
+
+    ##__________________________________________________________________________
+    ##                                                                   to_json
+
+    def to_json(self, filename=None):
+        """ Write the records as JSON document; returns the document if no
+            file name is given.
+        """
+        document = json.dumps({'records' : self.records,
+                               'tracemalloc' : self._trace},
+                              indent=2, sort_keys=True)
+        if filename is None:
+            return document
+        with open(filename, 'w') as f:
+            f.write(document)
+
+    ##__________________________________________________________________________
+    ##                                                                    to_csv
+
+    def to_csv(self, filename):
+        """ Write the records as CSV file, one row per step. """
+        with open(filename, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS)
+            writer.writeheader()
+            for record in self.records:
+                row = dict(record)
+                row['outputs'] = ' '.join('%s=%s' % item for item in sorted(record['outputs'].items()))
+                writer.writerow(row)
+
+    ##__________________________________________________________________________
+    ##                                                                   summary
+
+    def summary(self):
+        """ Summary table of the records. """
+        lines = ["%-8s %10s %10s %14s %14s %14s  %s"
+                 % ("step", "wall [s]", "cpu [s]", "peak RSS [MB]",
+                    "RSS incr. [MB]", "alloc. [MB]", "outputs")]
+        for record in self.records:
+            allocated = "n/a" if record['allocated'] is None \
+                        else "%.1f" % (record['allocated_peak']/1048576.0)
+            lines.append("%-8s %10.4f %10.4f %14.1f %14.1f %14s  %s"
+                         % (record['step'], record['wall_time'], record['cpu_time'],
+                            record['peak_rss']/1048576.0,
+                            record['rss_increase']/1048576.0, allocated,
+                            ' '.join('%s=%s' % item
+                                     for item in sorted(record['outputs'].items()))))
+        wall, cpu = self.total()
+        lines.append("%-8s %10.4f %10.4f" % ("total", wall, cpu))
+        return '\n'.join(lines)
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import shutil
+    import tempfile
+    from prnu import PRNU
+
+    devnull = open(os.devnull, 'w')
+    stdout  = sys.stdout
+
+    ## Overhead of the instrumentation
+    nofRuns = 5
+    timing  = {}
+    for enabled in [False, True]:
+        best = np.inf
+        for n in range(nofRuns):
+            prnu = PRNU()
+            profiler = StepProfiler() if enabled else None
+            sys.stdout = devnull
+            start = time.time()
+            prnu.calc_prnu(profiler=profiler)
+            best = min(best, time.time()-start)
+            sys.stdout = stdout
+        timing[enabled] = best
+
+    print ("\n[Profile of PRNU.calc_prnu]\n")
+    print (profiler.summary())
+    print ("\n-- Time without profiler ...... = %.4f s" % timing[False])
+    print ("-- Time with profiler ......... = %.4f s" % timing[True])
+
+    directory = tempfile.mkdtemp()
+    profiler.to_json(os.path.join(directory, 'profile.json'))
+    profiler.to_csv(os.path.join(directory, 'profile.csv'))
+    with open(os.path.join(directory, 'profile.csv')) as f:
+        print ("\n[CSV record]\n\n" + f.read())
+    shutil.rmtree(directory)
@@ -0,0 +1,363 @@
+""" Batched extraction of many rectangular regions from the detector bands.
+
+    The regions, given per band, are grouped by band and overlapping regions
+    are merged into covering rectangles. Each covering rectangle is read from
+    the band data (a NumPy array or an HDF5 dataset) once, with a single
+    hyperslab selection, and the individual regions are views into it. The
+    regions are returned either as a list of arrays of different shapes
+    (ragged) or as a padded stack with a mask of the padding. Statistics over
+    hundreds of regions are computed by segmented reductions over the pixels
+    of all regions, concatenated into one array.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+## A rectangular region of a band: [first, last) rows and columns
+Region = namedtuple('Region', ('band', 'row_start', 'row_stop', 'col_start', 'col_stop'))
+
+## =============================================================================
+##
+##  Helper functions
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                   _rectangle
+
+def _rectangle(band,
+               selection):
+    """ Region from a selection given as slices or as corners grouped by axis,
+        [(start,stop), (start,stop)], see `layout.region_slices`.
+    """
+    bounds = []
+    for item in selection:
+        if isinstance(item, slice):
+            if item.step not in (None, 1) or item.start is None or item.stop is None:
+                raise ValueError("Regions require slices with explicit bounds and unit step!")
+            item = (item.start, item.stop)
+        start, stop = item
+        if not 0 <= start < stop:
+            raise ValueError("Invalid region bounds (%s, %s)!" % (start, stop))
+        bounds.extend([start, stop])
+    if len(bounds) != 4:
+        raise ValueError("Regions must be two-dimensional!")
+    return Region(band, *bounds)
+
+##______________________________________________________________________________
+##                                                                      _overlap
+
+def _overlap(a, b):
+    return a.row_start < b.row_stop and b.row_start < a.row_stop and \
+           a.col_start < b.col_stop and b.col_start < a.col_stop
+
+##______________________________________________________________________________
+##                                                                        _merge
+
+def _merge(rectangles):
+    """ Merge overlapping rectangles of one band into covering rectangles.
+
+        :return: List of covering rectangles, in which no two overlap.
+    """
+    boxes = []
+    for rectangle in sorted(rectangles, key=lambda r: (r.row_start, r.col_start)):
+        # Absorb all boxes overlapping the (growing) rectangle
+        merged = True
+        while merged:
+            merged = False
+            for n, box in enumerate(boxes):
+                if _overlap(box, rectangle):
+                    rectangle = Region(rectangle.band,
+                                       min(box.row_start, rectangle.row_start),
+                                       max(box.row_stop, rectangle.row_stop),
+                                       min(box.col_start, rectangle.col_start),
+                                       max(box.col_stop, rectangle.col_stop))
+                    del boxes[n]
+                    merged = True
+                    break
+        boxes.append(rectangle)
+    return boxes
+
+## =============================================================================
+##
+##  Class definition
+##
+## =============================================================================
+
+class RegionExtractor (object):
+    """ Extraction of a fixed set of regions from the bands of a frame.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self, regions):
+        """ Initialize object's internal data; the covering rectangles are
+            computed once and reused for every extraction.
+
+            :param regions: Sequence of tuples (band, selection), where the
+                            selection of (rows, columns) is given either as
+                            slices or as corners [(start,stop), (start,stop)].
+        """
+        """ Regions, in the order in which they are returned. """
+        self.regions = [_rectangle(band, selection) for band, selection in regions]
+        bands = {}
+        for region in self.regions:
+            bands.setdefault(region.band, []).append(region)
+        """ Covering rectangles, each read once per extraction. """
+        self.boxes = []
+        for band in sorted(bands):
+            self.boxes.extend(_merge(bands[band]))
+        """ Per region: index of the covering rectangle and slices of the
+            region within it. """
+        self._members = []
+        for region in self.regions:
+            for n, box in enumerate(self.boxes):
+                if box.band == region.band and _overlap(box, region):
+                    break
+            self._members.append((n, (slice(region.row_start-box.row_start,
+                                            region.row_stop-box.row_start),
+                                      slice(region.col_start-box.col_start,
+                                            region.col_stop-box.col_start))))
+        """ Shape (rows, columns) of the padded stack. """
+        self.shape = (max(region.row_stop-region.row_start for region in self.regions),
+                      max(region.col_stop-region.col_start for region in self.regions))
+
+    ##__________________________________________________________________________
+    ##                                                               from_bands
+
+    @classmethod
+    def from_bands(cls, regions):
+        """ Extractor for regions given per band.
+
+            :param regions: Dictionary band -> selection of a region or list
+                            of selections of regions, given as slices or as
+                            corners, e.g. the `selected_regions`
+                            {1: [(10,90),(200,310)], ...}.
+        """
+        items = []
+        for band in sorted(regions):
+            selections = regions[band]
+            if len(selections) == 2 and all(isinstance(item, slice) or
+                                            all(np.isscalar(value) for value in item)
+                                            for item in selections):
+                selections = [selections]
+            items.extend((band, selection) for selection in selections)
+        return cls(items)
+
+    ##__________________________________________________________________________
+    ##                                                                      read
+
+    def read(self,
+             source,
+             frames=None):
+        """ Read the covering rectangles.
+
+            :param source: Dictionary band -> array-like of shape (rows,
+                           columns) or (frames, rows, columns), e.g. NumPy
+                           arrays or HDF5 datasets.
+            :param frames: Index of the frames to read from frame stacks; by
+                           default all leading axes are read.
+            :return: List of arrays, one per covering rectangle.
+        """
+        prefix = (Ellipsis,) if frames is None else (frames,)
+        return [np.asarray(source[box.band][prefix + (slice(box.row_start, box.row_stop),
+                                                      slice(box.col_start, box.col_stop))])
+                for box in self.boxes]
+
+    ##__________________________________________________________________________
+    ##                                                                   extract
+
+    def extract(self,
+                source,
+                frames=None):
+        """ Ragged extraction: list of arrays, one per region, which are views
+            into the covering rectangles. See `read` for the parameters.
+        """
+        blocks = self.read(source, frames)
+        return [blocks[n][(Ellipsis,) + index] for n, index in self._members]
+
+    ##__________________________________________________________________________
+    ##                                                                     stack
+
+    def stack(self,
+              source,
+              frames=None,
+              fill=0.0):
+        """ Padded extraction of all regions. See `read` for the parameters.
+
+            :param fill: Value of the padding.
+            :return: Tuple (values, mask), where `values` has the shape
+                     (..., regions, rows, columns) with the regions aligned to
+                     the first row and column, and `mask` (regions, rows,
+                     columns) is `True` for the padding.
+        """
+        blocks = self.read(source, frames)
+        leading = blocks[0].shape[:-2]
+        values = np.empty(leading + (len(self.regions),) + self.shape,
+                          dtype=np.result_type(*blocks))
+        values.fill(fill)
+        mask = np.ones((len(self.regions),) + self.shape, dtype=bool)
+        for m, (n, index) in enumerate(self._members):
+            block = blocks[n][(Ellipsis,) + index]
+            rows, columns = block.shape[-2:]
+            values[..., m, :rows, :columns] = block
+            mask[m, :rows, :columns] = False
+        return values, mask
+
+    ##__________________________________________________________________________
+    ##                                                                statistics
+
+    def statistics(self,
+                   source,
+                   frames=None,
+                   mask=None):
+        """ Count, mean, standard deviation, minimum, median and maximum of the
+            pixels of each region; see `read` for the parameters.
+
+            :param mask: Optional dictionary band -> pixel quality mask of
+                         shape (rows, columns), non-zero for pixels to be
+                         excluded.
+            :return: Dictionary with arrays of shape (..., regions); the count
+                     has shape (regions,). Regions without valid pixels yield
+                     NaN.
+        """
+        parts = self.extract(source, frames)
+        if mask is None:
+            parts = [part.reshape(part.shape[:-2] + (-1,)) for part in parts]
+        else:
+            quality = self.extract(mask)
+            parts = [part[..., quality[m] == 0] for m, part in enumerate(parts)]
+        count  = np.array([part.shape[-1] for part in parts])
+        result = {'count' : count}
+        for key in ['mean', 'std', 'min', 'median', 'max']:
+            result[key] = np.full(parts[0].shape[:-1] + (len(parts),), np.nan)
+        valid = np.flatnonzero(count)
+        if not len(valid):
+            return result
+
+        # Segmented reductions over the concatenated pixels of all regions, in
+        # double precision, so that integer data neither wraps nor truncates
+        values  = np.concatenate([parts[m] for m in valid], axis=-1).astype(np.float64,
+                                                                            copy=False)
+        sizes   = count[valid]
+        offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        mean    = np.add.reduceat(values, offsets, axis=-1, dtype=np.float64)/sizes
+        result['mean'][..., valid] = mean
+        result['min'][..., valid]  = np.minimum.reduceat(values, offsets, axis=-1)
+        result['max'][..., valid]  = np.maximum.reduceat(values, offsets, axis=-1)
+        values -= np.repeat(mean, sizes, axis=-1)
+        result['std'][..., valid]  = np.sqrt(np.add.reduceat(values*values, offsets, axis=-1)/sizes)
+
+        # Median by partial sorting of each region
+        for m in valid:
+            k = count[m]//2
+            if count[m] % 2:
+                median = np.partition(parts[m], k, axis=-1)[..., k]
+            else:
+                part   = np.partition(parts[m], (k-1, k), axis=-1)
+                median = 0.5*(part[..., k-1].astype(np.float64)+part[..., k])
+            result['median'][..., m] = median
+        return result
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import os
+    import shutil
+    import tempfile
+    import time
+    import h5py
+
+    np.random.seed(0)
+    shape = (1024, 1000)
+    bands = dict((band, np.random.rand(4, *shape)) for band in (1, 2, 3, 4))
+
+    ## Regions of test_dictionaries.py
+    selected_regions = {1: [(10,90),(200,310)],
+                        2: [(20,90),(200,310)],
+                        3: [(30,90),(200,310)],
+                        4: [(40,90),(200,310)]}
+    extractor = RegionExtractor.from_bands(selected_regions)
+    for region, values in zip(extractor.regions, extractor.extract(bands, frames=0)):
+        print ("-- %s -> %s" % (region, values.shape))
+
+    ## Hundreds of (partly overlapping) regions per band
+    nofRegions = 400
+    regions = []
+    for n in range(nofRegions):
+        band = 1 + n % 4
+        row  = np.random.randint(0, shape[0]-64)
+        col  = np.random.randint(0, shape[1]-64)
+        size = np.random.randint(8, 64, 2)
+        regions.append((band, [slice(row, row+size[0]), slice(col, col+size[1])]))
+    start = time.time()
+    extractor = RegionExtractor(regions)
+    print ("\n[%d regions] %d covering rectangles, setup %.4f s"
+           % (nofRegions, len(extractor.boxes), time.time()-start))
+
+    ## One region at a time, as before
+    functions = {'mean' : np.mean, 'std' : np.std, 'min' : np.min,
+                 'median' : np.median, 'max' : np.max}
+    def one_at_a_time(source, frame):
+        result = dict((key, []) for key in functions)
+        for band, selection in regions:
+            values = np.asarray(source[band][(frame,) + tuple(selection)])
+            for key, function in functions.items():
+                result[key].append(function(values))
+        return result
+
+    reference = one_at_a_time(bands, 0)
+    result    = extractor.statistics(bands, frames=0)
+    for key in functions:
+        np.testing.assert_allclose(result[key], reference[key], rtol=1e-12)
+    stacked = extractor.statistics(bands)
+    np.testing.assert_allclose(stacked['median'][0], result['median'], rtol=1e-12)
+
+    ## Pixel quality mask excluding every other column
+    quality = dict((band, np.zeros(shape, int)) for band in bands)
+    for band in bands:
+        quality[band][:, ::2] = 1
+    masked = extractor.statistics(bands, frames=0, mask=quality)
+    band, selection = regions[0]
+    values = bands[band][(0,) + tuple(selection)][:, quality[band][tuple(selection)][0] == 0]
+    np.testing.assert_allclose(masked['median'][0], np.median(values), rtol=1e-12)
+    ## Integer band data, e.g. raw uint16 counts, and regions given as slices
+    counts  = dict((band, (65535*bands[band][0]).astype(np.uint16)) for band in bands)
+    integer = extractor.statistics(counts)
+    for m, (band, selection) in enumerate(regions):
+        values = counts[band][tuple(selection)]
+        for key, function in functions.items():
+            np.testing.assert_allclose(integer[key][m], function(values.astype(float)),
+                                       rtol=1e-12)
+    sliced = RegionExtractor.from_bands({1: [slice(10, 90), slice(200, 310)],
+                                         2: [[slice(20, 90), slice(200, 310)],
+                                             [(0, 5), (0, 5)]]})
+    assert [region.band for region in sliced.regions] == [1, 2, 2]
+
+    for m, values in enumerate(extractor.extract(bands, frames=0)):
+        np.testing.assert_array_equal(values, bands[regions[m][0]][(0,) + tuple(regions[m][1])])
+
+    directory = tempfile.mkdtemp()
+    filename  = os.path.join(directory, 'bands.h5')
+    with h5py.File(filename, 'w') as f:
+        for band in bands:
+            f.create_dataset('band_%d/signal' % band, data=bands[band], chunks=(1, 128, 128))
+    with h5py.File(filename, 'r') as f:
+        datasets = dict((band, f['band_%d/signal' % band]) for band in bands)
+        np.testing.assert_array_equal(extractor.stack(datasets, frames=0)[0],
+                                      extractor.stack(bands, frames=0)[0])
+        print ("\n%-32s %12s %12s" % ("statistics of all regions", "memory [s]", "HDF5 [s]"))
+        for name, function in [("one region at a time", one_at_a_time),
+                               ("batched extraction",
+                                lambda source, frame: extractor.statistics(source, frames=frame))]:
+            timing = []
+            for source in [bands, datasets]:
+                start = time.time()
+                for frame in range(4):
+                    function(source, frame)
+                timing.append((time.time()-start)/4)
+            print ("%-32s %12.4f %12.4f" % (name, timing[0], timing[1]))
+    shutil.rmtree(directory)
@@ -0,0 +1,450 @@
+""" Re-gridding of data given on the (row,wavelength) mesh onto a regular grid
+    or back onto the detector grid (PRNU step 6).
+
+    The mesh derived from the spectral calibration map is not an arbitrary set
+    of scattered points: every detector row is a monotone 1D curve in
+    wavelength. Re-gridding therefore reduces to 1D interpolation along each
+    row, which is carried out for all rows at once by means of a single
+    `searchsorted` call on rows shifted into disjoint intervals. Genuinely
+    irregular meshes are handled by `scipy.interpolate.griddata`.
+
+    Since the mesh geometry is fixed for an instrument, the interpolation can
+    also be precomputed once as a sparse matrix (`RegridOperator`), reducing the
+    re-gridding of each further frame to a sparse matrix-vector product.
+"""
+
+import os
+
+import numpy as np
+import scipy.sparse as sparse
+from scipy.interpolate import griddata
+from scipy.spatial import Delaunay
+
+from cache import LRUCache, array_digest, atomic_write
+
+## In-memory cache of re-gridding operators
+_operator_cache = LRUCache(maxsize=8)
+
+## =============================================================================
+##
+##  Helper functions
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                 row_monotonic
+
+def row_monotonic(x):
+    """ Check whether all rows of the mesh coordinates are strictly monotone.
+
+        :param x: Mesh coordinates, shape (nofRows, nofPoints).
+        :return: +1 if all rows are strictly increasing, -1 if all rows are
+                 strictly decreasing, 0 otherwise.
+    """
+    if x.shape[1] < 2:
+        return 0
+    diff = np.diff(x, axis=1)
+    if np.all(diff > 0):
+        return 1
+    if np.all(diff < 0):
+        return -1
+    return 0
+
+##______________________________________________________________________________
+##                                                                   common_grid
+
+def common_grid(x,
+                size):
+    """ Regular grid spanning the coordinate range covered by all rows.
+
+        :param x: Mesh coordinates, shape (nofRows, nofPoints).
+        :param size: Number of grid points.
+    """
+    lower = np.max(np.min(x, axis=1))
+    upper = np.min(np.max(x, axis=1))
+    if lower > upper:
+        raise ValueError("Rows of the mesh do not cover a common range!")
+    return np.linspace(lower, upper, size)
+
+##______________________________________________________________________________
+##                                                     row_interpolation_weights
+
+def row_interpolation_weights(x,
+                              xt):
+    """ Indices and weights for linear interpolation along each row.
+
+        :param x: Mesh coordinates, strictly increasing along each row, shape
+                  (nofRows, nofPoints).
+        :param xt: Target coordinates, shape (nofRows, nofTargets).
+        :return: Tuple (index, weight, outside): `index` holds the position of
+                 the left neighbour of each target within the flattened mesh,
+                 `weight` the weight of the right neighbour, and `outside`
+                 flags targets beyond the range of their row.
+    """
+    nofRows, nofPoints = x.shape
+    # Shift the rows into disjoint intervals, such that a single search on the
+    # flattened coordinates finds the neighbours within the respective row
+    lower  = np.minimum(x[:, 0], xt.min(axis=1))
+    upper  = np.maximum(x[:, -1], xt.max(axis=1))
+    span   = np.max(upper-lower) + 1.0
+    offset = (np.arange(nofRows)*span - lower)[:, np.newaxis]
+    shifted = (x + offset).ravel()
+    index   = np.searchsorted(shifted, (xt + offset).ravel(), side='right')
+    index   = index.reshape(xt.shape) - 1
+
+    # Restrict to the nodes of the row, then compute the weights from the
+    # original (unshifted) coordinates
+    first = (np.arange(nofRows)*nofPoints)[:, np.newaxis]
+    index = np.clip(index, first, first+nofPoints-2)
+    x_flat = x.ravel()
+    x_left = x_flat[index]
+    weight = (xt - x_left)/(x_flat[index+1] - x_left)
+    outside = (xt < x[:, :1]) | (xt > x[:, -1:])
+    np.clip(weight, 0.0, 1.0, out=weight)
+    return index, weight, outside
+
+## =============================================================================
+##
+##  Re-gridding
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                   regrid_rows
+
+def regrid_rows(x,
+                values,
+                xt,
+                rows=None,
+                method='auto',
+                fill_value=np.nan):
+    """ Re-grid values given on the mesh onto target coordinates per row.
+
+        :param x: Mesh coordinates (e.g. wavelength), shape (nofRows, nofPoints).
+        :param values: Values at the mesh points, same shape as `x`.
+        :param xt: Target coordinates, either 1D (same for all rows) or of shape
+                   (nofRows, nofTargets).
+        :param rows: Row coordinates of the mesh, used by the 'griddata' method;
+                     defaults to the row number.
+        :param method: 'rows' (per-row linear interpolation, requires rows that
+                       are monotone in `x`), 'griddata' (triangulation based
+                       linear interpolation) or 'auto'.
+        :param fill_value: Value for targets outside the range of the mesh.
+        :return: Array of shape (nofRows, nofTargets).
+    """
+    x      = np.asarray(x, dtype=float)
+    values = np.asarray(values, dtype=float)
+    xt     = np.asarray(xt, dtype=float)
+    if xt.ndim == 1:
+        xt = np.broadcast_to(xt, (x.shape[0], xt.size))
+    if x.shape != values.shape or xt.shape[0] != x.shape[0]:
+        raise ValueError("Shapes of mesh %s, values %s and targets %s do not match"
+                         % (x.shape, values.shape, xt.shape))
+
+    direction = row_monotonic(x)
+    if method == 'auto':
+        method = 'rows' if direction != 0 else 'griddata'
+    if method == 'rows':
+        if direction == 0:
+            raise ValueError("Mesh rows are not monotone, use method='griddata'!")
+        if direction < 0:
+            x      = x[:, ::-1]
+            values = values[:, ::-1]
+        return _regrid_rows(x, values, xt, fill_value)
+    elif method == 'griddata':
+        if rows is None:
+            rows = np.arange(x.shape[0])
+        return regrid_griddata(rows, x, values, xt, fill_value=fill_value)
+    raise ValueError("Unknown re-gridding method '%s'" % method)
+
+##______________________________________________________________________________
+##                                                                  _regrid_rows
+
+def _regrid_rows(x,
+                 values,
+                 xt,
+                 fill_value):
+    """ Per-row linear interpolation for rows increasing in `x`. """
+    index, weight, outside = row_interpolation_weights(x, xt)
+    values_flat = values.ravel()
+    left    = values_flat[index]
+    right   = values_flat[index+1]
+    result  = left*(1.0-weight)
+    result += right*weight
+    # Targets on a node take its value, even if the other neighbour is NaN
+    np.copyto(result, left, where=(weight == 0.0))
+    np.copyto(result, right, where=(weight == 1.0))
+    result[outside] = fill_value
+    return result
+
+##______________________________________________________________________________
+##                                                               regrid_griddata
+
+def regrid_griddata(rows,
+                    x,
+                    values,
+                    xt,
+                    fill_value=np.nan):
+    """ Re-grid values by means of a Delaunay triangulation of the full mesh.
+
+        :param rows: Row coordinate of each mesh row, shape (nofRows,).
+        :param x: Mesh coordinates, shape (nofRows, nofPoints).
+        :param values: Values at the mesh points, same shape as `x`.
+        :param xt: Target coordinates, shape (nofRows, nofTargets).
+        :param fill_value: Value for targets outside the convex hull.
+    """
+    rows = np.asarray(rows, dtype=float)[:, np.newaxis]
+    points = (np.broadcast_to(rows, x.shape).ravel(), x.ravel())
+    target = (np.broadcast_to(rows, xt.shape), xt)
+    return griddata(points, values.ravel(), target, method='linear',
+                    fill_value=fill_value)
+
+## =============================================================================
+##
+##  Precomputed re-gridding operator
+##
+## =============================================================================
+
+class RegridOperator (object):
+    """ Linear re-gridding from a fixed mesh onto fixed target coordinates,
+        stored as sparse matrix with the interpolation weights.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self, matrix, outside, shape):
+        """ Initialize object's internal data.
+
+            :param matrix: Sparse (CSR) matrix mapping the flattened mesh values
+                           onto the flattened target values.
+            :param outside: Boolean array flagging targets outside the mesh.
+            :param shape: Shape (nofRows, nofTargets) of the re-gridded data.
+        """
+        """ Sparse matrix with the interpolation weights. """
+        self.matrix = matrix
+        """ Targets outside the range of the mesh. """
+        self.outside = np.asarray(outside, dtype=bool).reshape(shape)
+        """ Shape of the re-gridded data. """
+        self.shape = tuple(shape)
+
+    ##__________________________________________________________________________
+    ##                                                                  __call__
+
+    def __call__(self, values, fill_value=np.nan):
+        """ Re-grid values given on the mesh.
+
+            :param values: Values at the mesh points, either for a single frame
+                           (shape of the mesh) or for a stack of frames, with
+                           the frame index along the first axis.
+            :param fill_value: Value for targets outside the range of the mesh.
+        """
+        values = np.asarray(values, dtype=float)
+        nofPoints = self.matrix.shape[1]
+        if values.ndim <= 2:
+            result = self.matrix.dot(values.ravel()).reshape(self.shape)
+        else:
+            frames = values.reshape(-1, nofPoints)
+            result = self.matrix.dot(frames.T).T.reshape((-1,) + self.shape)
+        result[..., self.outside] = fill_value
+        return result
+
+    ##__________________________________________________________________________
+    ##                                                                      save
+
+    def save(self, filename):
+        """ Write the operator to a NumPy `.npz` file. """
+        matrix = self.matrix
+        def write(tmpname):
+            with open(tmpname, 'wb') as f:
+                np.savez(f,
+                         data=matrix.data,
+                         indices=matrix.indices,
+                         indptr=matrix.indptr,
+                         matrix_shape=matrix.shape,
+                         outside=self.outside,
+                         shape=self.shape)
+        atomic_write(filename, write)
+
+    ##__________________________________________________________________________
+    ##                                                                      load
+
+    @classmethod
+    def load(cls, filename):
+        """ Read an operator written by `save`. """
+        f = np.load(filename)
+        matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                                   shape=tuple(f['matrix_shape']))
+        return cls(matrix, f['outside'], tuple(f['shape']))
+
+##______________________________________________________________________________
+##                                                              _operator_rows
+
+def _operator_rows(x,
+                   xt):
+    """ Sparse operator for per-row linear interpolation. """
+    direction = row_monotonic(x)
+    if direction == 0:
+        raise ValueError("Mesh rows are not monotone, use method='griddata'!")
+    nofRows, nofPoints = x.shape
+    if direction < 0:
+        x = x[:, ::-1]
+    index, weight, outside = row_interpolation_weights(x, xt)
+    if direction < 0:
+        # Map indices of the reversed rows back onto the original mesh
+        start = (np.arange(nofRows)*nofPoints)[:, np.newaxis]
+        index = 2*start + nofPoints-1 - index
+        columns = np.dstack([index, index-1])
+    else:
+        columns = np.dstack([index, index+1])
+    weights = np.dstack([1.0-weight, weight])
+    weights[outside] = 0.0
+    nofTargets = xt.size
+    matrix = sparse.csr_matrix((weights.ravel(),
+                                columns.ravel(),
+                                np.arange(0, 2*nofTargets+1, 2)),
+                               shape=(nofTargets, x.size))
+    # Targets on a node do not depend on the other neighbour (which may be NaN)
+    matrix.eliminate_zeros()
+    return matrix, outside
+
+##______________________________________________________________________________
+##                                                          _operator_griddata
+
+def _operator_griddata(rows,
+                       x,
+                       xt):
+    """ Sparse operator for linear interpolation on a Delaunay triangulation;
+        the barycentric weights of the enclosing triangles are computed once.
+    """
+    rows   = np.asarray(rows, dtype=float)[:, np.newaxis]
+    points = np.column_stack([np.broadcast_to(rows, x.shape).ravel(), x.ravel()])
+    target = np.column_stack([np.broadcast_to(rows, xt.shape).ravel(), xt.ravel()])
+    triangulation = Delaunay(points)
+    simplex   = triangulation.find_simplex(target)
+    outside   = simplex < 0
+    transform = triangulation.transform[simplex]
+    delta     = target - transform[:, 2]
+    weights   = np.einsum('ijk,ik->ij', transform[:, :2], delta)
+    weights   = np.column_stack([weights, 1.0-weights.sum(axis=1)])
+    weights[outside] = 0.0
+    vertices  = triangulation.simplices[simplex]
+    matrix = sparse.csr_matrix((weights.ravel(),
+                                vertices.ravel(),
+                                np.arange(0, 3*len(target)+1, 3)),
+                               shape=(len(target), points.shape[0]))
+    matrix.eliminate_zeros()
+    return matrix, outside
+
+##______________________________________________________________________________
+##                                                               regrid_operator
+
+def regrid_operator(x,
+                    xt,
+                    rows=None,
+                    method='auto',
+                    cache_dir=None):
+    """ Retrieve the re-gridding operator for a mesh and target coordinates,
+        computing it only if it is neither cached in memory nor on disk.
+
+        :param x: Mesh coordinates (e.g. wavelength), shape (nofRows, nofPoints).
+        :param xt: Target coordinates, either 1D (same for all rows) or of shape
+                   (nofRows, nofTargets).
+        :param rows: Row coordinates of the mesh; defaults to the row number.
+        :param method: 'rows', 'griddata' or 'auto', see `regrid_rows`.
+        :param cache_dir: Directory for persisted operators, which are keyed by
+                          a hash of the mesh and target coordinates; `None`
+                          disables the on-disk cache.
+    """
+    x  = np.asarray(x, dtype=float)
+    xt = np.asarray(xt, dtype=float)
+    if xt.ndim == 1:
+        xt = np.broadcast_to(xt, (x.shape[0], xt.size))
+    if rows is None:
+        rows = np.arange(x.shape[0])
+    if method == 'auto':
+        method = 'rows' if row_monotonic(x) != 0 else 'griddata'
+    if method not in ('rows', 'griddata'):
+        raise ValueError("Unknown re-gridding method '%s'" % method)
+
+    key = method + '_' + array_digest(x, xt, np.asarray(rows, dtype=float))
+    operator = _operator_cache.get(key)
+    if operator is not None:
+        return operator
+
+    filename = None
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, 'regrid_' + key + '.npz')
+        if os.path.isfile(filename):
+            operator = RegridOperator.load(filename)
+
+    if operator is None:
+        if method == 'rows':
+            matrix, outside = _operator_rows(x, xt)
+        else:
+            matrix, outside = _operator_griddata(rows, x, xt)
+        operator = RegridOperator(matrix, outside, xt.shape)
+        if filename is not None:
+            operator.save(filename)
+
+    _operator_cache.put(key, operator)
+    return operator
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import time
+    from scm import spectral_calibration_map
+
+    image_area = (1024, 1024)
+    index_row  = np.arange(image_area[0])
+    wavelength = spectral_calibration_map(image_area)
+    rows, cols = np.indices(image_area)
+    values     = np.sin(wavelength/500.0) + 0.01*rows
+    target     = common_grid(wavelength, image_area[1])
+
+    ## Targets on a node keep the node value next to NaN (bad) pixels
+    x = np.arange(10.0)[np.newaxis]
+    v = np.arange(10.0)[np.newaxis]
+    v[0, 5] = np.nan
+    xt = np.array([[0.0, 4.0, 4.5, 6.0, 9.0]])
+    expected = np.interp(xt[0], x[0], v[0])
+    np.testing.assert_array_equal(regrid_rows(x, v, xt, method='rows')[0], expected)
+    np.testing.assert_array_equal(regrid_operator(x, xt, method='rows')(v)[0], expected)
+    np.testing.assert_array_equal(regrid_rows(x[:, ::-1], v[:, ::-1], xt, method='rows')[0],
+                                  expected)
+    np.testing.assert_array_equal(regrid_operator(x[:, ::-1], xt, method='rows')(v[:, ::-1])[0],
+                                  expected)
+
+    print ("\n[Re-gridding %d x %d mesh]\n" % image_area)
+
+    start = time.time()
+    result_rows = regrid_rows(wavelength, values, target, method='rows')
+    time_rows = time.time()-start
+    print ("-- Time per-row interpolation ...... = %.4f s" % time_rows)
+
+    start = time.time()
+    result_griddata = regrid_rows(wavelength, values, target, rows=index_row,
+                                  method='griddata')
+    time_griddata = time.time()-start
+    print ("-- Time griddata interpolation ..... = %.4f s" % time_griddata)
+    print ("-- Speed-up ........................ = %.0fx" % (time_griddata/time_rows))
+
+    valid = np.isfinite(result_rows) & np.isfinite(result_griddata)
+    print ("-- Max. difference ................. = %g"
+           % np.max(np.abs(result_rows[valid]-result_griddata[valid])))
+
+    ## Precomputed operators: one-off setup, then cost per frame
+    for method in ['rows', 'griddata']:
+        start = time.time()
+        operator = regrid_operator(wavelength, target, rows=index_row, method=method)
+        time_setup = time.time()-start
+        start = time.time()
+        result = operator(values)
+        time_frame = time.time()-start
+        reference = result_rows if method == 'rows' else result_griddata
+        valid = np.isfinite(reference)
+        print ("-- Operator %-8s setup / frame .. = %.4f s / %.4f s (max. diff. %g)"
+               % (method, time_setup, time_frame,
+                  np.max(np.abs(result[valid]-reference[valid]))))
@@ -1,13 +1,121 @@
 """ Reporting for the PRNU algorithm: generation of diagnostic plots for each
     of the individual processing steps to inspect the performance and accuracy.
+
+    The plots of the individual steps are independent of each other and can be
+    generated in parallel by a pool of worker processes using the (headless)
+    Agg backend, optionally in the background while the caller continues.
 """
 
+import multiprocessing
+import os
+import sys
+
 import numpy as np
 from matplotlib.backends.backend_pdf import PdfPages
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib import cm
 import matplotlib.pyplot as plt
+from matplotlib import font_manager
 from data import Data
+from mesh import mesh_columns
+import maskedstats
+
+## Data object and report of the worker processes, see `_init_worker`
+_worker_state = {}
+
+## =============================================================================
+##
+##  Worker processes
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                                  _init_worker
+
+def _init_worker(report,
+                 data,
+                 quiet):
+    """ Set up a worker process generating report plots. The data object is
+        inherited from the parent process when the pool is started, which also
+        makes it a snapshot of the data at that time.
+
+        :param report: `ReportPRNU` object generating the plots.
+        :param data: Data object with the results of the PRNU calculation.
+        :param quiet: Suppress the progress output of the worker?
+    """
+    plt.switch_backend('Agg')
+    # Fonts opened by the parent share their file offsets with the forked
+    # workers, so that concurrent glyph loading fails; open them anew (the
+    # font cache is internal to matplotlib and may not exist)
+    get_font = getattr(font_manager, '_get_font', None)
+    if hasattr(get_font, 'cache_clear'):
+        get_font.cache_clear()
+    _worker_state['report'] = report
+    _worker_state['data']   = data
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+
+##______________________________________________________________________________
+##                                                                  _report_step
+
+def _report_step(task):
+    """ Generate the plots of one step.
+
+        :param task: Tuple (step, outfile).
+        :return: Name of the written file.
+    """
+    step, outfile = task
+    getattr(_worker_state['report'], 'step%d' % step)(_worker_state['data'],
+                                                      outfile=outfile)
+    return outfile
+
+## =============================================================================
+##
+##  Report jobs
+##
+## =============================================================================
+
+class ReportJob (object):
+    """ Handle for a (possibly running) report generation.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self, files, result=None, pool=None):
+        """ Initialize object's internal data.
+
+            :param files: Names of the files to be written.
+            :param result: `AsyncResult` of the worker pool, `None` if the
+                           report has been generated already.
+            :param pool: Worker pool, joined once the report is complete.
+        """
+        """ Names of the files to be written. """
+        self.files = files
+        self._result = result
+        self._pool = pool
+
+    ##__________________________________________________________________________
+    ##                                                                     ready
+
+    def ready(self):
+        """ Has the report generation finished? """
+        return self._result is None or self._result.ready()
+
+    ##__________________________________________________________________________
+    ##                                                                      wait
+
+    def wait(self):
+        """ Wait for the report generation to finish, re-raising any error of
+            the worker processes, and return the names of the written files.
+        """
+        if self._result is not None:
+            try:
+                self._result.get()
+            finally:
+                self._pool.join()
+                self._result = None
+        return self.files
 
 ## =============================================================================
 ##
@@ -19,12 +127,154 @@ class ReportPRNU (object):
 
     def __init__(self, *args, **kwargs):
         """ Initialize object's internal data.
+
+            :param decimate: Reduce large arrays for plotting (optional keyword
+                             argument, default `True`): images are sub-sampled
+                             to display resolution, histograms are computed
+                             without flattened copies and scatter plots with
+                             many points are replaced by density maps. With
+                             `False` all data points are plotted.
         """
 
-        """ Enable/displable generation of 3D plots. """
+        """ Enable/disable generation of 3D plots. """
         self._with3D = False
-        """ Enable/displable generation of scatter plots. """
+        """ Enable/disable generation of scatter plots. """
         self._withScatter = True
+        """ Reduce large arrays for plotting? """
+        self._decimate = kwargs.get('decimate', True)
+        """ Maximum number of image pixels (rows, columns) to plot. """
+        self._maxImageShape = (512, 512)
+        """ Maximum number of points drawn as scatter plot; above this number a
+            density map is plotted instead. """
+        self._maxScatterPoints = 10000
+        """ Number of bins of histograms and density maps. """
+        self._bins = 100
+
+    ##__________________________________________________________________________
+    ##                                                                       run
+
+    def run (self,
+             data,
+             steps=range(1, 9),
+             directory='.',
+             nofWorkers=1,
+             background=False,
+             quiet=True):
+        """ Generate the diagnostics plots of several steps.
+
+            :param data: Data object with (temporary) data from the PRNU CKD
+                         calculation algorithm.
+            :param steps: Numbers of the steps to report on.
+            :param directory: Directory to which the PDF files are written.
+            :param nofWorkers: Number of worker processes, `None` for the
+                               number of CPUs. With a single worker and
+                               `background=False` (default) the plots are
+                               generated in the calling process.
+            :param background: Return immediately, while the plots are
+                               generated by the worker processes; these work on
+                               a snapshot of `data`, so the caller may go on
+                               modifying it.
+            :param quiet: Suppress the progress output of the worker processes?
+            :return: `ReportJob`; call its `wait` method to wait for completion.
+        """
+        if nofWorkers is None:
+            nofWorkers = multiprocessing.cpu_count()
+        tasks = [(step, os.path.join(directory, 'plots_prnu_step%d.pdf' % step))
+                 for step in steps]
+        files = [outfile for step, outfile in tasks]
+        if nofWorkers == 1 and not background:
+            for step, outfile in tasks:
+                getattr(self, 'step%d' % step)(data, outfile=outfile)
+            return ReportJob(files)
+        pool = multiprocessing.Pool(min(nofWorkers, len(tasks)),
+                                    initializer=_init_worker,
+                                    initargs=(self, data, quiet))
+        result = pool.map_async(_report_step, tasks, chunksize=1)
+        pool.close()
+        job = ReportJob(files, result, pool)
+        if not background:
+            job.wait()
+        return job
+
+    ##__________________________________________________________________________
+    ##                                                                 plotImage
+
+    def plotImage (self, image):
+        """ Show an image; in decimating mode the image is sub-sampled by
+            strides (a view, no copy) down to display resolution, keeping the
+            axes in pixel coordinates of the full image.
+        """
+        if not self._decimate:
+            return plt.imshow(image)
+        nofRows, nofCols = image.shape
+        step = (max(1, -(-nofRows//self._maxImageShape[0])),
+                max(1, -(-nofCols//self._maxImageShape[1])))
+        return plt.imshow(image[::step[0], ::step[1]],
+                          extent=(-0.5, nofCols-0.5, nofRows-0.5, -0.5),
+                          interpolation='nearest',
+                          rasterized=True)
+
+    ##__________________________________________________________________________
+    ##                                                             plotHistogram
+
+    def plotHistogram (self, values, color='g'):
+        """ Plot the normalized histogram of the finite entries of an array.
+
+            In decimating mode the histogram is computed by `np.histogram` on
+            the array itself and only the bin counts are passed on to
+            matplotlib, rather than a flattened copy of all values.
+        """
+        if not self._decimate:
+            return plt.hist(values[np.isfinite(values)], bins=self._bins,
+                            facecolor=color, normed=1)
+        # Limits over the finite values only; NaN and +-inf are not counted
+        with np.errstate(invalid='ignore'):
+            limits = (np.nanmin(values), np.nanmax(values))
+        if not np.all(np.isfinite(limits)):
+            finite = values[np.isfinite(values)]
+            if not finite.size:
+                return plt.hist([], bins=self._bins, facecolor=color)
+            limits = (finite.min(), finite.max())
+        with np.errstate(invalid='ignore'):
+            counts, edges = np.histogram(values, bins=self._bins, range=limits,
+                                         density=True)
+        return plt.hist(edges[:-1], bins=edges, weights=counts, facecolor=color)
+
+    ##__________________________________________________________________________
+    ##                                                               plotScatter
+
+    def plotScatter (self, x, y, **kwargs):
+        """ Scatter plot of points; in decimating mode, points beyond
+            `_maxScatterPoints` are shown as 2D density map and the markers of
+            smaller scatter plots are rasterized.
+        """
+        if not self._decimate:
+            return plt.scatter(x, y, **kwargs)
+        if len(x) <= self._maxScatterPoints:
+            return plt.scatter(x, y, rasterized=True, **kwargs)
+        counts, xedges, yedges = np.histogram2d(x, y, bins=self._bins)
+        mesh = plt.pcolormesh(xedges, yedges, np.ma.masked_equal(counts.T, 0),
+                              cmap='Greens', rasterized=True)
+        plt.colorbar(label="Number of points")
+        return mesh
+
+    ##__________________________________________________________________________
+    ##                                                           printStatistics
+
+    def printStatistics (self,
+                         label,
+                         values,
+                         mask):
+        """ Print statistics of the non-masked pixels of an array.
+
+            :param label: Description of the array.
+            :param values: Data array.
+            :param mask: Boolean mask, `True` for pixels to be ignored.
+        """
+        stats = maskedstats.statistics(values, mask)
+        print ("--- %s: %d valid pixels, mean = %g, std = %g, median = %g, range = [%g, %g]"
+               % (label, stats['count'], stats['mean'], stats['std'],
+                  stats['median'], stats['min'], stats['max']))
 
     ##__________________________________________________________________________
     ##                                                                     step1
@@ -40,13 +290,16 @@ class ReportPRNU (object):
                   will be written
         """
         print("--> Generating diagnostics plots for step 1 ...")
+        self.printStatistics("Detector signal selection",
+                             data._signal[tuple(data._selection)],
+                             np.asarray(data._pixel_quality, dtype=bool)[tuple(data._selection)])
 
         ## Create new PDF document
         pdf_pages = PdfPages(outfile)
 
         ## Detector signal for full CCD
         fig = plt.figure ()
-        plt.imshow(data._signal)
+        self.plotImage(data._signal)
         plt.title("Detector signal for full CCD")
         plt.xlabel("Column number")
         plt.ylabel("Row number")
@@ -56,14 +309,14 @@ class ReportPRNU (object):
 
         ## Histogram of detector signal for full CCD
         fig = plt.figure ()
-        plt.hist(data._signal.flatten(), bins=100, facecolor='g', normed=1)
+        self.plotHistogram(data._signal)
         plt.title("Distribution of detector signal values")
         pdf_pages.savefig(fig)
         plt.close()
 
         ## Plot detector signal for the selected region
         fig = plt.figure ()
-        plt.imshow(data._signal[data._selection])
+        self.plotImage(data._signal[tuple(data._selection)])
         plt.title("Detector signal selection")
         plt.xlabel("Column number")
         plt.ylabel("Row number")
@@ -91,7 +344,7 @@ class ReportPRNU (object):
 
         ## Row normalized detector signal
         fig = plt.figure ()
-        plt.imshow(data._signal_row_norm)
+        self.plotImage(data._signal_row_norm)
         plt.title("Row normalized detector signal")
         plt.xlabel("Column number")
         plt.ylabel("Row number")
@@ -101,17 +354,15 @@ class ReportPRNU (object):
 
         ## Histogram for row normalized detector signal
         fig = plt.figure ()
-        plt.hist(data._signal_row_norm.flatten(), bins=100, facecolor='g', normed=1)
+        self.plotHistogram(data._signal_row_norm)
         plt.title("Distribution of row normalized detector signal")
         pdf_pages.savefig(fig)
         plt.close()
 
         # Difference between input detector signal and row normalized detector signal
-        diff_signal = np.ndarray(shape=data._signal_row_norm.shape)
-        for nrow in range(len(data.index_row)):
-            diff_signal[nrow, :] = data._signal[data.index_row[nrow], :]-data._signal_row_norm[nrow, :]
+        diff_signal = data._signal[data.index_row]-data._signal_row_norm
         fig = plt.figure ()
-        plt.imshow(diff_signal)
+        self.plotImage(diff_signal)
         plt.title("Difference between input and row norm. signal")
         plt.xlabel("Column number")
         plt.ylabel("Row number")
@@ -121,7 +372,7 @@ class ReportPRNU (object):
 
         # Histogram for difference between input detector signal and row normalized detector signal
         fig = plt.figure ()
-        plt.hist(diff_signal.flatten(), bins=100, facecolor='b', normed=1)
+        self.plotHistogram(diff_signal, color='b')
         plt.title("Difference between input detector signal and row normalized detector signal")
         pdf_pages.savefig(fig)
         plt.close()
@@ -149,7 +400,7 @@ class ReportPRNU (object):
 
         ## Plot spectral calibration map
         fig = plt.figure ()
-        plt.imshow(data._scm)
+        self.plotImage(data._scm)
         plt.title("Spectral calibration map")
         plt.xlabel("Column number")
         plt.ylabel("Row number")
@@ -158,13 +409,14 @@ class ReportPRNU (object):
         plt.close()
 
         ## Plot (row,wavelength) mesh points derived from spectral calibration map
+        mesh_row, mesh_wavelength, mesh_signal = mesh_columns(data._signal_row_wavelength)
         if (self._withScatter):
             fig = plt.figure ()
-            plt.scatter(data._signal_row_wavelength[:,1],
-                        data._signal_row_wavelength[:,0],
-                        marker='x',
-                        c='g',
-                        s=2)
+            self.plotScatter(mesh_wavelength,
+                             mesh_row,
+                             marker='x',
+                             c='g',
+                             s=2)
             plt.xlabel("Wavelength (x)")
             plt.ylabel("Row (y)")
             plt.title("Scatter plot of (row,wavelength) mesh grid")
@@ -172,15 +424,33 @@ class ReportPRNU (object):
             plt.close()
 
         ## Plot detector signal as represented on an irregular (row,wavelength) mesh grid
-        if (self._withScatter):
+        if (self._withScatter and self._decimate and
+            len(mesh_signal) > self._maxScatterPoints):
+            # Mean signal within the bins of a (row,wavelength) density map
+            fig = plt.figure()
+            counts, xedges, yedges = np.histogram2d(mesh_wavelength, mesh_row,
+                                                    bins=self._bins)
+            total = np.histogram2d(mesh_wavelength, mesh_row,
+                                   bins=(xedges, yedges), weights=mesh_signal)[0]
+            with np.errstate(invalid='ignore'):
+                mean_signal = np.ma.masked_invalid(total.T/counts.T)
+            plt.pcolormesh(xedges, yedges, mean_signal, cmap='hot', rasterized=True)
+            plt.colorbar(label="Mean signal")
+            plt.xlabel("Wavelength (x)")
+            plt.ylabel("Row (y)")
+            plt.title("Signal as function of (row,wavelength)")
+            pdf_pages.savefig(fig)
+            plt.close()
+        elif (self._withScatter):
             fig = plt.figure()
             ax  = fig.gca(projection='3d')
             cmhot = plt.cm.get_cmap("hot")
-            ax.scatter(data._signal_row_wavelength[:,1],
-                       data._signal_row_wavelength[:,0],
-                       data._signal_row_wavelength[:,2],
-                       c=data._signal_row_wavelength[:,2],
-                       cmap=cmhot)
+            ax.scatter(mesh_wavelength,
+                       mesh_row,
+                       mesh_signal,
+                       c=mesh_signal,
+                       cmap=cmhot,
+                       rasterized=self._decimate)
             plt.xlabel("Wavelength (x)")
             plt.ylabel("Row (y)")
             plt.title("Signal as function of (row,wavelength)")
@@ -300,7 +570,7 @@ class ReportPRNU (object):
 
         # Smoothed signal after removal of high-frequency features
         fig = plt.figure ()
-        plt.imshow(data._signal_smooth)
+        self.plotImage(data._signal_smooth)
         plt.title("Smoothed signal after removal of high-frequency features")
         plt.xlabel("Column number")
         plt.ylabel("Row number")
@@ -325,13 +595,14 @@ class ReportPRNU (object):
                   will be written
         """
         print("--> Generating diagnostics plots for step 8 ...")
+        self.printStatistics("PRNU CKD", data._prnu, ~np.isfinite(data._prnu))
 
         # Create new PDF document
         pdf_pages = PdfPages(outfile)
 
         # PRNU map
         fig = plt.figure ()
-        plt.imshow(data._prnu)
+        self.plotImage(data._prnu)
         plt.title("PRNU CKD")
         plt.xlabel("Column number")
         plt.ylabel("Row number")
@@ -341,10 +612,73 @@ class ReportPRNU (object):
 
         # Histogram plot of PRNU
         fig = plt.figure ()
-        plt.hist(data._prnu.flatten(), bins=100, facecolor='g', normed=1)
+        self.plotHistogram(data._prnu)
         plt.title("Distribution of PRNU CKD values")
         pdf_pages.savefig(fig)
         plt.close()
 
         # Write the PDF document to the disk
         pdf_pages.close()
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import gc
+    import shutil
+    import tempfile
+    import time
+    from prnu import PRNU
+
+    prnu = PRNU()
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    prnu.calc_prnu()
+    sys.stdout = stdout
+    directory = tempfile.mkdtemp()
+
+    print ("\n[Full vs. decimated plotting for %d x %d frame]\n" % prnu._data.image_area)
+    print ("%6s %10s %10s %12s %12s" % ("step", "full [s]", "dec. [s]",
+                                         "full [kB]", "dec. [kB]"))
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    for step in [1, 2, 8]:
+        timing, size = {}, {}
+        for decimate in [False, True]:
+            outfile = os.path.join(directory, 'step%d_%s.pdf' % (step, decimate))
+            start = time.time()
+            getattr(ReportPRNU(decimate=decimate), 'step%d' % step)(prnu._data,
+                                                                    outfile=outfile)
+            timing[decimate] = time.time()-start
+            size[decimate]   = os.path.getsize(outfile)/1024.0
+        stdout.write("%6d %10.3f %10.3f %12.1f %12.1f\n"
+                     % (step, timing[False], timing[True], size[False], size[True]))
+    sys.stdout = stdout
+
+    ## Histograms of data with infinite or no finite values
+    for values in [np.array([[1.0, np.inf], [np.nan, 2.0]]),
+                   np.array([[np.nan, -np.inf]])]:
+        for decimate in [False, True]:
+            ReportPRNU(decimate=decimate).plotHistogram(values)
+            plt.close()
+
+    report = ReportPRNU()
+    print ("\n[Report generation for %d x %d frame]\n" % prnu._data.image_area)
+    print ("%8s %12s %12s %12s" % ("workers", "background", "return [s]", "done [s]"))
+    nofWorkers = max(2, multiprocessing.cpu_count())
+    for nofWorkers, background in [(1, False),
+                                   (nofWorkers, False),
+                                   (nofWorkers, True)]:
+        # Collect the garbage of the plots above, rather than within the timing
+        gc.collect()
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        start = time.time()
+        job = report.run(prnu._data,
+                         directory=directory,
+                         nofWorkers=nofWorkers,
+                         background=background)
+        returned = time.time()-start
+        files = job.wait()
+        done = time.time()-start
+        sys.stdout = stdout
+        print ("%8d %12s %12.3f %12.3f" % (nofWorkers, background, returned, done))
+        assert all(os.path.isfile(outfile) for outfile in files)
+    shutil.rmtree(directory)
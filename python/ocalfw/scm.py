@@ -0,0 +1,162 @@
+""" Spectral calibration map (SCM): mapping from detector (row,col) to
+    (row,wavelength) coordinates.
+
+    The map is evaluated in closed form over the full pixel grid; since it only
+    depends on the instrument geometry, generated maps are kept in an LRU cache
+    and can optionally be persisted to disk (NumPy `.npy` or HDF5 files), such
+    that repeated calibration runs load the map instead of recomputing it.
+"""
+
+import os
+
+import numpy as np
+
+from cache import LRUCache, atomic_write, key_digest, readonly_array
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+## Default parameters of the spectral calibration map
+SCM_PARAMETERS = {'a0'         : 10.0,
+                  'col_scale'  : 2.0,
+                  'col_offset' : 0.5}
+
+## In-memory cache of generated maps
+_scm_cache = LRUCache(maxsize=8)
+
+## =============================================================================
+##
+##  Map generation
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                      spectral_calibration_map
+
+def spectral_calibration_map(image_area,
+                             a0=SCM_PARAMETERS['a0'],
+                             col_scale=SCM_PARAMETERS['col_scale'],
+                             col_offset=SCM_PARAMETERS['col_offset'],
+                             dtype=float):
+    """ Evaluate the spectral calibration map for the full image area.
+
+        The wavelength assigned to pixel (row,col) is the distance of the point
+        (0.5*nofRows-row, col_scale*col) from (0, col_offset*col), scaled by
+        `a0`; this is the elliptical model of `Data.spectralCalibrationMap`.
+
+        :param image_area: Shape (rows,columns) of the full CCD.
+        :param a0: Scale factor of the map.
+        :param col_scale: Scale factor applied to the column number.
+        :param col_offset: Column dependent offset of the circle's center.
+        :param dtype: Floating point type of the generated map.
+    """
+    row, col = np.indices(image_area, dtype=dtype)
+    # Evaluate in place on the index arrays to avoid further temporaries
+    np.subtract(0.5*image_area[0], row, out=row)
+    np.square(row, out=row)
+    col *= (col_scale - col_offset)
+    np.square(col, out=col)
+    row += col
+    np.sqrt(row, out=row)
+    row *= a0
+    return row
+
+##______________________________________________________________________________
+##                                                               _cache_filename
+
+def _cache_filename(cache_dir,
+                    key,
+                    fmt):
+    """ Name of the file holding the persisted map for a given cache key. """
+    extension = {'npy': '.npy', 'hdf5': '.h5'}[fmt]
+    return os.path.join(cache_dir, 'scm_' + key_digest(key) + extension)
+
+##______________________________________________________________________________
+##                                                                     _load_map
+
+def _load_map(filename,
+              fmt):
+    """ Load a persisted map, returning `None` if the file is not available. """
+    if not os.path.isfile(filename):
+        return None
+    if fmt == 'npy':
+        return np.load(filename)
+    with h5py.File(filename, 'r') as f:
+        return f['scm'][...]
+
+##______________________________________________________________________________
+##                                                                     _save_map
+
+def _save_map(filename,
+              fmt,
+              scm,
+              key):
+    """ Persist a map; the file is written under a temporary name first, so
+        that concurrent runs never pick up a partially written map.
+    """
+    def write(tmpname):
+        if fmt == 'npy':
+            with open(tmpname, 'wb') as f:
+                np.save(f, scm)
+        else:
+            with h5py.File(tmpname, 'w') as f:
+                dataset = f.create_dataset('scm', data=scm)
+                dataset.attrs['key'] = repr(key)
+    atomic_write(filename, write)
+
+##______________________________________________________________________________
+##                                                                        get_scm
+
+def get_scm(image_area,
+            cache_dir=None,
+            fmt='npy',
+            dtype=float,
+            **parameters):
+    """ Retrieve the spectral calibration map for an instrument geometry,
+        generating it only if it is neither cached in memory nor on disk.
+
+        :param image_area: Shape (rows,columns) of the full CCD.
+        :param cache_dir: Directory for persisted maps; `None` disables the
+                          on-disk cache.
+        :param fmt: File format of persisted maps, 'npy' or 'hdf5'.
+        :param dtype: Floating point type of the map.
+        :param parameters: Parameters of the map, overriding `SCM_PARAMETERS`.
+        :return: Read-only array holding the map; it is shared between callers.
+    """
+    if fmt not in ('npy', 'hdf5'):
+        raise ValueError("Unknown SCM file format '%s'" % fmt)
+    if fmt == 'hdf5' and h5py is None:
+        raise ImportError("Persisting maps in HDF5 format requires h5py")
+
+    values = dict(SCM_PARAMETERS)
+    values.update(parameters)
+    key = (tuple(image_area),
+           tuple(sorted(values.items())),
+           np.dtype(dtype).str)
+
+    scm = _scm_cache.get(key)
+    if scm is not None:
+        return scm
+
+    filename = None
+    if cache_dir is not None:
+        filename = _cache_filename(cache_dir, key, fmt)
+        scm = _load_map(filename, fmt)
+
+    if scm is None:
+        scm = spectral_calibration_map(image_area, dtype=dtype, **values)
+        if filename is not None:
+            _save_map(filename, fmt, scm, key)
+
+    scm = readonly_array(scm)
+    _scm_cache.put(key, scm)
+    return scm
+
+##______________________________________________________________________________
+##                                                                    clear_cache
+
+def clear_cache():
+    """ Drop all maps from the in-memory cache. """
+    _scm_cache.clear()
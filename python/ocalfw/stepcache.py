@@ -0,0 +1,276 @@
+""" Caching of the results of the individual steps of the PRNU algorithm.
+
+    The key of a step is a digest chained over the keys of all preceding steps:
+    it combines the key of the previous step with the step number and the
+    parameters of the step, while the chain starts from the contents of the
+    input data (signal, pixel quality mask, image area and selection). A change
+    of the parameters of one step therefore invalidates exactly that step and
+    all steps following it, so that re-running the algorithm only recomputes
+    the invalidated suffix of the pipeline.
+
+    Results are kept in an LRU cache in memory and can optionally be persisted
+    as NumPy `.npz` files.
+"""
+
+import os
+
+import numpy as np
+
+from cache import LRUCache, array_digest, atomic_write, key_digest
+
+## =============================================================================
+##
+##  Cache keys
+##
+## =============================================================================
+
+##______________________________________________________________________________
+##                                                               _parameter_key
+
+def _parameter_key(value):
+    """ Hashable representation of a step parameter; arrays are represented by
+        the digest of their contents.
+    """
+    if isinstance(value, np.ndarray):
+        return ('array', array_digest(value))
+    if isinstance(value, dict):
+        return tuple((key, _parameter_key(value[key])) for key in sorted(value))
+    if isinstance(value, (tuple, list)):
+        return tuple(_parameter_key(item) for item in value)
+    if isinstance(value, type):
+        return np.dtype(value).str
+    return value
+
+##______________________________________________________________________________
+##                                                                     input_key
+
+def input_key(data):
+    """ Key of the input data of the PRNU algorithm held by a `Data` object;
+        the steps only distinguish good (zero) and bad (non-zero) pixels in
+        the pixel quality mask.
+    """
+    return key_digest((array_digest(data._signal, np.asarray(data._pixel_quality) != 0),
+                       tuple(data.image_area),
+                       tuple(data._selection)))
+
+##______________________________________________________________________________
+##                                                                     step_keys
+
+def step_keys(data,
+              parameters):
+    """ Chained keys of the steps of the PRNU algorithm.
+
+        :param data: `Data` object holding the input data.
+        :param parameters: Sequence of tuples (step, parameters), where
+                           `parameters` holds everything, besides the results
+                           of the preceding steps, that the result of the step
+                           depends on.
+        :return: List with one key per step.
+    """
+    keys = []
+    key  = input_key(data)
+    for step, values in parameters:
+        key = key_digest((key, step, _parameter_key(values)))
+        keys.append(key)
+    return keys
+
+## =============================================================================
+##
+##  Class definition
+##
+## =============================================================================
+
+class StepCache (object):
+    """ Cache of step results, each a dictionary attribute name -> value.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self,
+                 maxsize=32,
+                 cache_dir=None):
+        """ Initialize object's internal data.
+
+            :param maxsize: Maximum number of step results kept in memory.
+            :param cache_dir: Directory for persisted step results; `None`
+                              keeps the results only in memory.
+        """
+        """ In-memory cache of step results. """
+        self._cache = LRUCache(maxsize=maxsize)
+        """ Directory for persisted step results. """
+        self.cache_dir = cache_dir
+        """ Number of lookups served from the cache (memory or disk). """
+        self.hits = 0
+        """ Number of lookups not served from the cache. """
+        self.misses = 0
+
+    ##__________________________________________________________________________
+    ##                                                                 _filename
+
+    def _filename(self, key):
+        return os.path.join(self.cache_dir, 'step_' + key + '.npz')
+
+    ##__________________________________________________________________________
+    ##                                                                       get
+
+    def get(self, key):
+        """ Look up the result of a step.
+
+            :return: Dictionary attribute name -> value, or `None` if the result
+                     is not cached. The values must not be modified; use
+                     `restore` to hand them to a `Data` object.
+        """
+        result = self._cache.get(key)
+        if result is None and self.cache_dir is not None:
+            result = self._load(key)
+            if result is not None:
+                self._cache.put(key, result)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    ##__________________________________________________________________________
+    ##                                                                       put
+
+    def put(self,
+            key,
+            data,
+            names):
+        """ Store the result of a step.
+
+            :param key: Key of the step, see `step_keys`.
+            :param data: Object holding the result of the step.
+            :param names: Names of the attributes of `data` produced by the step.
+        """
+        result = dict((name, _copy(getattr(data, name))) for name in names)
+        self._cache.put(key, result)
+        if self.cache_dir is not None:
+            self._save(key, result)
+
+    ##__________________________________________________________________________
+    ##                                                                   restore
+
+    @staticmethod
+    def restore(data,
+                result):
+        """ Set the attributes of a data object from cached step results;
+            writable arrays are copied, so that the cached values are not
+            altered by in-place operations of later steps.
+        """
+        for name, value in result.items():
+            setattr(data, name, _copy(value))
+
+    ##__________________________________________________________________________
+    ##                                                                     clear
+
+    def clear(self):
+        """ Drop all results from the in-memory cache. """
+        self._cache.clear()
+
+    ##__________________________________________________________________________
+    ##                                                                     _save
+
+    def _save(self,
+              key,
+              result):
+        """ Persist a step result; tuples of arrays are stored element-wise. """
+        arrays = {}
+        for name, value in result.items():
+            if isinstance(value, tuple):
+                for n, item in enumerate(value):
+                    arrays['%s.%d' % (name, n)] = item
+            else:
+                arrays[name] = np.asarray(value)
+        def write(tmpname):
+            with open(tmpname, 'wb') as f:
+                np.savez(f, **arrays)
+        atomic_write(self._filename(key), write)
+
+    ##__________________________________________________________________________
+    ##                                                                     _load
+
+    def _load(self, key):
+        """ Load a persisted step result, `None` if not available. """
+        filename = self._filename(key)
+        if not os.path.isfile(filename):
+            return None
+        result = {}
+        items  = {}
+        with np.load(filename) as f:
+            for name in f.files:
+                if '.' in name:
+                    name_, n = name.rsplit('.', 1)
+                    items.setdefault(name_, {})[int(n)] = f[name]
+                else:
+                    result[name] = f[name]
+        for name, values in items.items():
+            result[name] = tuple(values[n] for n in sorted(values))
+        return result
+
+##______________________________________________________________________________
+##                                                                         _copy
+
+def _copy(value):
+    """ Copy of writable arrays (also within tuples); read-only arrays, such as
+        the shared spectral calibration map, are returned as they are.
+    """
+    if isinstance(value, np.ndarray):
+        return value.copy() if value.flags.writeable else value
+    if isinstance(value, tuple):
+        return tuple(_copy(item) for item in value)
+    return value
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import shutil
+    import sys
+    import tempfile
+    import time
+    from prnu import PRNU
+
+    def run(prnu, cache):
+        """ Run the PRNU calculation, returning the time and executed steps. """
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        hits  = cache.hits if cache is not None else 0
+        start = time.time()
+        prnu.calc_prnu(cache=cache)
+        elapsed = time.time()-start
+        sys.stdout = stdout
+        if cache is None:
+            return elapsed, len(PRNU.STEP_OUTPUTS)
+        return elapsed, len(PRNU.STEP_OUTPUTS)-(cache.hits-hits)
+
+    directory = tempfile.mkdtemp()
+    signal    = 1.0 + np.random.rand(1024, 600)
+    cache     = StepCache(cache_dir=directory)
+    prnu      = PRNU(signal=signal)
+
+    print ("\n[Incremental PRNU recomputation]\n")
+    print ("%-36s %10s %10s" % ("run", "time [s]", "computed"))
+    print ("%-36s %10.4f %10d" % (("cold cache",) + run(prnu, cache)))
+    print ("%-36s %10.4f %10d" % (("unchanged",) + run(prnu, cache)))
+    prnu._filter_shape = (31, 31)
+    print ("%-36s %10.4f %10d" % (("step 4 filter shape changed",) + run(prnu, cache)))
+    prnu.step_options[4] = {'method': 'separable'}
+    print ("%-36s %10.4f %10d" % (("step 4 method changed",) + run(prnu, cache)))
+
+    ## Same results as a computation from scratch
+    reference = PRNU(signal=signal)
+    reference._filter_shape = (31, 31)
+    reference.step_options[4] = {'method': 'separable'}
+    print ("%-36s %10.4f %10d" % (("no cache",) + run(reference, None)))
+    np.testing.assert_array_equal(prnu._data._prnu, reference._data._prnu)
+
+    ## Results persisted on disk
+    restarted = PRNU(signal=signal)
+    restarted._filter_shape = (31, 31)
+    restarted.step_options[4] = {'method': 'separable'}
+    print ("%-36s %10.4f %10d" % (("new process, disk cache",)
+                                  + run(restarted, StepCache(cache_dir=directory))))
+    np.testing.assert_array_equal(restarted._data._prnu, reference._data._prnu)
+    shutil.rmtree(directory)
@@ -0,0 +1,196 @@
+""" Models of the swath dependent signal variation.
+
+    The signal variation across the swath only depends on the detector column,
+    so it is described by a 1D column profile. The 2D map of a frame is a
+    read-only broadcast view of the profile, which does not allocate memory
+    for the full image area; adding the variation to a frame or to a stack of
+    frames is a single broadcast addition of the profile along the last axis.
+"""
+
+import numpy as np
+
+from functions import Sin
+
+## =============================================================================
+##
+##  Class definitions
+##
+## =============================================================================
+
+class SwathProfile (object):
+    """ Base class of the column profiles of the swath dependent signal
+        variation; derived classes implement `evaluate`.
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  evaluate
+
+    def evaluate(self, columns):
+        """ Signal variation at the given column numbers. """
+        raise NotImplementedError
+
+    ##__________________________________________________________________________
+    ##                                                                   profile
+
+    def profile(self, nofColumns):
+        """ Column profile for a detector with `nofColumns` columns. """
+        return self.evaluate(np.arange(nofColumns, dtype=float))
+
+    ##__________________________________________________________________________
+    ##                                                                       map
+
+    def map(self,
+            shape,
+            materialize=False):
+        """ Map of the signal variation.
+
+            :param shape: Shape of the map, the last axis being the columns;
+                          e.g. (rows,columns) or (frames,rows,columns).
+            :param materialize: Return a writable array of the full shape
+                                instead of a read-only broadcast view.
+        """
+        view = np.broadcast_to(self.profile(shape[-1]), tuple(shape))
+        return view.copy() if materialize else view
+
+    ##__________________________________________________________________________
+    ##                                                                       add
+
+    def add(self,
+            frames,
+            out=None):
+        """ Add the signal variation to a frame or a stack of frames.
+
+            :param frames: Array with the columns along the last axis.
+            :param out: Optional output array, e.g. `frames` for an in-place
+                        addition.
+        """
+        return np.add(frames, self.profile(np.shape(frames)[-1]), out=out)
+
+##______________________________________________________________________________
+##                                                                   SineProfile
+
+class SineProfile (SwathProfile):
+    """ Sinusoidal profile, see `functions.Sin`.
+    """
+
+    def __init__(self,
+                 a0=0.0,
+                 a1=1.0,
+                 a2=1.0,
+                 a3=0.0):
+        self.a0 = a0
+        self.a1 = a1
+        self.a2 = a2
+        self.a3 = a3
+
+    def evaluate(self, columns):
+        return Sin(columns, a0=self.a0, a1=self.a1, a2=self.a2, a3=self.a3)
+
+##______________________________________________________________________________
+##                                                             PolynomialProfile
+
+class PolynomialProfile (SwathProfile):
+    """ Polynomial profile in the normalized column coordinate
+        (column-center)/scale.
+    """
+
+    def __init__(self,
+                 coefficients,
+                 center=0.0,
+                 scale=1.0):
+        """ Initialize object's internal data.
+
+            :param coefficients: Polynomial coefficients, highest power first
+                                 (as for `np.polyval`).
+            :param center: Column mapped onto coordinate 0.
+            :param scale: Number of columns per unit of the coordinate.
+        """
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.center = center
+        self.scale = scale
+
+    def evaluate(self, columns):
+        return np.polyval(self.coefficients, (columns-self.center)/float(self.scale))
+
+##______________________________________________________________________________
+##                                                              TabulatedProfile
+
+class TabulatedProfile (SwathProfile):
+    """ Profile tabulated at a set of columns, linearly interpolated in
+        between and held constant beyond the first and last column.
+    """
+
+    def __init__(self,
+                 columns,
+                 values):
+        columns = np.asarray(columns, dtype=float)
+        values  = np.asarray(values, dtype=float)
+        if columns.shape != values.shape or columns.ndim != 1:
+            raise ValueError("Columns and values of a tabulated profile must be"
+                             " 1D arrays of the same length!")
+        order = np.argsort(columns)
+        self.columns = columns[order]
+        self.values  = values[order]
+
+    def evaluate(self, columns):
+        return np.interp(columns, self.columns, self.values)
+
+##______________________________________________________________________________
+##                                                                 default_swath
+
+def default_swath(nofColumns):
+    """ Sinusoidal swath profile used for the simulated detector signal: one
+        period across the detector width, amplitude 20.
+    """
+    return SineProfile(a1=20, a2=2.0/nofColumns)
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import time
+
+    def best_of(function, repeat=5):
+        best = np.inf
+        for n in range(repeat):
+            start = time.time()
+            function()
+            best = min(best, time.time()-start)
+        return best
+
+    def column_loop(shape):
+        """ Previous implementation: full map filled column by column. """
+        swath = np.random.rand(*shape)
+        for col in np.arange(shape[1]):
+            swath[:,col] = Sin(col, a1=20, a2=2.0/shape[1])
+        return swath
+
+    shape   = (1024, 600)
+    profile = default_swath(shape[1])
+    np.testing.assert_array_equal(profile.map(shape), column_loop(shape))
+
+    print ("\n[Swath map, %d x %d]\n" % shape)
+    print ("-- Column loop ................ = %.5f s" % best_of(lambda: column_loop(shape)))
+    print ("-- Broadcast view ............. = %.5f s" % best_of(lambda: profile.map(shape)))
+    print ("-- Materialized map ........... = %.5f s"
+           % best_of(lambda: profile.map(shape, materialize=True)))
+    print ("-- Strides of view ............ = %s" % (profile.map(shape).strides,))
+
+    frames = np.random.rand(16, shape[0], shape[1])
+    print ("\n[Adding swath variation to %d frames]\n" % len(frames))
+    print ("-- Per-frame column loop ...... = %.5f s"
+           % best_of(lambda: [frame + column_loop(shape) for frame in frames], 1))
+    print ("-- Broadcast add .............. = %.5f s" % best_of(lambda: profile.add(frames)))
+    print ("-- Broadcast add, in-place .... = %.5f s"
+           % best_of(lambda: profile.add(frames, out=frames)))
+
+    print ("\n[Profiles]\n")
+    for name, model in [('sine', profile),
+                        ('polynomial', PolynomialProfile([-20.0, 0.0, 20.0],
+                                                         center=shape[1]/2.0,
+                                                         scale=shape[1]/2.0)),
+                        ('tabulated', TabulatedProfile([0, 150, 300, 450, 599],
+                                                       [0, 20, 0, -20, 0]))]:
+        values = model.profile(shape[1])
+        print ("-- %-12s min = %8.3f  max = %8.3f  at column 150 = %8.3f"
+               % (name, values.min(), values.max(), values[150]))
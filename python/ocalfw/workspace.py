@@ -0,0 +1,185 @@
+""" Pool of preallocated work buffers.
+
+    Processing a sequence of frames of the same geometry needs the same set of
+    intermediate arrays for every frame. Instead of allocating these anew, the
+    buffers of a finished frame are released to a pool, from which the next
+    frame acquires them again, keyed on shape and data type. A workspace may
+    be shared by steps executed concurrently in threads.
+"""
+
+import threading
+import weakref
+
+import numpy as np
+
+## =============================================================================
+##
+##  Class definition
+##
+## =============================================================================
+
+class Workspace (object):
+    """ Pool of reusable arrays, keyed on (shape, dtype).
+    """
+
+    ##__________________________________________________________________________
+    ##                                                                  __init__
+
+    def __init__(self, maxsize=16):
+        """ Initialize object's internal data.
+
+            :param maxsize: Maximum number of released buffers kept per
+                            (shape, dtype) key; surplus buffers are dropped.
+        """
+        """ Maximum number of released buffers kept per key. """
+        self.maxsize = maxsize
+        """ Released buffers: (shape, dtype) -> list of arrays. """
+        self._free = {}
+        """ Buffers handed out by the pool: id -> array, held weakly, so that
+            an entry disappears with its array and a recycled id of another
+            array is never mistaken for a pooled buffer. """
+        self._owned = weakref.WeakValueDictionary()
+        """ Number of buffers allocated. """
+        self.allocated = 0
+        """ Number of buffers reused from the pool. """
+        self.reused = 0
+        """ Lock serializing access to the pool. """
+        self._lock = threading.Lock()
+
+    ##__________________________________________________________________________
+    ##                                                              __getstate__
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        # Buffers handed out belong to the arrays of this process only
+        del state['_owned']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._owned = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    ##__________________________________________________________________________
+    ##                                                                   acquire
+
+    def acquire(self,
+                shape,
+                dtype=float):
+        """ Get an uninitialized buffer of the given shape and data type.
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                buffer = free.pop()
+                self.reused += 1
+            else:
+                buffer = np.empty(key[0], dtype=dtype)
+                self.allocated += 1
+            self._owned[id(buffer)] = buffer
+        return buffer
+
+    ##__________________________________________________________________________
+    ##                                                                   release
+
+    def release(self, buffer):
+        """ Return a buffer to the pool; arrays which have not been acquired
+            from this pool (including views of pooled buffers) are ignored, so
+            any array may safely be passed.
+        """
+        if not isinstance(buffer, np.ndarray) or buffer.base is not None:
+            return
+        with self._lock:
+            if self._owned.get(id(buffer)) is not buffer:
+                return
+            del self._owned[id(buffer)]
+            free = self._free.setdefault((buffer.shape, buffer.dtype.str), [])
+            if len(free) < self.maxsize:
+                free.append(buffer)
+
+    ##__________________________________________________________________________
+    ##                                                                     clear
+
+    def clear(self):
+        """ Drop all released buffers. """
+        with self._lock:
+            self._free.clear()
+
+    ##__________________________________________________________________________
+    ##                                                                    nbytes
+
+    def nbytes(self):
+        """ Number of bytes held by released buffers. """
+        return sum(buffer.nbytes for free in self._free.values() for buffer in free)
+
+##  Testing
+
+if __name__ == '__main__':
+
+    import multiprocessing
+    import os
+    import resource
+    import sys
+    import time
+    from data import Data
+    from prnu import PRNU
+
+    def run_frames(shared, nofFrames, queue):
+        """ Process consecutive frames, optionally with a shared workspace. """
+        sys.stdout = open(os.devnull, 'w')
+        workspace = Workspace()
+        allocated = 0
+        start = time.time()
+        for n in range(nofFrames):
+            if not shared:
+                allocated += workspace.allocated
+                workspace = Workspace()
+            prnu = PRNU(signal=1.0+np.random.rand(1024, 600), workspace=workspace)
+            prnu.calc_prnu()
+            prnu._data.release()
+        elapsed = time.time()-start
+        allocated += workspace.allocated
+        queue.put((elapsed/nofFrames,
+                   resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,
+                   allocated))
+
+    ## Views, copies and arrays of another id are not taken into the pool
+    workspace = Workspace()
+    buffer = workspace.acquire((4, 4))
+    for other in [buffer[:2], buffer.copy(), np.empty((4, 4))]:
+        workspace.release(other)
+    assert workspace.nbytes() == 0
+    workspace.release(buffer)
+    workspace.release(buffer)
+    assert workspace.nbytes() == buffer.nbytes and workspace.acquire((4, 4)) is buffer
+    del buffer
+    assert not len(workspace._owned) and workspace.acquire((4, 4)) is not None
+
+    ## Arrays allocated when constructing a data object
+    data = Data()
+    print ("\n[Memory allocated by Data()] %d bytes in %s"
+           % (sum(value.nbytes for value in data.__dict__.values()
+                  if isinstance(value, np.ndarray)),
+              sorted(name for name, value in data.__dict__.items()
+                     if isinstance(value, np.ndarray)) or "no arrays"))
+    data.setSelection([slice(0, 200), slice(0, 100)])
+    print ("-- Shapes after setSelection = %s, %s"
+           % (data._signal_row_norm.shape, data.f_norm_row.shape))
+
+    ## The pool saves allocations, not memory: the high-water mark is set by
+    ## the buffers of a single frame either way
+    print ("\n[Work buffer allocations and memory high-water mark, 1024 x 600 frames]\n")
+    print ("%8s %8s %14s %14s %14s" % ("frames", "pool", "time/frame [s]",
+                                       "max. RSS [MB]", "work buffers"))
+    for nofFrames in [1, 10, 40]:
+        for shared in [False, True]:
+            queue   = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_frames,
+                                              args=(shared, nofFrames, queue))
+            process.start()
+            elapsed, maxrss, allocated = queue.get()
+            process.join()
+            print ("%8d %8s %14.3f %14.1f %14d"
+                   % (nofFrames, shared, elapsed, maxrss, allocated))
@@ -1,3 +1,4 @@
+import bisect
 import numpy as np
 import matplotlib.pyplot as plt
 